@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for todo.py
+
+  Usage: bench.py [parse] [memory] [search] [analytics] [stress] [startup]
+                  [serve] [shell] [import] [parallel] [federated]
+                  [-n lines] [-p processes]
+"""
+
+import os
+import re
+import sys
+import time
+import json
+import random
+import shutil
+import socket
+import datetime
+import tempfile
+import subprocess
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import todo
+
+
+# Lines per second the tokenizer has to sustain on the synthetic file
+PARSE_TARGET = 200000
+# How many times smaller a TaskTable has to be than a list of Tasks
+MEMORY_TARGET = 10
+# How many times faster an indexed search has to be than a scan
+SEARCH_TARGET = 10
+# Seconds an analytics report over a decade of done tasks may take
+ANALYTICS_TARGET = 1.0
+ANALYTICS_DAYS = 3650
+# Concurrent processes and commands per process in the stress test
+STRESS_PROCESSES = 8
+STRESS_COMMANDS = 20
+# Actions timed from a new process on a small and on a big todo.txt
+# (5 times -n lines), and how many times slower add may get on the big
+# one: it shouldn't read it
+STARTUP_ACTIONS = [['shorthelp'], ['add', 'new task +bench'],
+                   ['addto', 'someday.txt', 'idea'], ['listfile'],
+                   ['ls', 'budget', '+ops'], ['stats']]
+STARTUP_RUNS = 5
+STARTUP_TARGET = 1.5
+# Requests sent to todo.py serve: the polls of status bars, whose
+# median may take SERVE_TARGET milliseconds, then searches and writes
+SERVE_POLLS = [['stats'], ['listcon'], ['--limit', '10', 'ls'],
+               ['--format', 'ndjson', '--limit', '10', 'ls']]
+SERVE_OTHERS = [['ls', 'deploy-42', '+taxes', '@phone'],
+                ['add', 'served task +bench'], ['append', '1', 'more']]
+SERVE_RUNS = 20
+SERVE_TARGET = 1.0
+# Commands of a grooming script run by todo.py shell, the seconds it may
+# take, and the commands run one process each to compare
+SHELL_COMMANDS = 300
+SHELL_TARGET = 1.0
+SHELL_SAMPLE = 5
+# Lines per second todo.py import has to add with dates and dedup, and
+# the adds run one process each to compare
+IMPORT_TARGET = 100000
+IMPORT_SAMPLE = 5
+# Speedup per CPU a cold parse of a big file (5 times -n lines) has to
+# get from processes over one
+PARALLEL_TARGET = 0.5
+# Todo directories searched at once for a page of tasks, the biggest
+# holding half of the -n lines, and how many times slower than a search
+# of the biggest alone searching all of them may be: the others hold as
+# many lines in all, which one CPU searches in about as long again.
+FEDERATED_DIRECTORIES = 100
+FEDERATED_SEARCH = ['--limit', '50', 'ls', '+release', 'deploy-42']
+FEDERATED_TARGET = 2.0
+
+WORDS = ['call', 'mom', 'review', 'deploy-42', 'fix', 'the', 'build',
+         'write', 'report', 'for', 'meeting', 'about', 'budget',
+         'due:2024-05-01', 'http://example.com', 'and', 'send', 'notes', 'to',
+         'team']
+PROJECTS = ['+ops', '+home', '+release', '+garden', '+taxes']
+CONTEXTS = ['@phone', '@work', '@home', '@errands', '@computer']
+
+
+def make_lines(count, seed=0):
+    """
+    Returns a list of random todo.txt lines
+    """
+    rand = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        words = rand.sample(WORDS, rand.randint(3, 12))
+        words += rand.sample(PROJECTS, rand.randint(0, 2))
+        words += rand.sample(CONTEXTS, rand.randint(0, 2))
+        rand.shuffle(words)
+        kind = rand.random()
+        if kind < 0.2:
+            words.insert(0, '(' + rand.choice('ABCDE') + ')')
+        elif kind < 0.4:
+            words.insert(0, 'x 2024-0{0}-1{0}'.format(rand.randint(1, 9)))
+        lines.append(' '.join(words) + '\n')
+    return lines
+
+
+def legacy_parse_task(line, number):
+    """
+    parse_task as it was before the tokenizer, kept as the baseline
+    """
+    pr_pattern = re.compile(r"^\(([A-Z])\)")
+    priority = re.match(pr_pattern, line)
+    comp_pattern = re.compile(r"(x\s\d{4}-\d{2}-\d{2}\s)")
+    completed = re.findall(comp_pattern, line)
+    proj_pattern = re.compile(r".*\s*(\+\w+)\s.*")
+    projects = re.findall(proj_pattern, line)
+    con_pattern = re.compile(r".*\s*(\@\w+)\s.*")
+    contexts = re.findall(con_pattern, line)
+    if priority:
+        priority = priority.group(1)
+    return todo.Task(number, str(line), priority, projects, contexts,
+                     completed)
+
+
+def timed(function, lines):
+    """
+    Returns lines per second for parsing lines with function
+    """
+    start = time.perf_counter()
+    for number, line in enumerate(lines, 1):
+        function(line, number)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def bench_parse(count):
+    lines = make_lines(count)
+    legacy = timed(legacy_parse_task, lines)
+    current = timed(todo.parse_task, lines)
+    print("parse: {0} lines".format(count))
+    print("  regex parser:  {0:>10,.0f} lines/s".format(legacy))
+    print("  tokenizer:     {0:>10,.0f} lines/s ({1:.1f}x)".format(
+        current, current / legacy))
+    print("  target:        {0:>10,} lines/s".format(PARSE_TARGET))
+    return current >= PARSE_TARGET
+
+
+def write_todo_file(count):
+    """
+    Writes count random lines to a temporary todo.txt, returns its path
+    """
+    fd, path = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(make_lines(count))
+    return path
+
+
+def traced_size(function):
+    """
+    Returns the memory still allocated after calling function
+    """
+    tracemalloc.start()
+    result = function()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_memory(count):
+    path = write_todo_file(count)
+    try:
+        with open(path) as f:
+            objects = traced_size(lambda: [
+                todo.parse_task(line, number)
+                for number, line in enumerate(f, 1)])
+        table = traced_size(lambda: todo.parse_todo_file(path))
+    finally:
+        os.remove(path)
+    print("memory: {0} lines".format(count))
+    print("  Task objects:  {0:>10,} bytes".format(objects))
+    print("  TaskTable:     {0:>10,} bytes ({1:.1f}x smaller)".format(
+        table, objects / table))
+    return objects / table >= MEMORY_TARGET
+
+
+def bench_search(count):
+    path = write_todo_file(count)
+    queries = [['+ops', '@phone', 'budget'], ['deploy-42', '-@work', '-+ops'],
+               ['review', 'meeting', 'notes', 'team']]
+    try:
+        table = todo.parse_todo_file(path)
+        tasks = list(table)
+        start = time.perf_counter()
+        table.word_index()
+        built = time.perf_counter() - start
+        indexed = scan = 0
+        for terms in queries:
+            start = time.perf_counter()
+            matching = todo.match_keyword_arguments(table, terms)
+            indexed += time.perf_counter() - start
+            start = time.perf_counter()
+            expected = todo.match_keyword_arguments(tasks, terms)
+            scan += time.perf_counter() - start
+            if [task.row for task in matching] != [
+                    task.row for task in expected]:
+                print("search: results differ for", ' '.join(terms))
+                return False
+    finally:
+        os.remove(path)
+    print("search: {0} lines, {1} queries".format(count, len(queries)))
+    print("  index built:   {0:>10.1f} ms".format(built * 1000))
+    print("  scan:          {0:>10.1f} ms/query".format(
+        scan * 1000 / len(queries)))
+    print("  index:         {0:>10.1f} ms/query ({1:.1f}x)".format(
+        indexed * 1000 / len(queries), scan / indexed))
+    return scan / indexed >= SEARCH_TARGET
+
+
+def bench_analytics(count):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'done.txt')
+    try:
+        first = datetime.date.today().toordinal() - ANALYTICS_DAYS
+        with open(path, 'w') as f:
+            for number, line in enumerate(make_lines(count)):
+                if line.startswith('x '):
+                    line = line[13:]  # Done already
+                elif line.startswith('('):
+                    line = line[4:]  # Prioritized
+                day = first + number * ANALYTICS_DAYS // count
+                created = datetime.date.fromordinal(day - number % 30)
+                f.write('x {0} {1} {2}'.format(
+                    datetime.date.fromordinal(day), created, line))
+        archive = todo.ArchiveIndex(path)
+        archive.update()  # Built once, later appends are indexed alone
+        times = []
+        for report in ('summary', 'day', 'week', 'project', 'context'):
+            start = time.perf_counter()
+            list(todo.analytics_records(report, [archive], 0))
+            times.append((report, time.perf_counter() - start))
+    finally:
+        shutil.rmtree(directory)
+    print("analytics: {0} done tasks over {1} days".format(
+        count, ANALYTICS_DAYS))
+    for report, seconds in times:
+        print("  {0:<14} {1:>10.1f} ms".format(report + ':', seconds * 1000))
+    print("  target:        {0:>10.1f} ms".format(ANALYTICS_TARGET * 1000))
+    return max(seconds for _, seconds in times) <= ANALYTICS_TARGET
+
+
+def run_commands(directory, worker):
+    """
+    Runs STRESS_COMMANDS todo.py commands one after the other:
+    adds a task, and every other time appends a word to task 1
+    """
+    for n in range(STRESS_COMMANDS):
+        if n % 2:
+            argv = ['append', '1', 'w{0}-{1}'.format(worker, n)]
+        else:
+            argv = ['add', 'task {0}-{1} +stress'.format(worker, n)]
+        subprocess.run([sys.executable, todo.__file__, '-d', directory] + argv,
+                       stdout=subprocess.DEVNULL, check=True)
+
+
+def bench_stress(count):
+    processes = STRESS_PROCESSES
+    if '-p' in sys.argv:
+        processes = int(sys.argv[sys.argv.index('-p') + 1])
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'todo.txt'), 'w') as f:
+            f.write('anchor\n')
+            f.writelines(make_lines(count // 20))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(processes) as pool:
+            list(pool.map(lambda worker: run_commands(directory, worker),
+                          range(processes)))
+        elapsed = time.perf_counter() - start
+
+        with open(os.path.join(directory, 'todo.txt')) as f:
+            lines = f.read().splitlines()
+    finally:
+        shutil.rmtree(directory)
+
+    added = sum(line.endswith('+stress') for line in lines)
+    appended = len(lines[0].split()) - 1
+    expected = processes * STRESS_COMMANDS // 2
+    commands = processes * STRESS_COMMANDS
+    print("stress: {0} processes, {1} commands, {2} lines".format(
+        processes, commands, count // 20))
+    print("  throughput:    {0:>10,.1f} commands/s".format(commands / elapsed))
+    print("  added:         {0:>10} of {1}".format(added, expected))
+    print("  appended:      {0:>10} of {1}".format(appended, expected))
+    return added == expected and appended == expected
+
+
+def startup_time(directory, argv):
+    """
+    Returns the median seconds of STARTUP_RUNS runs of a todo.py command
+    """
+    times = []
+    for _ in range(STARTUP_RUNS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, todo.__file__, '-d', directory] + argv,
+                       stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def bench_startup(count):
+    sizes = (10, count * 5)
+    directories = [tempfile.mkdtemp() for _ in sizes]
+    try:
+        for directory, size in zip(directories, sizes):
+            with open(os.path.join(directory, 'todo.txt'), 'w') as f:
+                for start in range(0, size, 100000):
+                    f.writelines(make_lines(min(100000, size - start), start))
+            startup_time(directory, ['ls', 'budget'])  # Cache and index
+        times = {' '.join(argv[:1]): [startup_time(directory, argv)
+                                      for directory in directories]
+                 for argv in STARTUP_ACTIONS}
+    finally:
+        for directory in directories:
+            shutil.rmtree(directory)
+    print("startup: {0} and {1} lines".format(*sizes))
+    for action, (small, big) in times.items():
+        print("  {0:<14} {1:>10.1f} ms {2:>10.1f} ms".format(
+            action + ':', small * 1000, big * 1000))
+    small, big = times['add']
+    print("  add target:    {0:>10.1f}x".format(STARTUP_TARGET))
+    return big <= small * STARTUP_TARGET
+
+
+def serve_request(path, argv):
+    """
+    Sends argv to a todo.py server, returns the exit code and output
+    """
+    with socket.socket(socket.AF_UNIX) as client:
+        client.connect(path)
+        client.sendall((json.dumps(argv) + '\n').encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+        response = b''.join(iter(lambda: client.recv(1 << 16), b''))
+    code, _, output = response.decode('utf-8').partition('\n')
+    return int(code), output
+
+
+def bench_serve(count):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, todo.SERVE_SOCKET)
+    server = None
+    times = []
+    try:
+        with open(os.path.join(directory, 'todo.txt'), 'w') as f:
+            f.writelines(make_lines(count))
+        server = subprocess.Popen([sys.executable, todo.__file__, '-d',
+                                   directory, 'serve'],
+                                  stdout=subprocess.PIPE)
+        server.stdout.readline()  # Serving
+        for argv in SERVE_POLLS + SERVE_OTHERS:
+            samples = []
+            for _ in range(SERVE_RUNS):
+                start = time.perf_counter()
+                code, _ = serve_request(path, argv)
+                samples.append(time.perf_counter() - start)
+                if code != 0:
+                    print("serve: failed", ' '.join(argv))
+                    return False
+            times.append((' '.join(argv), sorted(samples)[SERVE_RUNS // 2]))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(directory)
+    print("serve: {0} lines, median of {1} requests".format(count, SERVE_RUNS))
+    for request, seconds in times:
+        print("  {0:<40} {1:>8.2f} ms".format(request + ':', seconds * 1000))
+    print("  {0:<40} {1:>8.2f} ms".format('poll target:', SERVE_TARGET))
+    return all(seconds * 1000 <= SERVE_TARGET
+               for _, seconds in times[:len(SERVE_POLLS)])
+
+
+def grooming_script(count, seed=0):
+    """
+    Returns the lines of a script adding, completing, prioritizing and
+    appending to tasks among the first count
+    """
+    rand = random.Random(seed)
+    commands = []
+    for n in range(SHELL_COMMANDS):
+        number = rand.randint(1, count // 2)
+        commands.append(['add "groomed {0} +ops"'.format(n),
+                         'do {0}'.format(number),
+                         'pri {0} B'.format(number),
+                         'append {0} reviewed'.format(number)][n % 4])
+    return [command + '\n' for command in commands]
+
+
+def bench_shell(count):
+    directory = tempfile.mkdtemp()
+    todo_path = os.path.join(directory, 'todo.txt')
+    script = grooming_script(count)
+    try:
+        with open(todo_path, 'w') as f:
+            f.writelines(make_lines(count))
+        argv = [sys.executable, todo.__file__, '-d', directory]
+        subprocess.run(argv + ['ls', 'budget'], stdout=subprocess.DEVNULL,
+                       check=True)  # Cache and index
+        start = time.perf_counter()
+        subprocess.run(argv + ['shell'], input=''.join(script), text=True,
+                       stdout=subprocess.DEVNULL, check=True)
+        shell = time.perf_counter() - start
+        start = time.perf_counter()
+        for line in script[:SHELL_SAMPLE]:
+            subprocess.run(argv + line.replace('"', '').split(),
+                           stdout=subprocess.DEVNULL)
+        processes = (time.perf_counter() - start) / SHELL_SAMPLE
+    finally:
+        shutil.rmtree(directory)
+    print("shell: {0} lines, {1} commands".format(count, len(script)))
+    print("  one process each: {0:>10.1f} s (estimated)".format(
+        processes * len(script)))
+    print("  shell:            {0:>10.1f} s".format(shell))
+    print("  target:           {0:>10.1f} s".format(SHELL_TARGET))
+    return shell <= SHELL_TARGET
+
+
+def bench_import(count):
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'tickets.txt')
+    try:
+        with open(os.path.join(directory, 'todo.txt'), 'w') as f:
+            f.writelines(make_lines(count // 10, count))
+        with open(source, 'w') as f:
+            f.writelines(make_lines(count))
+        argv = [sys.executable, todo.__file__, '-d', directory]
+        subprocess.run(argv + ['ls', 'budget'], stdout=subprocess.DEVNULL,
+                       check=True)  # Cache and index
+        start = time.perf_counter()
+        subprocess.run(argv + ['import', source, 'date', 'dedup'],
+                       stdout=subprocess.DEVNULL, check=True)
+        imported = time.perf_counter() - start
+        start = time.perf_counter()
+        for line in make_lines(IMPORT_SAMPLE):
+            subprocess.run(argv + ['add', line.strip()],
+                           stdout=subprocess.DEVNULL, check=True)
+        adds = (time.perf_counter() - start) / IMPORT_SAMPLE
+    finally:
+        shutil.rmtree(directory)
+    print("import: {0} lines into {1}".format(count, count // 10))
+    print("  one add each: {0:>10.1f} s (estimated)".format(adds * count))
+    print("  import:       {0:>10.1f} s".format(imported))
+    print("  lines/s:      {0:>10.0f}".format(count / imported))
+    print("  target:       {0:>10.0f}".format(IMPORT_TARGET))
+    return count / imported >= IMPORT_TARGET
+
+
+def bench_parallel(count):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'done.txt')
+    size = count * 5
+    try:
+        with open(path, 'w') as f:
+            for start in range(0, size, 100000):
+                f.writelines(make_lines(min(100000, size - start), start))
+        times = {}
+        for jobs in (1, None):
+            todo.JOBS = jobs
+            start = time.perf_counter()
+            todo.TaskTable(todo.TaskFile(path))
+            times[jobs] = time.perf_counter() - start
+        todo.JOBS = None
+        megabytes = os.path.getsize(path) / (1 << 20)
+    finally:
+        shutil.rmtree(directory)
+    cpus = todo.parallel_jobs()
+    speedup = times[1] / times[None]
+    print("parallel: {0} lines, {1:.0f} MiB, {2} CPUs".format(
+        size, megabytes, cpus))
+    print("  one process: {0:>10.2f} s".format(times[1]))
+    print("  processes:   {0:>10.2f} s".format(times[None]))
+    print("  speedup:     {0:>10.1f}x".format(speedup))
+    print("  target:      {0:>10.1f}x".format(cpus * PARALLEL_TARGET))
+    return speedup >= cpus * PARALLEL_TARGET
+
+
+def bench_federated(count):
+    root = tempfile.mkdtemp()
+    sizes = [count // 2] + [count // 2 // (FEDERATED_DIRECTORIES - 1)] * (
+        FEDERATED_DIRECTORIES - 1)
+    try:
+        directories = []
+        for i, size in enumerate(sizes):
+            directory = os.path.join(root, 'team{0:03d}'.format(i))
+            os.mkdir(directory)
+            with open(os.path.join(directory, 'todo.txt'), 'w') as f:
+                f.writelines(make_lines(size, i))
+            directories.append(directory)
+        for directory in directories:
+            startup_time(directory, FEDERATED_SEARCH)  # Cache and index
+        biggest = startup_time(directories[0], FEDERATED_SEARCH)
+        small = startup_time(directories[1], FEDERATED_SEARCH)
+        start = time.perf_counter()
+        subprocess.run([sys.executable, todo.__file__, '-d',
+                        os.path.join(root, 'team*')] + FEDERATED_SEARCH,
+                       stdout=subprocess.DEVNULL, check=True)
+        federated = time.perf_counter() - start
+    finally:
+        shutil.rmtree(root)
+    print("federated: {0} directories, {1} lines".format(
+        len(sizes), sum(sizes)))
+    print("  biggest alone:   {0:>10.1f} ms".format(biggest * 1000))
+    print("  one per process: {0:>10.1f} ms (estimated)".format(
+        (biggest + small * (len(sizes) - 1)) * 1000))
+    print("  all at once:     {0:>10.1f} ms".format(federated * 1000))
+    print("  target:          {0:>10.1f}x".format(FEDERATED_TARGET))
+    return federated <= biggest * FEDERATED_TARGET
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'memory': bench_memory,
+    'search': bench_search,
+    'analytics': bench_analytics,
+    'stress': bench_stress,
+    'startup': bench_startup,
+    'serve': bench_serve,
+    'shell': bench_shell,
+    'import': bench_import,
+    'parallel': bench_parallel,
+    'federated': bench_federated,
+}
+
+
+def main():
+    count = 200000
+    if '-n' in sys.argv:
+        count = int(sys.argv[sys.argv.index('-n') + 1])
+    names = [x for x in sys.argv[1:] if x in BENCHMARKS] or list(BENCHMARKS)
+    passed = True
+    for name in names:
+        passed = BENCHMARKS[name](count) and passed
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
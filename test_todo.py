@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import re
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+
+import todo
+
+
+TODO_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'todo.py')
+
+TASKS = '''(A) call mom +family @phone
+x 2024-01-02 pay bills +home
+write report +work @office due:2024-05-01
+(B) fix bike +home @garage
+(C) plan trip @home
+buy milk
+'''
+
+
+class TodoTestCase(unittest.TestCase):
+    """
+    Runs each test in a todo directory of its own
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.write('todo.txt', TASKS)
+        self.set(PATH=self.dir)
+
+    def set(self, **settings):
+        """
+        Changes globals of todo until the test ends
+        """
+        patcher = mock.patch.multiple(todo, create=True, **settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, name, text):
+        with open(self.path(name), 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def read(self, name):
+        with open(self.path(name), encoding='utf-8') as f:
+            return f.read()
+
+    def todo(self, *argv, answer=''):
+        """
+        Runs todo.py on the test directory, returns its output
+        """
+        result = subprocess.run(
+            [sys.executable, TODO_PY, '-d', self.dir] + list(argv),
+            input=answer, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return result.stdout
+
+    def contents(self, tasks):
+        return [task.content for task in tasks]
+
+
+class CacheTest(TodoTestCase):
+    def test_reads_changed_file(self):
+        todo.load_tasks(self.path('todo.txt'))
+        self.assertTrue(os.path.exists(todo.cache_path(
+            self.path('todo.txt'))))
+        self.write('todo.txt', TASKS.replace('fix bike', 'fix door'))
+        tasks = todo.load_tasks(self.path('todo.txt'))
+        self.assertIn('(B) fix door +home @garage\n', self.contents(tasks))
+
+    def test_corrupted_cache_is_ignored(self):
+        todo.load_tasks(self.path('todo.txt'))
+        with open(todo.cache_path(self.path('todo.txt')), 'r+b') as f:
+            f.seek(20)
+            f.write(b'\xff\xff\xff\xff')
+        self.assertIsNone(todo.read_cache(
+            todo.TaskFile(self.path('todo.txt'))))
+        tasks = todo.load_tasks(self.path('todo.txt'))
+        self.assertEqual(self.contents(tasks), TASKS.splitlines(True))
+
+    def test_appended_lines_are_parsed(self):
+        todo.load_tasks(self.path('todo.txt'))
+        with open(self.path('todo.txt'), 'a') as f:
+            f.write('(A) water plants +garden\n')
+        tasks = todo.load_tasks(self.path('todo.txt'))
+        self.assertEqual(len(tasks), 7)
+        self.assertEqual(tasks[6].priority, 'A')
+        self.assertEqual(tasks[6].projects, ['+garden'])
+
+    def test_unchanged_file_isnt_read(self):
+        todo.load_tasks(self.path('todo.txt'))
+        with mock.patch.object(todo, 'prefix_checksum') as checksum:
+            tasks = todo.load_tasks(self.path('todo.txt'))
+        checksum.assert_not_called()
+        self.assertEqual(self.contents(tasks), TASKS.splitlines(True))
+
+    def fields(self, tasks):
+        return [(task.content, task.priority, task.projects, task.contexts,
+                 task.done) for task in tasks]
+
+    def test_same_length_edit_then_append(self):
+        # The cached prefix changed in the middle, its size didn't
+        lines = TASKS.splitlines(True) * 2000
+        self.write('todo.txt', ''.join(lines))
+        todo.load_tasks(self.path('todo.txt'))
+        lines[6000] = '(B) call mom +family @phone\n'
+        self.write('todo.txt', ''.join(lines) + 'water plants\n')
+        tasks = todo.load_tasks(self.path('todo.txt'))
+        self.assertEqual(self.fields(tasks), self.fields(
+            todo.parse_todo_file(self.path('todo.txt'))))
+        self.assertEqual(tasks[6000].priority, 'B')
+        self.assertEqual(tasks[12000].content, 'water plants\n')
+
+    def test_priorities_after_depri(self):
+        self.write('todo.txt', 'call mom\nbuy milk\n')
+        self.todo('lsp')
+        self.todo('pri', '1', 'B')
+        self.todo('pri', '1', 'A')
+        self.todo('depri', '1')
+        cold = self.todo('--no-cache', 'lsp').splitlines()[-1]
+        self.assertTrue(cold.endswith('TODO: 1 of 2 tasks shown'), cold)
+        self.assertEqual(self.todo('lsp').splitlines()[-1], cold)
+        self.assertIn('(B) 1 open, 0 done', self.todo('stats'))
+        self.assertEqual(self.fields(todo.load_tasks(self.path('todo.txt'))),
+                         self.fields(todo.parse_todo_file(
+                             self.path('todo.txt'))))
+
+
+class JournalTest(TodoTestCase):
+    def test_replay(self):
+        self.todo('--journal', 'do', '1')
+        self.todo('--journal', 'add', 'water plants')
+        self.todo('--journal', 'del', '2', answer='y\n')
+        self.assertEqual(self.read('todo.txt'), TASKS)
+        tasks = todo.load_tasks(self.path('todo.txt'))
+        self.assertEqual(self.contents(tasks), [
+            'x 2024-01-02 pay bills +home\n', '(B) fix bike +home @garage\n',
+            '(C) plan trip @home\n', 'buy milk\n', 'water plants\n'])
+
+    def test_compaction(self):
+        self.todo('--journal', 'do', '1')
+        self.todo('--journal', 'add', 'water plants')
+        journal = todo.journal_path(self.path('todo.txt'))
+        self.assertTrue(os.path.exists(journal))
+        replayed = self.contents(todo.load_tasks(self.path('todo.txt')))
+        self.todo('compact')
+        self.assertFalse(os.path.exists(journal))
+        self.assertEqual(self.read('todo.txt'), ''.join(replayed))
+
+    def test_outside_change_sets_journal_aside(self):
+        self.todo('--journal', 'do', '1')
+        self.write('todo.txt', 'new file\n')
+        tasks = todo.load_tasks(self.path('todo.txt'))
+        self.assertEqual(self.contents(tasks), ['new file\n'])
+        journal = todo.journal_path(self.path('todo.txt'))
+        self.assertFalse(os.path.exists(journal))
+        self.assertTrue(os.path.exists(journal + '.stale'))
+
+
+def fail_after_archiving():
+    todo.archive_tasks()
+    sys.exit(1)
+
+
+class GroupCommitTest(TodoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.set(current_tasks=todo.load_tasks(self.path('todo.txt')),
+                 DEFER_WRITES=True, deferred_done=[])
+
+    def test_queued_actions_are_written_once(self):
+        os.mkdir(todo.queue_dir())
+        for number, argv in enumerate((['pri', '3', 'A'], ['do', '9'],
+                                       ['append', '6', 'today'])):
+            path = os.path.join(todo.queue_dir(), '{0}.req'.format(number))
+            with open(path, 'w') as f:
+                json.dump(['todo.py'] + argv, f)
+        with self.assertRaises(SystemExit) as exit:
+            todo.commit_queue(['todo.py', 'depri', '1'])
+        self.assertEqual(exit.exception.code, 0)
+        lines = self.read('todo.txt').splitlines()
+        self.assertEqual(lines[0], 'call mom +family @phone')
+        self.assertEqual(lines[2], '(A) write report +work @office '
+                         'due:2024-05-01')
+        self.assertEqual(lines[5], 'buy milk today')
+        self.assertEqual(sorted(os.listdir(todo.queue_dir())),
+                         ['0.out', '1.out', '2.out'])
+        with open(os.path.join(todo.queue_dir(), '1.out')) as f:
+            self.assertEqual(f.readline(), '1\n')
+
+    def test_failed_action_is_rolled_back(self):
+        code, output = todo.run_action(['todo.py', 'pri', '3', 'A'],
+                                       capture=True)
+        self.assertEqual(code, 0, output)
+        before = self.contents(todo.current_tasks)
+        code, output = todo.run_action(['todo.py', 'do', '1', '9'],
+                                       capture=True)
+        self.assertEqual(code, 1, output)
+        self.assertEqual(self.contents(todo.current_tasks), before)
+
+    def test_unqueued_action_is_refused(self):
+        code, output = todo.run_action(['todo.py', 'del', '1'], capture=True)
+        self.assertEqual(code, 1)
+        self.assertIn("can't be queued", output)
+        self.assertEqual(self.contents(todo.current_tasks),
+                         TASKS.splitlines(True))
+
+    def test_failed_archive_is_rolled_back(self):
+        code, output = todo.run_action(['todo.py', 'do', '3'], capture=True)
+        self.assertEqual(code, 0, output)
+        before = self.contents(todo.current_tasks)
+        archived = list(todo.deferred_done)
+        actions = dict(todo.possible_actions, fail=fail_after_archiving)
+        with mock.patch.object(todo, 'possible_actions', actions):
+            code, _ = todo.run_action(['todo.py', 'fail'], capture=True,
+                                      queued=False)
+        self.assertEqual(code, 1)
+        self.assertEqual(self.contents(todo.current_tasks), before)
+        self.assertEqual(todo.deferred_done, archived)
+
+    def test_flush_writes_deferred_changes(self):
+        for argv in (['do', '1'], ['pri', '5', 'B'], ['archive']):
+            code, output = todo.run_action(['todo.py'] + argv, capture=True)
+            self.assertEqual(code, 0, output)
+        self.assertEqual(self.read('todo.txt'), TASKS)
+        self.assertFalse(os.path.exists(self.path('done.txt')))
+        todo.flush_writes()
+        lines = self.read('todo.txt').splitlines()
+        self.assertEqual(lines[-1], '(B) buy milk')
+        self.assertFalse(any(line.startswith('x ') for line in lines))
+        done = self.read('done.txt').splitlines()
+        self.assertEqual(len(done), 2)
+        self.assertTrue(done[0].endswith(' call mom +family @phone'))
+        self.assertEqual(done[1], 'x 2024-01-02 pay bills +home')
+
+    def test_archive_waits_for_todo(self):
+        code, output = todo.run_action(['todo.py', 'do', '1'], capture=True)
+        self.assertEqual(code, 0, output)
+        archive_done = todo.archive_done
+
+        def checked_archive(tasks):
+            self.assertNotEqual(self.read('todo.txt'), TASKS)
+            archive_done(tasks)
+
+        with mock.patch.object(todo, 'archive_done', checked_archive):
+            todo.flush_writes()
+        self.assertTrue(self.read('done.txt').endswith(
+            ' call mom +family @phone\n'))
+
+    def test_addto_done_is_deferred(self):
+        self.write('done.txt', '')
+        code, output = todo.run_action(
+            ['todo.py', 'addto', 'done.txt', 'x 2024-05-01 water plants'],
+            capture=True, queued=False)
+        self.assertEqual(code, 0, output)
+        self.assertEqual(self.read('done.txt'), '')
+        todo.flush_writes()
+        self.assertEqual(self.read('done.txt'),
+                         'x 2024-05-01 water plants\n')
+
+
+class QueryTest(unittest.TestCase):
+    def task(self, line):
+        return todo.parse_task(line + '\n', 1)
+
+    def test_terms(self):
+        query = todo.Query(['milk', '-bread', '+home', '-@work', 'pri:A-C',
+                            '-re:/^x/i'])
+        self.assertEqual(query.words, [('milk', False), ('bread', True)])
+        self.assertEqual(query.names, [('+home', False), ('@work', True)])
+        self.assertEqual(query.priorities, [('A', 'C', False)])
+        self.assertEqual(len(query.regexes), 1)
+        self.assertTrue(query.regexes[0][1])
+
+    def test_done_terms(self):
+        self.assertEqual(todo.Query(['done:true', '-done:false']).done,
+                         [True, True])
+
+    def test_lone_sigils_are_words(self):
+        query = todo.Query(['+', '@'])
+        self.assertEqual(query.words, [('+', False), ('@', False)])
+        self.assertEqual(query.names, [])
+
+    def test_invalid_terms(self):
+        for term in ('pri:a', 'pri:AB', 'done:yes', 'done:2024-1',
+                     're:milk', 're:/(/'):
+            with self.subTest(term=term):
+                self.assertRaises(ValueError, todo.Query, [term])
+
+    def test_matches(self):
+        query = todo.Query(['pri:A-B', '+home', '-milk'])
+        self.assertTrue(query.matches(self.task('(B) fix bike +home')))
+        self.assertFalse(query.matches(self.task('(C) fix bike +home')))
+        self.assertFalse(query.matches(self.task('(A) buy milk +home')))
+        self.assertFalse(query.matches(self.task('fix bike +home')))
+        query = todo.Query(['re:/BILLS$/i'])
+        self.assertTrue(query.matches(self.task('x 2024-02-29 pay bills')))
+
+    def test_completion_terms(self):
+        self.assertEqual(todo.Query(['done:2024-01']).completed,
+                         [('2024-01', '2024-01', False)])
+        self.assertEqual(todo.Query(['-done:2024..2024-03-15']).completed,
+                         [('2024', '2024-03-15', True)])
+
+    def test_matches_completion_dates(self):
+        query = todo.Query(['done:2024-01..2024-02'])
+        self.assertTrue(query.matches(self.task('x 2024-02-29 pay bills')))
+        self.assertFalse(query.matches(self.task('x 2024-03-01 pay bills')))
+        self.assertFalse(query.matches(self.task('pay bills')))
+
+
+DONE = '''x 2024-01-02 pay bills
+x 2024-01-05 call bank +home
+note kept in done.txt
+x 2024-02-11 renew passport
+x 2024-03-01 file taxes +home
+x 2024-03-09 fix sink
+'''
+ROTATED = sorted(line for line in DONE.splitlines(True) if line[:2] == 'x ')
+
+
+class Crash(Exception):
+    pass
+
+
+class RotationTest(TodoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write('done.txt', DONE)
+
+    def rotated(self):
+        segments = todo.load_segments()
+        return sorted(line for segment in segments.segments
+                      for line in segment.lines()) if segments else []
+
+    def test_rotate(self):
+        todo.rotate_archive()
+        self.assertEqual(self.read('done.txt'), 'note kept in done.txt\n')
+        self.assertEqual(sorted(os.listdir(todo.segments_path())),
+                         ['2024-01.txt.gz', '2024-02.txt.gz',
+                          '2024-03.txt.gz'])
+        self.assertEqual(self.rotated(), ROTATED)
+
+    def test_rotate_into_old_segments(self):
+        todo.rotate_archive()
+        more = 'x 2024-03-20 call plumber\nx 2024-04-02 pay rent\n'
+        self.write('done.txt', self.read('done.txt') + more)
+        todo.rotate_archive()
+        self.assertEqual(self.rotated(),
+                         sorted(ROTATED + more.splitlines(True)))
+
+    def test_concurrent_addto(self):
+        todo.rotate_archive()
+        added = ['x 2024-03-{0:02} task {0}\n'.format(day)
+                 for day in range(10, 18)]
+        processes = [subprocess.Popen(
+            [sys.executable, TODO_PY, '-d', self.dir, 'addto', 'done.txt',
+             line.rstrip('\n')], stdout=subprocess.DEVNULL)
+            for line in added]
+        for process in processes:
+            self.assertEqual(process.wait(), 0)
+        self.assertEqual(self.rotated(), sorted(ROTATED + added))
+
+    def crash_rotation(self, appends):
+        append = todo.ArchiveSegment.append
+        calls = []
+
+        def crashing_append(segment, lines):
+            if len(calls) == appends:
+                raise Crash
+            calls.append(segment)
+            append(segment, lines)
+
+        with mock.patch.object(todo.ArchiveSegment, 'append',
+                               crashing_append):
+            self.assertRaises(Crash, todo.rotate_archive)
+        self.assertTrue(os.path.exists(todo.rotate_log_path()))
+        todo.recover_rotation()
+        self.assertFalse(os.path.exists(todo.rotate_log_path()))
+
+    def test_crash_between_segments(self):
+        for appends in (0, 1, 2):
+            with self.subTest(appends=appends):
+                shutil.rmtree(todo.segments_path(), ignore_errors=True)
+                self.write('done.txt', DONE)
+                self.crash_rotation(appends)
+                self.assertEqual(self.read('done.txt'),
+                                 'note kept in done.txt\n')
+                self.assertEqual(self.rotated(), ROTATED)
+
+    def test_crash_into_old_segments(self):
+        todo.rotate_archive()
+        more = 'x 2024-03-20 call plumber\nx 2024-04-02 pay rent\n'
+        self.write('done.txt', self.read('done.txt') + more)
+        self.crash_rotation(0)
+        self.assertEqual(self.rotated(),
+                         sorted(ROTATED + more.splitlines(True)))
+
+    def test_crash_before_done_is_written(self):
+        with mock.patch.object(todo, 'write_tasks', side_effect=Crash):
+            self.assertRaises(Crash, todo.rotate_archive)
+        todo.recover_rotation()
+        self.assertFalse(os.path.exists(todo.rotate_log_path()))
+        self.assertEqual(self.read('done.txt'), DONE)
+        self.assertEqual(self.rotated(), [])
+
+
+class MoveTest(TodoTestCase):
+    def test_move(self):
+        self.write('someday.txt', 'learn piano\n')
+        self.todo('mv', '1,4', 'someday.txt')
+        self.assertEqual(self.read('someday.txt'),
+                         'learn piano\n(A) call mom +family @phone\n'
+                         '(B) fix bike +home @garage\n')
+        self.assertEqual(self.read('todo.txt').splitlines(),
+                         [line for line in TASKS.splitlines()
+                          if 'mom' not in line and 'bike' not in line])
+        self.assertFalse(os.path.exists(todo.move_log_path()))
+
+    def test_crash_before_source_is_replaced(self):
+        self.write('someday.txt', 'learn piano')
+        table = todo.load_tasks(self.path('todo.txt'))
+        replace = os.replace
+
+        def crashing_replace(source, destination):
+            if destination == self.path('todo.txt'):
+                raise Crash
+            replace(source, destination)
+
+        with mock.patch.object(todo.os, 'replace', crashing_replace):
+            self.assertRaises(Crash, todo.commit_move, table,
+                              [table.order[0]], self.path('someday.txt'))
+        self.assertEqual(self.read('someday.txt'),
+                         'learn piano\n(A) call mom +family @phone\n')
+        todo.recover_move()
+        self.assertEqual(self.read('someday.txt'), 'learn piano')
+        self.assertEqual(self.read('todo.txt'), TASKS)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['.todo.txt.cache', 'someday.txt', 'todo.txt'])
+
+
+class CatalogTest(TodoTestCase):
+    def states(self):
+        return {record['file']: record['state'] for record in
+                json.loads(self.todo('--format', 'json', 'lf'))}
+
+    def test_state_follows_the_cache(self):
+        self.write('notes.txt', 'learn piano\n')
+        self.assertEqual(self.states(), {'notes.txt': 'not parsed',
+                                         'todo.txt': 'not parsed'})
+        self.todo('ls')
+        self.todo('pri', '2', 'C')
+        self.todo('lf', 'notes', 'piano')
+        self.assertEqual(self.states(), {'notes.txt': 'parsed, indexed',
+                                         'todo.txt': 'parsed'})
+        self.write('notes.txt', 'learn guitar\n')
+        self.assertEqual(self.states()['notes.txt'], 'changed since parsed')
+
+
+class ShellTest(TodoTestCase):
+    def test_script_deletes_without_asking(self):
+        self.todo('shell', answer='pri 3 B\ndel 2\n')
+        lines = TASKS.splitlines()
+        self.assertEqual(self.read('todo.txt').splitlines(),
+                         [lines[0], '(B) ' + lines[2]] + lines[3:])
+
+    def test_other_processes_run_between_actions(self):
+        shell = subprocess.Popen(
+            [sys.executable, '-u', TODO_PY, '-d', self.dir, 'shell'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        self.addCleanup(shell.kill)
+        shell.stdin.write('pri 6 B\nlsp\n')
+        shell.stdin.flush()
+        while 'tasks shown' not in shell.stdout.readline():
+            pass
+        # Reading isn't held up by the changes the shell didn't write
+        self.assertIn('6 of 6 tasks shown', self.todo('ls'))
+        add = subprocess.Popen(
+            [sys.executable, TODO_PY, '-d', self.dir, 'add', 'water plants'],
+            stdout=subprocess.PIPE)
+        self.addCleanup(add.kill)
+        shell.stdin.write('commit\nappend 1 today\n')
+        shell.stdin.close()
+        self.assertEqual(add.wait(60), 0)
+        self.assertEqual(shell.wait(60), 0, shell.stdout.read())
+        shell.stdout.close()
+        add.stdout.close()
+        lines = self.read('todo.txt').splitlines()
+        self.assertEqual(lines[0], '(A) call mom +family @phone today')
+        self.assertEqual(lines[5], '(B) buy milk')
+        self.assertEqual(lines[6], 'water plants')
+
+
+class ParallelParseTest(TodoTestCase):
+    def test_same_as_serial(self):
+        lines = []
+        for number in range(20000):
+            priority = '({0}) '.format('ABC'[number % 3]) \
+                if number % 4 else ''
+            done = 'x 2024-{0:02}-01 '.format(number % 12 + 1) \
+                if number % 7 == 0 else ''
+            lines.append('{0}{1}task {2} +p{3} @c{4} é\n'.format(
+                done, priority, number, number % 13, number % 5))
+        self.write('todo.txt', ''.join(lines))
+        self.set(PARALLEL_THRESHOLD=1 << 16, PARALLEL_CHUNK=1 << 15, JOBS=4)
+        parallel = todo.TaskTable(todo.TaskFile(self.path('todo.txt')))
+        todo.JOBS = 1
+        serial = todo.TaskTable(todo.TaskFile(self.path('todo.txt')))
+        self.assertEqual(parallel.rows, 20000)
+        for column in todo.TaskTable.COLUMNS:
+            self.assertEqual(getattr(parallel, column),
+                             getattr(serial, column), column)
+        self.assertEqual([parallel.names[i] for i in parallel.name_ids],
+                         [serial.names[i] for i in serial.name_ids])
+        self.assertEqual(parallel.counters(), serial.counters())
+        self.assertEqual(self.contents(parallel), self.contents(serial))
+        terms = ['task', '+p3', '@c1']
+        self.assertEqual(
+            self.contents(todo.iter_keyword_matches(parallel, terms)),
+            self.contents(todo.iter_keyword_matches(serial, terms)))
+
+
+class FederatedTest(TodoTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, text in (('a', '(B) b1\nzz a2\n(A) a3\n'),
+                           ('b', 'aa b1\n(A) a0\n(C) c1\n')):
+            os.mkdir(self.path(name))
+            self.write(os.path.join(name, 'todo.txt'), text)
+
+    def listing(self, *directories):
+        """
+        Runs ls on directories, returns its output without colors and
+        its errors
+        """
+        argv = [sys.executable, TODO_PY]
+        for directory in directories:
+            argv += ['-d', self.path(directory)]
+        result = subprocess.run(argv + ['ls'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return re.sub(r'\x1b\[[0-9;]*m', '', result.stdout), result.stderr
+
+    def test_merge_order(self):
+        output, _ = self.listing('a', 'b')
+        listed = [line for line in output.splitlines()
+                  if line.startswith(self.dir)]
+        a, b = self.path('a'), self.path('b')
+        expected = [(b, '(A) a0'), (a, '(A) a3'), (a, '(B) b1'),
+                    (b, '(C) c1'), (b, 'aa b1'), (a, 'zz a2')]
+        self.assertEqual(len(listed), len(expected))
+        for line, (directory, content) in zip(listed, expected):
+            self.assertTrue(line.startswith(directory + ': '), line)
+            self.assertTrue(line.endswith(content), line)
+        self.assertIn('6 of 6 tasks shown in 2 directories', output)
+
+    def test_missing_directories_are_skipped(self):
+        os.mkdir(self.path('empty'))
+        output, errors = self.listing('a', 'missing', 'empty', 'b')
+        self.assertIn('6 of 6 tasks shown in 2 directories', output)
+        self.assertIn('missing does not exist, skipped', errors)
+        self.assertIn('No todo.txt in ' + self.path('empty'), errors)
+
+    def test_listing_creates_no_lock(self):
+        self.write(os.path.join('b', '.todo.lock'), '')
+        self.listing('a', 'b')
+        self.assertNotIn('.todo.lock', os.listdir(self.path('a')))
+        self.assertIn('.todo.lock', os.listdir(self.path('b')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,12 +3,41 @@
 
 
 import os
+import io
 import sys
 import re
+import mmap
+import time
+import zlib
+import struct
+import bisect
+import heapq
+import itertools
 import operator
-from collections import OrderedDict
-from pathlib import Path
-from datetime import date, datetime
+import contextlib
+from array import array
+# copy, csv, json, gzip, hashlib, datetime, collections, shlex and
+# socket are imported by the functions using them, most actions never do
+
+try:
+    import fcntl
+except ImportError:  # No advisory locks on this platform
+    fcntl = None
+
+
+# Settings changed by command line options
+USE_CACHE = True  # --no-cache
+USE_JOURNAL = False  # --journal
+DEFER_WRITES = False  # todo.txt is written once all queued actions ran
+deferred_done = []  # lines archived while writes are deferred
+LIMIT = None  # --limit, most tasks a listing prints
+OFFSET = 0  # --offset, tasks a listing skips
+FORMAT = None  # --format, json, ndjson or csv records instead of text
+JOBS = None  # --jobs, processes parsing big files, one per CPU if None
+FORCE = False  # -f, actions don't ask for confirmation
+# Files kept in memory by serve, {(path, loader): (identity, data)},
+# None unless serving
+RESIDENT = None
 
 
 def check_parameters():
@@ -18,41 +47,118 @@ def check_parameters():
     return param_list
 
 
-def get_working_path():
-    if '-d' in sys.argv:
-        assigned_path = sys.argv[sys.argv.index('-d') + 1]
-        return assigned_path
-    else:
-        default_path = os.getcwd()
-        return default_path
+def get_working_paths():
+    """
+    Returns the todo directories given with -d, which can be repeated.
+    A directory can be a glob pattern, or @FILE: a manifest listing
+    directories or patterns, one per line, relative to it.
+    """
+    values = [sys.argv[i + 1] for i, word in enumerate(sys.argv[:-1])
+              if word == '-d']
+    if not values:
+        return [os.getcwd()]
+    patterns = []
+    for value in values:
+        if not value.startswith('@'):
+            patterns.append(value)
+            continue
+        base = os.path.dirname(value[1:])
+        try:
+            with open(value[1:]) as f:
+                patterns += [os.path.join(base, line.strip()) for line in f
+                             if line.strip() and line.strip()[0] != '#']
+        except OSError:
+            print("TODO: Manifest {0} can't be read.".format(value[1:]))
+            sys.exit(1)
+    paths = []
+    for pattern in patterns:
+        if not any(char in pattern for char in '*?['):
+            paths.append(pattern)
+            continue
+        import glob
+        found = sorted(path for path in glob.glob(pattern)
+                       if os.path.isdir(path))
+        if not found:
+            print("TODO: No directory matches {0}.".format(pattern))
+            sys.exit(1)
+        paths += found
+    return list(dict.fromkeys(paths))
+
+
+def pop_option(name, has_value=False):
+    """
+    Removes the option --name [VALUE] from sys.argv.
+    Returns its value (True for flags), or None if it wasn't given.
+    """
+    if name not in sys.argv:
+        return None
+    index = sys.argv.index(name)
+    sys.argv.pop(index)
+    if not has_value:
+        return True
+    if index >= len(sys.argv):
+        print("usage: todo.py {0} VALUE".format(name))
+        sys.exit(1)
+    return sys.argv.pop(index)
 
 
 def print_help():
     print(
         """
-  Usage: todo.py [-d todo_directory] action [task_number] [task_description]
+  Usage: todo.py [-d todo_directory...] [--no-cache] [--journal]
+                 [--limit N] [--offset M] [--format F] [--jobs N] [-f]
+                 action [task_number] [task_description]
+
+-d DIR     -- todo directory; a glob or @FILE, a list of them, or -d
+              repeated lists the todo.txt of all of them with ls, listpri
+--no-cache -- don't read or write the parsed files cache
+--journal  -- log changes to todo.txt in a journal instead of rewriting it
+--limit N  -- list at most N tasks
+--offset M -- skip the first M tasks of a listing
+--format F -- list tasks as json, ndjson or csv records in file order
+--jobs N   -- parse big files with N processes, one per CPU by default
+-f         -- don't ask for confirmation, as in shell scripts
 
 add       -- add TODO ITEM to todo.txt
+analytics -- completions per day, week, project or context in done.txt
 addm      -- add TODO ITEMs, one per line, to todo.txt
 addto     -- add text to file (not item)
 append    -- adds to item on line NUMBER the text TEXT
-archive   -- moves done items from todo.txt to done.txt
+archive   -- moves done items from todo.txt to done.txt, or with rotate
+             to monthly compressed segments in the done directory
 command   -- run internal commands only
+compact   -- folds the journal of changes back into todo.txt
 del       -- deletes the item on line NUMBER in todo.txt
 depri     -- remove prioritization from item
 do        -- marks item on line NUMBER as done in todo.txt
 help      -- display help
+import    -- adds the lines of a file or stdin as tasks at once
 list      -- displays all todo items containing TERM(s), sorted by priority
 listall   -- displays items including done ones containing TERM(s)
 listcon   -- list all contexts
 listfile  -- display all files in .todo directory
 listpri   -- displays all items prioritized at PRIORITY
-move      -- move item between files
+move      -- move items between files
 prepend   -- adds to the beginning of the item on line NUMBER text TEXT
-pri       -- adds or replace in NUMBER the priority PRIORITY (upper case letter)
-remdup    -- remove exact duplicates from todo.txt
+pri       -- adds or replace in NUMBER the priority PRIORITY
+             (upper case letter)
+remdup    -- remove exact duplicates from todo.txt, or near ones with
+             normalize, and the tasks in done.txt too with done
 replace   -- replace in NUMBER the TEXT
 report    -- adds the number of open and done items to report.txt
+serve     -- keeps the files in memory and runs actions sent to a socket
+shell     -- runs actions read from stdin, writing their changes at once
+stats     -- displays the number of open and done items by priority,
+             project and context
+
+TERMs of list, listall and listpri, a task has to match them all:
+WORD                    -- tasks containing WORD
++PROJECT, @CONTEXT      -- tasks in PROJECT, or CONTEXT
+pri:X, pri:X-Y          -- tasks prioritized X, or X to Y
+done:true, done:false   -- done tasks, or pending ones
+done:DATE[..DATE]       -- tasks completed on DATE (yyyy[-mm[-dd]]) or between
+re:/REGEX/, re:/REGEX/i -- tasks matching REGEX, or ignoring case
+-TERM                   -- tasks not matching TERM
 """)
 
 
@@ -65,14 +171,17 @@ def print_short_help():
   Actions:
     add|a "THING I NEED TO DO +project @context"
     addto DEST "TEXT TO ADD"
+    analytics [summary|day|week|project|context]
     append|app ITEM# "TEXT TO APPEND"
-    archive
+    archive [rotate]
     command [ACTIONS]
-    deduplicate
+    compact
+    deduplicate [normalize] [done]
     del|rm ITEM# [TERM]
     depri|dp ITEM#[, ITEM#, ITEM#, ...]
     do ITEM#[, ITEM#, ITEM#, ...]
     help [ACTION...]
+    import FILE|- [date] [dedup]
     list|ls [TERM...]
     listall|lsa [TERM...]
     listaddons
@@ -80,12 +189,15 @@ def print_short_help():
     listfile|lf [SRC [TERM...]]
     listpri|lsp [PRIORITIES] [TERM...]
     listproj|lsprj [TERM...]
-    move|mv ITEM# DEST [SRC]
+    move|mv ITEM#[,ITEM#|ITEM#-ITEM#...] DEST [SRC]
     prepend|prep ITEM# "TEXT TO PREPEND"
     pri|p ITEM# PRIORITY
     replace ITEM# "UPDATED TODO"
     report
+    serve
+    shell
     shorthelp
+    stats
     """)
 
 
@@ -93,14 +205,18 @@ class Task:
     """
     Represents a task
     """
+    __slots__ = ('num', 'content', 'priority', 'projects', 'contexts',
+                 'done', 'tags')
+
     def __init__(self, number, content, priority=None,
-                 projects=None, contexts=None, done=None):
+                 projects=None, contexts=None, done=None, tags=None):
         self.num = number  # int
         self.content = content  # string
         self.priority = priority  # string
         self.projects = projects  # list
         self.contexts = contexts  # list
-        self.done = done
+        self.done = done  # completion date string
+        self.tags = tags  # dict
         if not self.priority:
             self.priority = ''
 
@@ -116,15 +232,14 @@ class Task:
         """
         Marks a task as done adding "x yyyy-mm-dd "
         """
-        date_command = os.popen("date '+%F'")
-        date = str(date_command.read())
-        date = date.replace('\n', ' ')
+        from datetime import date
+        today = date.today().isoformat() + ' '
         if self.priority != '':
             self.deprioritize()
-            pr = 'x ' + date
+            pr = 'x ' + today
             self.content = pr + self.content
         else:
-            self.content = 'x ' + date + self.content
+            self.content = 'x ' + today + self.content
 
 
 class colors:
@@ -159,123 +274,3013 @@ def parse_todo_file(file_name):
     """
     Parse a tasks file
     """
-    task_list = []
-    task_num = 0
+    return TaskTable(TaskFile(file_name))
 
-    with open(file_name, 'r') as f:
-        while True:
-            line = f.readline()
-            if not line:
-                break
-            else:
-                task_num += 1
-                task = parse_task(line, task_num)
-            task_list.append(task)
-    return task_list
+
+def is_date(text):
+    """
+    Checks if text is a yyyy-mm-dd date
+    """
+    return (len(text) == 10 and text[4] == '-' and text[7] == '-' and
+            text[:4].isdigit() and text[5:7].isdigit() and text[8:].isdigit())
+
+
+def line_prefix(line):
+    """
+    Returns the priority "(A) " or the completion date "x yyyy-mm-dd "
+    a task line starts with, as (priority, completed)
+    """
+    if line[:1] == '(' and line[2:3] == ')' and 'A' <= line[1:2] <= 'Z':
+        return line[1], None
+    if line[:2] == 'x ' and is_date(line[2:12]) and line[12:13].isspace():
+        return '', line[2:12]
+    return '', None
+
+
+def tokenize_line(line):
+    """
+    Splits a task line into its parts walking it only once.
+    Returns (priority, completed, projects, contexts, tags).
+    """
+    priority, completed = line_prefix(line)
+    projects = []
+    contexts = []
+    tags = {}
+    for word in line.split():
+        first = word[0]
+        if first == '+' and len(word) > 1:
+            projects.append(word)
+        elif first == '@' and len(word) > 1:
+            contexts.append(word)
+        elif ':' in word:
+            # key:value, neither side empty or holding another colon
+            key, _, value = word.partition(':')
+            if key and value and ':' not in value and value[0] != '/':
+                tags[key] = value
+
+    return priority, completed, projects, contexts, tags
+
+
+def index_words(line):
+    """
+    Returns the words a line is indexed under: its words, then its
+    completion date as 'x DATE' and its creation date as ' DATE'.
+    Words have no spaces, so these can't be words, and a search finds
+    no more in them than in the line.
+    """
+    words = line.split()
+    priority, completed = line_prefix(line)
+    # The creation date comes after the completion date or priority
+    position = 2 if completed else 1 if priority else 0
+    tokens = words[:]
+    if completed:
+        tokens.append('x ' + completed)
+    if position < len(words) and is_date(words[position]):
+        tokens.append(' ' + words[position])
+    return tokens
+
+
+def count_row(name_counts, priority_counts, priority, done, name_ids, step):
+    """
+    Adds step to the open or done counts of the names and the
+    priority of a row. A name repeated in the row counts once.
+    """
+    state = 1 if done else 0
+    priority_counts[2 * priority + state] += step
+    if len(name_ids) > 1:
+        name_ids = set(name_ids)
+    for name_id in name_ids:
+        name_counts[2 * name_id + state] += step
 
 
 def parse_task(line, number):
     """
     Parse a line containing a task
     """
-    # Check for priority (Capital letters)
-    pr_pattern = re.compile(r"^\(([A-Z])\)")  # Matches "A"
-    priority = re.match(pr_pattern, line)
+    priority, completed, projects, contexts, tags = tokenize_line(line)
+    return Task(number, line, priority, projects, contexts, completed, tags)
+
+
+class TaskFile:
+    """
+    Memory-mapped tasks file.
+    Line offsets are recorded once and a line is only parsed into
+    a Task when it is accessed.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            if self.stat.st_size > 0:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buffer = b''
+        self._starts = None
+
+    @property
+    def starts(self):
+        """
+        Offsets of the start of every line, plus the end of the file
+        """
+        if self._starts is None:
+            buf = self.buffer
+            starts = array('Q', [0])
+            pos = buf.find(b'\n')
+            while pos >= 0:
+                starts.append(pos + 1)
+                pos = buf.find(b'\n', pos + 1)
+            if starts[-1] != len(buf):
+                starts.append(len(buf))  # Last line without a newline
+            self._starts = starts
+        return self._starts
+
+    def __len__(self):
+        if self._starts is not None:
+            return len(self._starts) - 1
+        buf = self.buffer
+        count = count_newlines(buf, 0, len(buf))
+        if buf[-1:] not in (b'', b'\n'):
+            count += 1
+        return count
+
+    def line(self, index):
+        """
+        Returns the text of the line at index
+        """
+        starts = self.starts
+        return decode_line(self.buffer[starts[index]:starts[index + 1]])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return parse_task(self.line(index), index + 1)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def unchanged(self):
+        """
+        Returns True if the file on disk is still the one mapped
+        """
+        try:
+            stat = os.stat(self.file_name)
+        except OSError:
+            return False
+        old = self.stat
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns) == (
+            old.st_ino, old.st_size, old.st_mtime_ns)
+
+
+class TaskTable:
+    """
+    Columnar store for the tasks of a file.
+    Priorities are kept in a byte array, done flags in a bitmap,
+    content as offsets into the file buffer and projects/contexts as
+    interned ids. It behaves like a list of tasks: items are TaskView
+    objects reading (and writing) their row of the table.
+    Open and done counts of the rows are kept per name and priority.
+    """
+    COLUMNS = ('starts', 'priorities', 'done', 'name_starts', 'name_ids')
+    LINE_COST = 64  # index lookups it takes to check a line for a term
+
+    def __init__(self, task_file, columns=None, names=None, words=None,
+                 counts=None):
+        self.file = task_file
+        self.buffer = task_file.buffer
+        self.starts = array('Q', [0])  # line offsets, plus the end
+        self.priorities = bytearray()  # ord() of the priority or 0
+        self.done = bytearray()  # one bit per row
+        self.name_starts = array('I', [0])  # rows' slices of name_ids
+        self.name_ids = array('I')
+        self.names = []  # interned +projects and @contexts
+        self.name_index = {}
+        self.name_counts = array('q')  # open, done count of each name
+        self.priority_counts = array('q', bytes(8 * 512))  # same by ord()
+        self.edits = {}  # row -> Task that replaced the parsed line
+        self.rows = 0  # number of rows parsed from the file
+        self.words = words  # word -> rows having it, built on first search
+        self.indexed = 0  # rows in the index
+        if columns is None:
+            self.parse_rows(0)
+        else:
+            # Columns loaded from the cache
+            for name, column in zip(self.COLUMNS, columns):
+                setattr(self, name, column)
+            self.names = names
+            self.name_index = {name: i for i, name in enumerate(names)}
+            self.rows = len(self.starts) - 1
+            if words is not None:
+                self.indexed = self.rows
+            if counts is None:
+                self.name_counts = array('q', bytes(16 * len(names)))
+                self.count_rows(0, self.rows, 1)
+            else:
+                self.name_counts, self.priority_counts = counts
+        self.order = array('I', range(self.rows))  # rows in list order
+        self.first_change = None  # first position that differs from the file
+        self.reordered = False  # rows were removed, added or moved
+        self.patchable = True  # rows still match the offsets of the file
+        self.numbers = None  # row -> number, once rows were renumbered
+        self.numbered = None  # or the order they were numbered in, sorted
+        self.ascending = True  # rows are in file order, then appended ones
+        self.touched = set()  # rows changed since loading
+        self.removed = []  # rows removed since loading
+        self.added = []  # rows appended since loading
+        self.journalable = True  # changes can be written as a journal
+        self.batches = []  # journal records of changes made before renumbering
+        self.dropped = set()  # rows of the file and index out of the list
+        self.listed = None  # rows in listing order, kept while serving
+        task_file._starts = self.starts
+
+    def parse_rows(self, offset, end=None):
+        """
+        Tokenizes the file from offset on, up to end, and appends the
+        rows. Big files are tokenized in chunks by processes.
+        """
+        if end is None and isinstance(self.buffer, mmap.mmap):
+            bounds = chunk_bounds(self.buffer, offset, len(self.buffer))
+            for part in map_chunks(self.file, bounds, parse_chunk):
+                self.merge_rows(*part)
+            offset = self.starts[-1]  # The rest if a process failed
+        for start, raw in iter_raw_lines(self.buffer, offset, end=end):
+            priority, completed, projects, contexts, tags = tokenize_line(
+                decode_line(raw))
+            self.add_row(start + len(raw), ord(priority) if priority else 0,
+                         completed, self.intern(projects + contexts))
+
+    def merge_rows(self, rows, columns, names, counts):
+        """
+        Appends rows tokenized by parse_chunk: their columns, whose
+        name ids index names, and their counts
+        """
+        starts, priorities, done, name_starts, name_ids = columns
+        name_counts, priority_counts = counts
+        ids = self.intern(names)
+        base = len(self.name_ids)
+        self.name_ids.extend(map(ids.__getitem__, name_ids))
+        self.name_starts.extend(map(base.__add__, name_starts))
+        for i, name_id in enumerate(ids):
+            self.name_counts[2 * name_id] += name_counts[2 * i]
+            self.name_counts[2 * name_id + 1] += name_counts[2 * i + 1]
+        for i, count in enumerate(priority_counts):
+            if count:
+                self.priority_counts[i] += count
+        self.priorities.extend(priorities)
+        self.starts.extend(starts)
+        shift = self.rows & 7
+        if shift:
+            # The bits go on from the middle of the last byte
+            bits = int.from_bytes(done, 'little') << shift | self.done.pop()
+            done = bits.to_bytes((shift + rows + 7) // 8, 'little')
+        self.done.extend(done)
+        self.rows += rows
+
+    def add_row(self, end, priority, done, name_ids):
+        """
+        Appends a row ending at offset end to the columns
+        """
+        row = self.rows
+        self.priorities.append(priority)
+        if row & 7 == 0:
+            self.done.append(0)
+        if done:
+            self.done[row >> 3] |= 1 << (row & 7)
+        count_row(self.name_counts, self.priority_counts, priority, done,
+                  name_ids, 1)
+        self.name_ids.extend(name_ids)
+        self.name_starts.append(len(self.name_ids))
+        self.starts.append(end)
+        self.rows += 1
+
+    def rebased(self, task_file, position):
+        """
+        Returns the table of task_file, which was just written from
+        this table. Columns of the rows before position are copied,
+        later rows are moved without parsing them again.
+        """
+        table = TaskTable(task_file, self.prefix_columns(position),
+                          list(self.names),
+                          counts=self.counts_before(position))
+        starts, priorities, done = self.starts, self.priorities, self.done
+        name_starts, name_ids = self.name_starts, self.name_ids
+        moves = array('l', [-1]) * self.rows  # row -> row in the new table
+        edited = []
+        for row in self.order[position:]:
+            edit = self.edits.get(row)
+            if edit is None:
+                moves[row] = table.rows
+                table.add_row(
+                    table.starts[-1] + starts[row + 1] - starts[row],
+                    priorities[row], done[row >> 3] & 1 << (row & 7),
+                    name_ids[name_starts[row]:name_starts[row + 1]])
+            else:
+                edited.append((table.rows, edit.content))
+                table.add_row(
+                    table.starts[-1] + len(edit.content.encode('utf-8')),
+                    ord(edit.priority) if edit.priority else 0, edit.done,
+                    table.intern(edit.projects + edit.contexts))
+        table.order = array('I', range(table.rows))
+        if self.words is not None:
+            table.words = self.moved_index(position, moves, edited)
+            table.indexed = table.rows
+        return table
+
+    def word_index(self):
+        """
+        Returns the index of the words of the parsed rows, indexing
+        the rows it lacks first
+        """
+        if self.words is None:
+            self.words = {}
+        index = self.words
+        row = self.indexed
+        if row < self.rows:
+            for _, raw in iter_raw_lines(self.buffer, self.starts[row]):
+                if row == self.rows:
+                    break
+                for word in index_words(decode_line(raw)):
+                    rows = index.get(word)
+                    if rows is None:
+                        index[word] = array('I', (row,))
+                    elif rows[-1] != row:  # Repeated words count once
+                        rows.append(row)
+                row += 1
+            self.indexed = row
+        return index
+
+    def moved_index(self, position, moves, edited):
+        """
+        Returns the index of a table that has the rows of this one
+        before position, and from there on each row at moves[row]
+        (-1 if it's gone) and the (row, content) pairs of edited.
+        """
+        index = {}
+        for word, rows in self.word_index().items():
+            split = bisect.bisect_left(rows, position)
+            kept = rows[:split]
+            if split < len(rows):
+                kept.extend(sorted(row for row in map(moves.__getitem__,
+                                                      rows[split:])
+                                   if row >= 0))
+            if kept:
+                index[word] = kept
+        for row, content in edited:
+            for word in set(index_words(content)):
+                rows = index.get(word)
+                if rows is None:
+                    index[word] = array('I', (row,))
+                else:
+                    rows.insert(bisect.bisect_left(rows, row), row)
+        return index
+
+    def unindex(self, row, line):
+        """
+        Removes row from the index of the words of line
+        """
+        for word in set(index_words(line)):
+            rows = self.words.get(word)
+            if rows is not None and row in rows:
+                rows.remove(row)
+                if not rows:
+                    del self.words[word]
+
+    def intern(self, names):
+        """
+        Returns the ids of names, adding the new ones
+        """
+        ids = []
+        for name in names:
+            name_id = self.name_index.get(name)
+            if name_id is None:
+                name_id = self.name_index[name] = len(self.names)
+                self.names.append(name)
+                self.name_counts.extend((0, 0))
+            ids.append(name_id)
+        return ids
+
+    def count_rows(self, first, last, step, counts=None):
+        """
+        Adds step to the counts of the table, or to the counts given
+        as (name counts, priority counts), for each of the rows first
+        to last
+        """
+        name_counts, priority_counts = counts or (self.name_counts,
+                                                  self.priority_counts)
+        name_starts, name_ids = self.name_starts, self.name_ids
+        priorities, done = self.priorities, self.done
+        for row in range(first, last):
+            count_row(name_counts, priority_counts, priorities[row],
+                      done[row >> 3] & 1 << (row & 7),
+                      name_ids[name_starts[row]:name_starts[row + 1]], step)
+
+    def counts_before(self, position):
+        """
+        Returns copies of the counts of the rows before position
+        """
+        counts = (array('q', self.name_counts),
+                  array('q', self.priority_counts))
+        self.count_rows(position, self.rows, -1, counts)
+        return counts
+
+    def counters(self):
+        """
+        Returns the open and done counts of the tasks in the list as
+        {key: (open, done)}, keyed by +project, @context, pri:X, and ''
+        for all the tasks. Only the rows changed since parsing are
+        looked at, on top of the counts of the parsed rows.
+        """
+        edits, dropped = self.edits, self.dropped
+        changed = [(row, self.intern(task.projects + task.contexts))
+                   for row, task in edits.items() if row not in dropped]
+        name_counts = array('q', self.name_counts)
+        priority_counts = array('q', self.priority_counts)
+        for row in dropped.union(edits):
+            if row < self.rows:
+                self.count_rows(row, row + 1, -1,
+                                (name_counts, priority_counts))
+        for row, ids in changed:
+            task = edits[row]
+            count_row(name_counts, priority_counts,
+                      ord(task.priority) if task.priority else 0, task.done,
+                      ids, 1)
+
+        counts = {'': (sum(priority_counts[0::2]),
+                       sum(priority_counts[1::2]))}
+        for code in range(ord('A'), ord('Z') + 1):
+            if priority_counts[2 * code] or priority_counts[2 * code + 1]:
+                counts['pri:' + chr(code)] = (priority_counts[2 * code],
+                                              priority_counts[2 * code + 1])
+        for name_id, name in enumerate(self.names):
+            if name_counts[2 * name_id] or name_counts[2 * name_id + 1]:
+                counts[name] = (name_counts[2 * name_id],
+                                name_counts[2 * name_id + 1])
+        return counts
+
+    def store(self, row, task):
+        """
+        Overwrites the columns of row with the parts of task.
+        Returns False if task has a different number of names.
+        """
+        ids = self.intern(task.projects + task.contexts)
+        start, end = self.name_starts[row], self.name_starts[row + 1]
+        if len(ids) != end - start:
+            return False
+        self.count_rows(row, row + 1, -1)
+        count_row(self.name_counts, self.priority_counts,
+                  ord(task.priority) if task.priority else 0, task.done,
+                  ids, 1)
+        self.name_ids[start:end] = array('I', ids)
+        self.priorities[row] = ord(task.priority) if task.priority else 0
+        if task.done:
+            self.done[row >> 3] |= 1 << (row & 7)
+        else:
+            self.done[row >> 3] &= ~(1 << (row & 7))
+        return True
+
+    def parse_tail(self):
+        """
+        Parses the lines added to the file after the parsed rows
+        """
+        end = self.starts[-1]
+        if self.rows and self.buffer[end - 1:end] != b'\n':
+            # The last line was incomplete, parse it again
+            self.rows -= 1
+            row = self.rows
+            if self.indexed > row:
+                self.unindex(row, decode_line(
+                    self.buffer[self.starts[row]:end]))
+                self.indexed = row
+            self.count_rows(row, row + 1, -1)
+            self.starts.pop()
+            self.priorities.pop()
+            self.done[row >> 3] &= ~(1 << (row & 7))
+            if row & 7 == 0:
+                self.done.pop()
+            self.name_starts.pop()
+            del self.name_ids[self.name_starts[-1]:]
+        self.parse_rows(self.starts[-1])
+        # The list is the file again, no row is out of it
+        self.order = array('I', range(self.rows))
+        self.dropped = set()
+        self.listed = None
+
+    def line(self, row):
+        """
+        Returns the content of row
+        """
+        edit = self.edits.get(row)
+        if edit is not None:
+            return edit.content
+        return decode_line(self.buffer[self.starts[row]:self.starts[row + 1]])
+
+    def number(self, row):
+        numbered = self.numbered
+        if numbered is not None and numbered and row <= numbered[-1]:
+            position = bisect.bisect_left(numbered, row)
+            return position + 1 if numbered[position] == row else 0
+        if self.numbers is not None and row < len(self.numbers):
+            return self.numbers[row]
+        if row < self.rows:
+            return row + 1
+        return self.edits[row].num
+
+    def renumber(self):
+        """
+        Numbers the rows by their current position. While the rows are
+        in ascending order, the order is kept and bisected instead.
+        """
+        if self.ascending:
+            self.numbered, self.numbers = array('I', self.order), None
+            return
+        self.numbered = None
+        self.numbers = array('I', bytes(4 * (max(self.order, default=0) + 1)))
+        for position, row in enumerate(self.order, 1):
+            self.numbers[row] = position
+
+    def position(self, row):
+        """
+        Returns the position of row in the list
+        """
+        if self.ascending:
+            position = bisect.bisect_left(self.order, row)
+            if position < len(self.order) and self.order[position] == row:
+                return position
+            raise ValueError("row is not in the list")
+        return self.order.index(row)
+
+    def with_number(self, number):
+        """
+        Yields the task numbered number, looked up at its position
+        unless the list changed since it was numbered
+        """
+        if 0 < number <= len(self.order):
+            row = self.order[number - 1]
+            if self.number(row) == number:
+                yield TaskView(self, row)
+                return
+        for row in self.order:
+            if self.number(row) == number:
+                yield TaskView(self, row)
+                return
+
+    def priority(self, row):
+        edit = self.edits.get(row)
+        if edit is not None:
+            return edit.priority
+        code = self.priorities[row]
+        return chr(code) if code else ''
+
+    def is_done(self, row):
+        edit = self.edits.get(row)
+        if edit is not None:
+            return bool(edit.done)
+        return bool(self.done[row >> 3] & 1 << (row & 7))
+
+    def row_names(self, row, sigil):
+        """
+        Returns the projects (sigil '+') or contexts (sigil '@') of row
+        """
+        edit = self.edits.get(row)
+        if edit is not None:
+            return edit.projects if sigil == '+' else edit.contexts
+        names = self.names
+        ids = self.name_ids[self.name_starts[row]:self.name_starts[row + 1]]
+        return [names[i] for i in ids if names[i][0] == sigil]
+
+    def changed(self, position, reordered=False):
+        """
+        Records that the rows from position on differ from the file
+        """
+        if position < 0:
+            position += len(self.order)
+        position = min(max(position, 0), len(self.order))
+        if self.first_change is None or position < self.first_change:
+            self.first_change = position
+        self.reordered = self.reordered or reordered
+
+    def edit(self, row):
+        """
+        Returns the Task holding the changes of row
+        """
+        edit = self.edits.get(row)
+        if edit is None:
+            edit = self.edits[row] = parse_task(self.line(row),
+                                                self.number(row))
+        self.changed(self.position(row))
+        self.touched.add(row)
+        return edit
+
+    def set_content(self, row, content):
+        self.edits[row] = parse_task(content, self.number(row))
+        self.changed(self.position(row))
+        self.touched.add(row)
+
+    def add(self, task):
+        """
+        Stores a task that isn't a row of the file, returns its row
+        """
+        row = max(self.rows, max(self.edits, default=0) + 1)
+        self.edits[row] = task
+        return row
+
+    def priority_buckets(self):
+        """
+        Returns the rows in list order bucketed by priority,
+        as a dict of lists
+        """
+        buckets = {}
+        priorities, edits = self.priorities, self.edits
+        letters = [chr(code) if code else '' for code in range(256)]
+        for row in self.order:
+            if row in edits:
+                priority = edits[row].priority or ''
+            else:
+                priority = letters[priorities[row]]
+            bucket = buckets.get(priority)
+            if bucket is None:
+                bucket = buckets[priority] = []
+            bucket.append(row)
+        return buckets
+
+    def listing(self):
+        """
+        Returns all the rows of an unchanged table in listing order,
+        sorted again only once lines were appended
+        """
+        if self.listed is None or len(self.listed) != self.rows:
+            buckets = self.priority_buckets()
+            self.listed = array('I', [
+                row for priority in sorted(buckets, key=priority_order)
+                for row in sorted(buckets[priority], key=self.line)])
+        return self.listed
+
+    def prioritized(self, first='A', last='Z'):
+        """
+        Returns the tasks with a priority between first and last
+        """
+        low, high = ord(first), ord(last)
+        priorities, rows, edits = self.priorities, self.rows, self.edits
+        selected = []
+        for row in self.order:
+            if row in edits:
+                code = ord(edits[row].priority or '\0')
+            else:
+                code = priorities[row]
+            if low <= code <= high:
+                selected.append(TaskView(self, row))
+        return selected
+
+    def postings(self, term):
+        """
+        Returns the lists of rows of the words containing term,
+        or None if the index can't tell because term spans words
+        """
+        if not term or any(char.isspace() for char in term):
+            return None
+        return [rows for word, rows in self.word_index().items()
+                if term in word]
+
+    def match(self, query):
+        """
+        Yields the tasks matching a Query, in list order.
+        Words and names are looked up in the index, the rarest first.
+        The other terms, the ones much more common than the rows found
+        so far and the changed rows are checked row by row.
+        """
+        if self.words is None or self.indexed < self.rows:
+            self.word_index()
+            if USE_CACHE and self.file.unchanged():
+                write_cache(self)  # Keep the index for the next searches
+        check_words, check_names = [], []  # terms left for row_matches
+        check_dates = []
+        lookups = []
+        for term, negated in query.words:
+            lists = self.postings(term)
+            if lists is None:
+                check_words.append((term, negated))
+            else:
+                lookups.append((negated, sum(map(len, lists)), term, lists,
+                                check_words))
+        for name, negated in query.names:
+            rows = self.words.get(name, array('I'))
+            lookups.append((negated, len(rows), name, [rows], check_names))
+        for first, last, negated in query.completed:
+            lists = [rows for word, rows in self.words.items()
+                     if word[:2] == 'x ' and
+                     date_in_range(word[2:], first, last)]
+            lookups.append((negated, sum(map(len, lists)), (first, last),
+                            lists, check_dates))
+        found, excluded = combine_postings(lookups, self.LINE_COST)
+
+        edits = self.edits
+        if found is None:
+            candidates = self.order
+        elif self.reordered and not self.ascending:
+            candidates = [row for row in self.order
+                          if row in found or row in edits]
+        else:
+            # In file order the rows left are the ones not dropped
+            candidates = sorted(found.union(edits).difference(self.dropped))
+        for row in candidates:
+            if row in edits:
+                task = TaskView(self, row)
+                if query.matches(task):
+                    yield task
+            elif row not in excluded and self.row_matches(
+                    row, query, check_words, check_names, check_dates):
+                yield TaskView(self, row)
+
+    def row_matches(self, row, query, words, names, dates):
+        """
+        Checks a parsed row against the priorities and done states of
+        query, the words, names and completion dates given, then the
+        regexes of query.
+        The line is only decoded when the other terms need it.
+        """
+        priority = chr(self.priorities[row])
+        for low, high, negated in query.priorities:
+            if (low <= priority <= high) == negated:
+                return False
+        done = bool(self.done[row >> 3] & 1 << (row & 7))
+        for state in query.done:
+            if done != state:
+                return False
+        if dates:
+            date = self.line(row)[2:12] if done else None
+            for (first, last), negated in dates:
+                if (done and date_in_range(date, first, last)) == negated:
+                    return False
+        if names:
+            start, end = self.name_starts[row], self.name_starts[row + 1]
+            ids = self.name_ids[start:end]
+            for name, negated in names:
+                if (self.name_index.get(name, -1) in ids) == negated:
+                    return False
+        if words or query.regexes:
+            content = self.line(row)
+            for term, negated in words:
+                if (term in content) == negated:
+                    return False
+            for regex, negated in query.regexes:
+                if bool(regex.search(content)) == negated:
+                    return False
+        return True
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        for row in self.order:
+            yield TaskView(self, row)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [TaskView(self, row) for row in self.order[index]]
+        return TaskView(self, self.order[index])
+
+    def __setitem__(self, index, task):
+        self.edits[self.order[index]] = task
+        self.changed(index)
+        self.touched.add(self.order[index])
+
+    def row_of(self, task):
+        if isinstance(task, TaskView) and task.table is self:
+            return task.row
+        return self.add(task)
+
+    def index(self, task):
+        if not isinstance(task, TaskView) or task.table is not self:
+            raise ValueError("task is not in the table")
+        return self.position(task.row)
+
+    def remove(self, task):
+        self.pop(self.index(task))
+
+    def pop(self, index=-1):
+        task = TaskView(self, self.order[index])
+        del self.order[index]
+        self.changed(index, reordered=True)
+        self.removed.append(task.row)
+        self.dropped.add(task.row)
+        return task
+
+    def insert(self, index, task):
+        moved = isinstance(task, TaskView) and task.table is self
+        row = self.row_of(task)
+        self.dropped.discard(row)
+        if moved or index < len(self.order):
+            self.journalable = False  # Not an append
+            self.ascending = False
+        else:
+            self.added.append(row)
+        self.order.insert(index, row)
+        self.changed(index, reordered=True)
+
+    def append(self, task):
+        self.insert(len(self.order), task)
+
+    def discard(self, rows):
+        """
+        Takes a set of rows out of the list in one pass
+        """
+        order = self.order
+        first = next((i for i, row in enumerate(order) if row in rows),
+                     len(order))
+        self.order = array('I', [row for row in order if row not in rows])
+        self.changed(first, reordered=True)
+        removed = [row for row in order[first:] if row in rows]
+        self.removed += removed
+        self.dropped.update(removed)
+
+    def snapshot(self):
+        """
+        Returns the state of the table, to undo later changes
+        """
+        import copy
+        return (array('I', self.order),
+                {row: copy.copy(task) for row, task in self.edits.items()},
+                set(self.touched), list(self.removed), list(self.added),
+                self.first_change, self.reordered, self.journalable,
+                self.numbers, list(self.batches), set(self.dropped),
+                self.numbered, self.ascending)
+
+    def restore(self, state):
+        (self.order, self.edits, self.touched, self.removed, self.added,
+         self.first_change, self.reordered, self.journalable,
+         self.numbers, self.batches, self.dropped, self.numbered,
+         self.ascending) = state
+
+    def written(self, journaled=False):
+        """
+        Records that the changes were saved, to the journal if journaled
+        """
+        self.touched, self.removed, self.added = set(), [], []
+        self.journalable = True
+        self.batches = []
+        self.patchable = False
+        self.first_change = 0 if journaled else None
+
+    def encode(self, position=0):
+        """
+        Returns the bytes of the tasks from position on.
+        Unchanged rows are copied from the file without decoding them.
+        """
+        buf, starts, rows, edits = self.buffer, self.starts, self.rows, \
+            self.edits
+        chunks = []
+        for row in self.order[position:]:
+            if row in edits:
+                chunks.append(edits[row].content.encode('utf-8'))
+            else:
+                chunks.append(buf[starts[row]:starts[row + 1]])
+        return b''.join(chunks)
+
+    def prefix_columns(self, position):
+        """
+        Returns copies of the columns of the rows before position
+        """
+        done = self.done[:(position + 7) // 8]
+        if position & 7:
+            done[-1] &= (1 << (position & 7)) - 1
+        return (self.starts[:position + 1], self.priorities[:position],
+                done, self.name_starts[:position + 1],
+                self.name_ids[:self.name_starts[position]])
+
+
+class TaskView(Task):
+    """
+    Task stored in a row of a TaskTable
+    """
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def num(self):
+        return self.table.number(self.row)
+
+    @property
+    def content(self):
+        return self.table.line(self.row)
+
+    @content.setter
+    def content(self, value):
+        self.table.set_content(self.row, value)
+
+    @property
+    def priority(self):
+        return self.table.priority(self.row)
+
+    @priority.setter
+    def priority(self, value):
+        # The line is the task: its priority stays the one it starts
+        # with, the callers change the line as well
+        edit = self.table.edit(self.row)
+        edit.priority = line_prefix(edit.content)[0]
+
+    @property
+    def projects(self):
+        return self.table.row_names(self.row, '+')
+
+    @property
+    def contexts(self):
+        return self.table.row_names(self.row, '@')
+
+    @property
+    def done(self):
+        if self.table.is_done(self.row):
+            return self.content[2:12]
+        return None
+
+    @property
+    def tags(self):
+        return tokenize_line(self.content)[4]
+
+
+class SplicedBuffer:
+    """
+    Former bytes of a file whose tail was rewritten in place.
+    Reads before offset come from the map of the file,
+    later ones from a copy of the old tail.
+    """
+    def __init__(self, buffer, offset, tail):
+        self.buffer = buffer
+        self.offset = offset
+        self.tail = tail
+
+    def __len__(self):
+        return self.offset + len(self.tail)
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(len(self))
+        if stop <= self.offset:
+            return self.buffer[start:stop]
+        if start >= self.offset:
+            return self.tail[start - self.offset:stop - self.offset]
+        return self.buffer[start:self.offset] + self.tail[:stop - self.offset]
+
+
+def iter_raw_lines(buf, start=0, chunk=1 << 22, end=None):
+    """
+    Yields (offset, line) for the lines of buf from start on, up to
+    the end of a line at end, reading about a chunk of bytes at a time.
+    """
+    end = len(buf) if end is None else end
+    while start < end:
+        stop = buf.find(b'\n', min(start + chunk, end) - 1, end)
+        stop = end if stop < 0 else stop + 1
+        lines = buf[start:stop].split(b'\n')
+        last = lines.pop()  # empty unless the file lacks a final newline
+        for line in lines:
+            line += b'\n'
+            yield start, line
+            start += len(line)
+        if last:
+            yield start, last
+        start = stop
+
+
+# Bytes left to parse from which processes tokenize them in chunks
+PARALLEL_THRESHOLD = 1 << 26
+PARALLEL_CHUNK = 1 << 24
+
+
+def chunk_bounds(buf, start, end):
+    """
+    Returns the offsets splitting buf[start:end] into chunks of about
+    PARALLEL_CHUNK bytes of whole lines, plus end. Only [start, end]
+    if there are less than PARALLEL_THRESHOLD bytes or one job.
+    """
+    if end - start < PARALLEL_THRESHOLD or parallel_jobs() < 2:
+        return [start, end]
+    bounds = [start]
+    while bounds[-1] < end:
+        stop = buf.find(b'\n', min(bounds[-1] + PARALLEL_CHUNK, end) - 1,
+                        end)
+        bounds.append(end if stop < 0 else stop + 1)
+    return bounds
+
+
+def parallel_jobs():
+    """
+    Returns how many processes parse big files
+    """
+    return JOBS or os.cpu_count() or 1
+
+
+def map_chunks(task_file, bounds, function, *arguments):
+    """
+    Yields, in order, function(file_name, identity, start, end, *args)
+    run in processes for the chunks between bounds, with the
+    arguments of each chunk in arguments. Nothing if there is one
+    chunk; stops at the first None, returned by a process that mapped
+    another file, or if the processes can't run.
+    """
+    if len(bounds) < 3:
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    stat = task_file.stat
+    identity = stat.st_ino, stat.st_size, stat.st_mtime_ns
+    count = len(bounds) - 1
+    try:
+        with ProcessPoolExecutor(min(parallel_jobs(), count)) as pool:
+            results = pool.map(function, [task_file.file_name] * count,
+                               [identity] * count, bounds[:-1], bounds[1:],
+                               *arguments)
+            for result in results:
+                if result is None:
+                    pool.shutdown(cancel_futures=True)
+                    return
+                yield result
+    except (OSError, BrokenProcessPool):
+        return
+
+
+def mapped_chunk_file(file_name, identity):
+    """
+    Returns the TaskFile of file_name in a process of map_chunks, or
+    None if it isn't the file the parent mapped
+    """
+    try:
+        task_file = TaskFile(file_name)
+    except OSError:
+        return None
+    stat = task_file.stat
+    if (stat.st_ino, stat.st_size, stat.st_mtime_ns) != identity:
+        return None
+    return task_file
+
+
+def parse_chunk(file_name, identity, start, end):
+    """
+    Tokenizes the lines of a chunk of a tasks file in a process.
+    Returns what TaskTable.merge_rows appends.
+    """
+    task_file = mapped_chunk_file(file_name, identity)
+    if task_file is None:
+        return None
+    columns = (array('Q', [start]), bytearray(), bytearray(),
+               array('I', [0]), array('I'))
+    table = TaskTable(task_file, columns, [],
+                      counts=(array('q'), array('q', bytes(8 * 512))))
+    table.parse_rows(start, end)
+    return (table.rows, (table.starts[1:], table.priorities, table.done,
+                         table.name_starts[1:], table.name_ids),
+            table.names, (table.name_counts, table.priority_counts))
+
+
+def index_chunk(file_name, identity, start, end, first_row):
+    """
+    Indexes the lines of a chunk of an archive in a process
+    """
+    task_file = mapped_chunk_file(file_name, identity)
+    if task_file is None:
+        return None
+    return index_lines(task_file.buffer, start, end, first_row)
+
+
+def cache_path(file_name):
+    """
+    Returns the path of the cache of a tasks file
+    """
+    directory, name = os.path.split(file_name)
+    return os.path.join(directory, '.' + name + '.cache')
+
+
+CACHE_MAGIC = b'TODOPYC8' + sys.byteorder[0].encode()
+
+
+CACHE_HEADER = '<QQQI'
+
+
+def prefix_checksum(buf, size, block=1 << 22):
+    """
+    Checksum of all of buf[:size], read a block at a time.
+    An edit anywhere before size changes it.
+    """
+    try:
+        view = memoryview(buf)  # Blocks of a map aren't copied
+    except TypeError:
+        view = buf  # SplicedBuffer
+    crc = 0
+    for start in range(0, size, block):
+        crc = zlib.crc32(view[start:min(start + block, size)], crc)
+    if isinstance(view, memoryview):
+        view.release()
+    return crc
+
+
+def write_cache(table):
+    """
+    Saves the parsed columns of a TaskTable next to its file.
+    The cache is tagged with the file's mtime, size and inode,
+    and a checksum of the parsed bytes to detect appends.
+    The counts of the names and priorities are saved with them, and
+    the index of words once it was built.
+    """
+    stat = table.file.stat
+    size = table.starts[-1]
+    sections = [getattr(table, name) for name in TaskTable.COLUMNS]
+    sections.append('\n'.join(table.names).encode('utf-8'))
+    sections += [table.name_counts, table.priority_counts]
+    if table.words is None:
+        sections += [b'', b'', b'']
+    else:
+        index = table.word_index()
+        offsets = array('Q', [0])
+        for rows in index.values():
+            offsets.append(offsets[-1] + len(rows))
+        sections.append('\n'.join(index).encode('utf-8'))
+        sections.append(offsets)
+        sections.append(b''.join(rows.tobytes() for rows in index.values()))
+    payload = [struct.pack(CACHE_HEADER, stat.st_mtime_ns, size, stat.st_ino,
+                           prefix_checksum(table.buffer, size))]
+    for section in sections:
+        data = bytes(section)
+        payload.append(struct.pack('<Q', len(data)))
+        payload.append(data)
+    payload = b''.join(payload)
+
+    path = cache_path(table.file.file_name)
+    temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(CACHE_MAGIC)
+            f.write(payload)
+            f.write(struct.pack('<I', zlib.crc32(payload)))
+        os.replace(temp_path, path)
+    except OSError:
+        pass  # The cache is optional
+
+
+def cache_state(file_name):
+    """
+    Returns the mtime and size file_name had when its cache was saved,
+    and whether the index of words was saved with it, reading only the
+    lengths of the sections. None if there's no cache.
+    """
+    try:
+        with open(cache_path(file_name), 'rb') as f:
+            if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return None
+            mtime, size, _, _ = struct.unpack(
+                CACHE_HEADER, f.read(struct.calcsize(CACHE_HEADER)))
+            # The columns, names and counts come before the words
+            for _ in range(len(TaskTable.COLUMNS) + 3):
+                length, = struct.unpack('<Q', f.read(8))
+                f.seek(length, os.SEEK_CUR)
+            length, = struct.unpack('<Q', f.read(8))
+    except (OSError, struct.error):
+        return None
+    return mtime, size, length > 0
+
+
+def read_cache(task_file):
+    """
+    Returns a TaskTable built from the cache of task_file, or None if
+    there's no cache, it's out of date or it's corrupted.
+    The table may lack the lines appended since the cache was saved.
+    """
+    try:
+        with open(cache_path(task_file.file_name), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    start, end = len(CACHE_MAGIC), len(data) - 4
+    if not data.startswith(CACHE_MAGIC) or end < start:
+        return None
+    payload = memoryview(data)[start:end]
+    if struct.unpack('<I', data[end:])[0] != zlib.crc32(payload):
+        return None
+    # The file must be the same, or the same with lines appended: only
+    # then is the prefix read again, it may have been edited in place
+    stat = task_file.stat
+    mtime, size, inode, checksum = struct.unpack_from(CACHE_HEADER, payload)
+    if inode != stat.st_ino or size > stat.st_size:
+        return None
+    if size == stat.st_size:
+        if mtime != stat.st_mtime_ns:
+            return None
+    elif prefix_checksum(task_file.buffer, size) != checksum:
+        return None
+
+    try:
+        sections = []
+        pos = struct.calcsize(CACHE_HEADER)
+        while pos < len(payload):
+            length, = struct.unpack_from('<Q', payload, pos)
+            pos += 8
+            sections.append(payload[pos:pos + length])
+            pos += length
+        (starts, priorities, done, name_starts, name_ids, names,
+         name_counts, priority_counts, words, offsets, postings) = sections
+        columns = (array('Q'), bytearray(priorities), bytearray(done),
+                   array('I'), array('I'))
+        columns[0].frombytes(starts)
+        columns[3].frombytes(name_starts)
+        columns[4].frombytes(name_ids)
+        names = bytes(names).decode('utf-8')
+        names = names.split('\n') if names else []
+        counts = array('q'), array('q')
+        counts[0].frombytes(name_counts)
+        counts[1].frombytes(priority_counts)
+        index = read_index(words, offsets, postings)
+    except (ValueError, struct.error):
+        return None
+
+    starts, priorities, done, name_starts, name_ids = columns
+    rows = len(priorities)
+    if (len(starts) != rows + 1 or len(name_starts) != rows + 1 or
+            len(done) != (rows + 7) // 8 or
+            name_starts[-1] != len(name_ids) or starts[-1] != size or
+            len(counts[0]) != 2 * len(names) or len(counts[1]) != 512):
+        return None
+    return TaskTable(task_file, columns, names, index, counts)
+
+
+def read_index(words, offsets, postings):
+    """
+    Rebuilds the index of words from its cache sections, which are
+    empty if the index wasn't built
+    """
+    if not offsets:
+        return None
+    words = bytes(words).decode('utf-8')
+    words = words.split('\n') if words else []
+    ends = array('Q')
+    ends.frombytes(offsets)
+    rows = array('I')
+    rows.frombytes(postings)
+    if len(ends) != len(words) + 1 or ends[-1] != len(rows):
+        raise ValueError("index sections don't match")
+    return {word: rows[ends[i]:ends[i + 1]] for i, word in enumerate(words)}
+
+
+def archive_index_path(file_name):
+    """
+    Returns the path of the full-text index of an archive file
+    """
+    directory, name = os.path.split(file_name)
+    return os.path.join(directory, '.' + name + '.index')
+
+
+INDEX_MAGIC = (b'TODOPYI4' + sys.byteorder[0].encode()).ljust(16, b'\0')
+
+
+# First row, rows, end offset in the archive, its inode and checksum
+SEGMENT_HEADER = '<QQQQQ'
+
+
+def index_lines(buf, start, end, first_row):
+    """
+    Returns the offsets of the lines of buf[start:end], plus end, and
+    the index of their words, numbering the lines from first_row
+    """
+    starts = array('Q')
+    index = {}
+    row = first_row
+    for offset, raw in iter_raw_lines(buf, start, end=end):
+        starts.append(offset)
+        for word in index_words(decode_line(raw)):
+            rows = index.get(word)
+            if rows is None:
+                index[word] = array('I', (row,))
+            elif rows[-1] != row:
+                rows.append(row)
+        row += 1
+    starts.append(end)
+    return starts, index
+
+
+def encode_segment(first_row, starts, index, stat, checksum):
+    """
+    Returns the bytes of an index segment: its length, a header, the
+    line offsets, the words, their offsets and postings, and a crc32.
+    Sections are padded to 8 bytes so they can be mapped as arrays.
+    """
+    words = [word.encode('utf-8') for word in index]
+    word_starts = array('I')
+    offsets = array('Q', [0])
+    position = 1
+    for word, rows in zip(words, index.values()):
+        word_starts.append(position)
+        position += len(word) + 1
+        offsets.append(offsets[-1] + len(rows))
+    word_starts.append(position)
+    vocabulary = b'\n' + b'\n'.join(words) + b'\n' if words else b'\n'
+    postings = b''.join(rows.tobytes() for rows in index.values())
+
+    payload = [struct.pack(SEGMENT_HEADER, first_row, len(starts) - 1,
+                           starts[-1], stat.st_ino, checksum)]
+    for section in (starts.tobytes(), vocabulary, word_starts.tobytes(),
+                    offsets.tobytes(), postings):
+        payload.append(struct.pack('<Q', len(section)))
+        payload.append(section)
+        payload.append(bytes(-len(section) % 8))
+    payload = b''.join(payload)
+    return b''.join([struct.pack('<Q', len(payload)), payload,
+                     struct.pack('<Q', zlib.crc32(payload))])
+
+
+class IndexSegment:
+    """
+    Run of lines of an archive and the index of their words, read
+    through views of the map of the index file
+    """
+    def __init__(self, data, position):
+        length, = struct.unpack_from('<Q', data, position)
+        start = position + 8
+        if start + length + 8 > len(data):
+            raise ValueError("segment is cut short")
+        self.data = data
+        self.position = position
+        self.size = length + 16
+        (self.first_row, self.rows, self.end, self.inode,
+         self.checksum) = struct.unpack_from(SEGMENT_HEADER, data, start)
+        view = memoryview(data)
+        sections = []
+        pos = start + struct.calcsize(SEGMENT_HEADER)
+        for _ in range(5):
+            size, = struct.unpack_from('<Q', data, pos)
+            pos += 8
+            if pos + size > start + length:
+                raise ValueError("section out of its segment")
+            sections.append((pos, pos + size))
+            pos += size + -size % 8
+        (starts, self.vocabulary, word_starts, offsets,
+         postings) = sections
+        self.starts = view[starts[0]:starts[1]].cast('Q')
+        self.word_starts = view[word_starts[0]:word_starts[1]].cast('I')
+        self.offsets = view[offsets[0]:offsets[1]].cast('Q')
+        self.postings = view[postings[0]:postings[1]].cast('I')
+        if (len(self.starts) != self.rows + 1 or
+                len(self.offsets) != len(self.word_starts) or
+                self.offsets[-1] != len(self.postings)):
+            raise ValueError("sections don't match")
+
+    def intact(self):
+        """
+        Checks the crc32 of the segment
+        """
+        start = self.position + 8
+        end = self.position + self.size - 8
+        crc, = struct.unpack_from('<Q', self.data, end)
+        return zlib.crc32(memoryview(self.data)[start:end]) == crc
+
+    def word(self, i):
+        start = self.vocabulary[0]
+        return self.data[start + self.word_starts[i]:
+                         start + self.word_starts[i + 1] - 1].decode('utf-8')
+
+    def word_rows(self, i):
+        return self.postings[self.offsets[i]:self.offsets[i + 1]]
+
+    def containing(self, term):
+        """
+        Returns the lists of rows of the words containing term.
+        The vocabulary is searched as a whole, words are told apart
+        by their offsets.
+        """
+        needle = term.encode('utf-8')
+        start, end = self.vocabulary
+        lists = []
+        pos = self.data.find(needle, start, end)
+        while pos >= 0:
+            i = bisect.bisect_right(self.word_starts, pos - start) - 1
+            lists.append(self.word_rows(i))
+            pos = self.data.find(needle, start + self.word_starts[i + 1], end)
+        return lists
+
+    def exact(self, word):
+        """
+        Returns the lists of rows of word, at most one
+        """
+        start, end = self.vocabulary
+        pos = self.data.find(b'\n' + word.encode('utf-8') + b'\n', start, end)
+        if pos < 0:
+            return []
+        return [self.word_rows(
+            bisect.bisect_left(self.word_starts, pos + 1 - start))]
+
+    def completed(self, first, last):
+        """
+        Returns the lists of rows completed between first and last
+        """
+        start, end = self.vocabulary
+        lists = []
+        pos = self.data.find(b'\nx ', start, end)
+        while pos >= 0:
+            date = self.data[pos + 3:pos + 13].decode('utf-8')
+            if date_in_range(date, first, last):
+                lists.append(self.word_rows(
+                    bisect.bisect_left(self.word_starts, pos + 1 - start)))
+            pos = self.data.find(b'\nx ', pos + 1, end)
+        return lists
+
+    def words_matching(self, pattern):
+        """
+        Yields (word, rows) for the words pattern, a regex of bytes
+        matching '\\nWORD' with the word as its group, finds in the
+        vocabulary
+        """
+        start, end = self.vocabulary
+        for found in pattern.finditer(self.data, start, end):
+            i = bisect.bisect_left(self.word_starts, found.start() + 1 - start)
+            yield found.group(1).decode('utf-8'), self.word_rows(i)
+
+    def index(self):
+        """
+        Returns the index of words of the segment as a dict of arrays
+        """
+        index = {}
+        for i in range(len(self.word_starts) - 1):
+            rows = index[self.word(i)] = array('I')
+            rows.frombytes(self.word_rows(i).cast('B'))
+        return index
+
+
+class ArchiveIndex:
+    """
+    Full-text index of a file that only grows, like done.txt.
+    Lines appended to the file are indexed in a segment appended to
+    .NAME.index. When the last segments get out of balance they're
+    merged into one appended after them, which supersedes them, and
+    once the index file is mostly superseded segments it's rewritten.
+    Searches read the postings of the terms looked up and the lines
+    they lead to, through maps of both files.
+    """
+    LINE_COST = TaskTable.LINE_COST
+
+    def __init__(self, file_name):
+        self.file = TaskFile(file_name)
+        self.path = archive_index_path(file_name)
+        self.read()
+
+    def read(self):
+        """
+        Maps the index file and finds its live segments, none if they
+        don't match the archive anymore
+        """
+        self.segments = []
+        self.size = 0  # bytes of the index file in use
+        try:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size <= len(INDEX_MAGIC):
+                    return
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return
+        if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            return
+
+        segments = []
+        pos = len(INDEX_MAGIC)
+        while pos + 8 <= len(data):
+            try:
+                segment = IndexSegment(data, pos)
+            except (ValueError, TypeError, struct.error):
+                break  # Cut short by a crash
+            while segments and segments[-1].first_row >= segment.first_row:
+                segments.pop()  # Merged into segment
+            rows = segments[-1].first_row + segments[-1].rows \
+                if segments else 0
+            if segment.first_row != rows:
+                return
+            segments.append(segment)
+            pos += segment.size
+        if not segments or not segments[-1].intact():
+            return
+        last, buf = segments[-1], self.file.buffer
+        if (last.inode != self.file.stat.st_ino or last.end > len(buf) or
+                prefix_checksum(buf, last.end) != last.checksum):
+            return
+        self.segments = segments
+        self.size = pos
+
+    @property
+    def rows(self):
+        """
+        Number of lines indexed
+        """
+        if not self.segments:
+            return 0
+        return self.segments[-1].first_row + self.segments[-1].rows
+
+    @property
+    def end(self):
+        """
+        Offset in the archive where the lines indexed end
+        """
+        return self.segments[-1].end if self.segments else 0
+
+    def __len__(self):
+        buf, end = self.file.buffer, self.end
+        tail = count_newlines(buf, end, len(buf))
+        if len(buf) > end and buf[len(buf) - 1:] != b'\n':
+            tail += 1  # Last line without a newline
+        return self.rows + tail
+
+    def indexed(self):
+        """
+        Checks if every complete line of the archive is indexed
+        """
+        buf = self.file.buffer
+        end = buf.rfind(b'\n') + 1
+        return end == self.end and (bool(self.segments) or not end)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Keeps other processes from updating the index meanwhile,
+        with a lock on the archive
+        """
+        with open(self.file.file_name, 'rb') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def update(self):
+        """
+        Indexes the lines appended to the archive since the last
+        segment. Trailing segments are merged while one holds less
+        than twice the rows of the ones after it.
+        """
+        if self.indexed():
+            return
+        with self.locked():
+            # Another process may have appended lines or indexed them
+            self.file = TaskFile(self.file.file_name)
+            self.read()
+            if self.indexed():
+                return
+            buf = self.file.buffer
+            end = buf.rfind(b'\n') + 1
+            starts, index = self.index_chunks(buf, self.end, end)
+            first, first_row = len(self.segments), self.rows
+            rows = len(starts) - 1
+            while first > 0 and self.segments[first - 1].rows <= 2 * rows:
+                first -= 1
+                rows += self.segments[first].rows
+            if first < len(self.segments):
+                first_row = self.segments[first].first_row
+                starts, index = self.merged(self.segments[first:], starts,
+                                            index)
+            segment = encode_segment(first_row, starts, index, self.file.stat,
+                                     prefix_checksum(buf, end))
+            live = sum(s.size for s in self.segments[:first]) + len(segment)
+            if not self.segments or self.size + len(segment) > 2 * live:
+                self.rewrite(segment, first)
+            else:
+                with open(self.path, 'r+b') as f:
+                    f.seek(self.size)
+                    f.write(segment)
+                    f.truncate()
+        self.read()
+
+    def index_chunks(self, buf, start, end):
+        """
+        Returns index_lines() of the lines of buf[start:end], which
+        processes index in chunks when they are big
+        """
+        bounds = chunk_bounds(buf, start, end)
+        first_rows = [self.rows]
+        for first, last in zip(bounds, bounds[1:-1]):
+            first_rows.append(first_rows[-1] + count_newlines(buf, first,
+                                                              last))
+        starts, index = array('Q'), {}
+        for chunk_starts, chunk_index in map_chunks(
+                self.file, bounds, index_chunk, first_rows):
+            starts.extend(chunk_starts[:-1])
+            start = chunk_starts[-1]
+            for word, rows in chunk_index.items():
+                index.setdefault(word, array('I')).extend(rows)
+        # The rest if a process failed, or all of it
+        rest_starts, rest_index = index_lines(buf, start, end,
+                                              self.rows + len(starts))
+        if not starts:
+            return rest_starts, rest_index
+        starts.extend(rest_starts)
+        for word, rows in rest_index.items():
+            index.setdefault(word, array('I')).extend(rows)
+        return starts, index
+
+    def merged(self, segments, starts, index):
+        """
+        Returns the line offsets and the index of words of segments
+        followed by the lines of starts and index
+        """
+        merged_starts = array('Q')
+        merged = {}
+        for segment in segments:
+            merged_starts.frombytes(segment.starts[:-1].cast('B'))
+            for word, rows in segment.index().items():
+                merged.setdefault(word, array('I')).extend(rows)
+        merged_starts.extend(starts)
+        for word, rows in index.items():
+            merged.setdefault(word, array('I')).extend(rows)
+        return merged_starts, merged
+
+    def rewrite(self, segment, first):
+        """
+        Writes a new index file with the live segments before first
+        and segment, and moves it over the old one
+        """
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(INDEX_MAGIC)
+                for old in self.segments[:first]:
+                    f.write(old.data[old.position:old.position + old.size])
+                f.write(segment)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass  # The index is optional
+
+    def match(self, query):
+        """
+        Yields the tasks of the archive matching a Query. Rows are
+        found by looking terms up in the segments, and only their lines
+        are read, unless just exclusions could be looked up.
+        """
+        lookups = []
+        for term, negated in query.words:
+            if term and not any(char.isspace() for char in term):
+                lists = [rows for segment in self.segments
+                         for rows in segment.containing(term)]
+                lookups.append((negated, sum(map(len, lists)), term, lists,
+                                []))
+        for name, negated in query.names:
+            lists = [rows for segment in self.segments
+                     for rows in segment.exact(name)]
+            lookups.append((negated, sum(map(len, lists)), name, lists, []))
+        for first, last, negated in query.completed:
+            lists = [rows for segment in self.segments
+                     for rows in segment.completed(first, last)]
+            lookups.append((negated, sum(map(len, lists)), first, lists, []))
+        found, excluded = combine_postings(lookups, self.LINE_COST)
+
+        if found is None:
+            lines = enumerate(iter_raw_lines(self.file.buffer))
+        else:
+            lines = self.lines(sorted(found))
+        for row, (_, raw) in lines:
+            if row in excluded:
+                continue
+            task = parse_task(decode_line(raw), row + 1)
+            if query.matches(task):
+                yield task
+
+    def words_matching(self, pattern):
+        """
+        Yields (word, rows) for the indexed words the regex pattern
+        matches as a whole, a pair per segment that has the word
+        """
+        regex = re.compile(b'\n(' + pattern.encode('utf-8') + b')(?=\n)')
+        for segment in self.segments:
+            yield from segment.words_matching(regex)
+
+    def lines(self, rows):
+        """
+        Yields (row, (offset, line)) for the rows given in order,
+        and for the lines after the ones indexed
+        """
+        buf = self.file.buffer
+        first_rows = [segment.first_row for segment in self.segments]
+        for row in rows:
+            segment = self.segments[bisect.bisect_right(first_rows, row) - 1]
+            i = row - segment.first_row
+            start, end = segment.starts[i], segment.starts[i + 1]
+            yield row, (start, buf[start:end])
+        yield from enumerate(iter_raw_lines(buf, self.end), self.rows)
+
+
+def load_archive(file_name):
+    """
+    Returns the ArchiveIndex of a file that only grows, brought up to
+    date, or its TaskTable when caching is off or it has a journal
+    """
+    if not USE_CACHE or os.path.exists(journal_path(file_name)):
+        return load_tasks(file_name)
+    return resident(file_name, read_archive)
+
+
+def read_archive(file_name):
+    archive = ArchiveIndex(file_name)
+    archive.update()
+    return archive
+
+
+# Done tasks are rotated into monthly segments in this directory
+# of the todo.txt directory once it exists
+SEGMENTS_DIR = 'done'
+SEGMENT_MAGIC = b'TODOPYS1'
+SEGMENT_FORMAT = '<II'  # lengths of the JSON header and of the bloom filter
+BLOOM_BITS = 10  # bits per key, about 1% false positives
+BLOOM_HASHES = 7
+SEGMENT_FLUSH = 1 << 16  # tasks rotated into segments at a time
+SEGMENT_LEVEL = 6  # gzip compression level
+
+
+class BloomFilter:
+    """
+    Set of strings that can tell for sure a string isn't in it
+    """
+    def __init__(self, bits, data=None):
+        self.bits = bits
+        self.data = bytearray(data if data is not None else bits // 8)
+
+    @staticmethod
+    def sized(keys):
+        """
+        Returns an empty filter with room for keys strings
+        """
+        return BloomFilter(max(1024, keys * BLOOM_BITS + 7) // 8 * 8)
+
+    def positions(self, key):
+        raw = key.encode('utf-8')
+        first, step = zlib.crc32(raw), zlib.adler32(raw) | 1
+        return [(first + i * step) % self.bits for i in range(BLOOM_HASHES)]
+
+    def add(self, key):
+        data = self.data
+        for bit in self.positions(key):
+            data[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, key):
+        data = self.data
+        return all(data[bit >> 3] & 1 << (bit & 7)
+                   for bit in self.positions(key))
+
+    def may_contain_text(self, text):
+        """
+        Checks if text may be in a line of words added with word_keys
+        """
+        for part in text.split():
+            if len(part) >= 3 and not all(
+                    part[i:i + 3] in self for i in range(len(part) - 2)):
+                return False
+        return True
+
+
+def word_keys(lines):
+    """
+    Returns the keys of lines for a BloomFilter: their words, and the
+    trigrams of their words for searches of parts of words
+    """
+    words = set(itertools.chain.from_iterable(map(str.split, lines)))
+    keys = set(words)
+    for word in words:
+        keys.update(word[i:i + 3] for i in range(len(word) - 2))
+    return keys
+
+
+class ArchiveSegment:
+    """
+    Done tasks of a month, gzip compressed behind a header with the
+    range of their completion dates, their count and a bloom filter
+    of their words. Each rotation appends a gzip member.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.first = self.last = None  # completion dates
+        self.tasks = 0
+        self.keys = 0  # keys added to the bloom filter
+        self.bloom = BloomFilter(1024)
+        self.offset = 0  # where the gzip members start
+        if not os.path.exists(path):
+            return
+        import json
+        with open(path, 'rb') as f:
+            head = f.read(len(SEGMENT_MAGIC) + struct.calcsize(
+                SEGMENT_FORMAT))
+            if not head.startswith(SEGMENT_MAGIC):
+                raise ValueError("not an archive segment")
+            header_size, bloom_size = struct.unpack_from(
+                SEGMENT_FORMAT, head, len(SEGMENT_MAGIC))
+            header = json.loads(f.read(header_size).decode('utf-8'))
+            self.bloom = BloomFilter(header['bits'], f.read(bloom_size))
+        self.first, self.last = header['first'], header['last']
+        self.tasks, self.keys = header['tasks'], header['keys']
+        self.offset = len(head) + header_size + bloom_size
+        if len(self.bloom.data) * 8 != self.bloom.bits:
+            raise ValueError("bloom filter cut short")
+
+    def lines(self):
+        """
+        Yields the lines of the segment
+        """
+        if not self.offset:
+            return
+        import gzip
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            with gzip.GzipFile(fileobj=f) as lines:
+                for raw in lines:
+                    yield decode_line(raw)
+
+    def may_match(self, query):
+        """
+        Checks if some task of the segment may match a Query,
+        from its header alone
+        """
+        if not self.tasks or not all(query.done):
+            return False  # Only done tasks here
+        for first, last, negated in query.completed:
+            if negated:
+                if (date_in_range(self.first, first, last) and
+                        date_in_range(self.last, first, last)):
+                    return False
+            elif (self.last[:len(first)] < first or
+                    self.first[:len(last)] > last):
+                return False
+        for name, negated in query.names:
+            if not negated and name not in self.bloom:
+                return False
+        for term, negated in query.words:
+            if not negated and not self.bloom.may_contain_text(term):
+                return False
+        return True
+
+    def append(self, lines):
+        """
+        Adds lines of done tasks to the segment, as a gzip member after
+        the old ones, which are copied as they are. The bloom filter is
+        rebuilt larger once it's full.
+        """
+        import gzip
+        import json
+        keys = word_keys(lines)
+        dates = [line[2:12] for line in lines]
+        if self.first is not None:
+            dates += [self.first, self.last]
+        self.first, self.last = min(dates), max(dates)
+        self.tasks += len(lines)
+        self.keys += len(keys)
+        if self.keys * BLOOM_BITS > self.bloom.bits:
+            keys = word_keys(itertools.chain(self.lines(), lines))
+            self.keys = len(keys)
+            self.bloom = BloomFilter.sized(2 * self.keys)
+        for key in keys:
+            self.bloom.add(key)
+
+        header = json.dumps({'first': self.first, 'last': self.last,
+                             'tasks': self.tasks, 'keys': self.keys,
+                             'bits': self.bloom.bits}).encode('utf-8')
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(SEGMENT_MAGIC)
+            f.write(struct.pack(SEGMENT_FORMAT, len(header),
+                                len(self.bloom.data)))
+            f.write(header)
+            f.write(self.bloom.data)
+            if self.offset:
+                with open(self.path, 'rb') as old:
+                    old.seek(self.offset)
+                    while True:
+                        chunk = old.read(1 << 20)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+            f.write(gzip.compress(''.join(lines).encode('utf-8'),
+                                  SEGMENT_LEVEL))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.__init__(self.path)
+
+
+class SegmentedArchive:
+    """
+    Done tasks rotated into monthly ArchiveSegments, read in the order
+    of the months. Tasks are numbered on from first_number.
+    """
+    def __init__(self, directory, first_number=1):
+        self.directory = directory
+        self.first_number = first_number
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if re.fullmatch(r'\d{4}-\d{2}\.txt\.gz', name):
+                try:
+                    self.segments.append(ArchiveSegment(
+                        os.path.join(directory, name)))
+                except (OSError, ValueError, KeyError, struct.error):
+                    print("TODO: damaged archive segment",
+                          os.path.join(directory, name))
+                    sys.exit(1)
+
+    def __len__(self):
+        return sum(segment.tasks for segment in self.segments)
+
+    def __iter__(self):
+        for number, line in enumerate(self.lines(), self.first_number):
+            yield parse_task(line, number)
+
+    def lines(self):
+        """
+        Yields the lines of all the segments
+        """
+        for segment in self.segments:
+            yield from segment.lines()
+
+    def match(self, query):
+        """
+        Yields the tasks matching a Query, only reading the segments
+        whose header doesn't rule them out
+        """
+        number = self.first_number
+        for segment in self.segments:
+            if segment.may_match(query):
+                for offset, line in enumerate(segment.lines()):
+                    task = parse_task(line, number + offset)
+                    if query.matches(task):
+                        yield task
+            number += segment.tasks
+
+
+def segments_path():
+    """
+    Returns the path of the directory of archive segments
+    """
+    return os.path.join(PATH, SEGMENTS_DIR)
+
+
+def load_segments(first_number=1):
+    """
+    Returns the SegmentedArchive of the todo.txt directory, or None if
+    done tasks aren't rotated into segments
+    """
+    if not os.path.isdir(segments_path()):
+        return None
+    return SegmentedArchive(segments_path(), first_number)
+
+
+def append_segments(lines):
+    """
+    Adds the lines of done tasks to the segments of the months they
+    were completed
+    """
+    months = {}
+    for line in lines:
+        if not line.endswith('\n'):
+            line += '\n'
+        months.setdefault(line[2:9], []).append(line)
+    for month, lines in sorted(months.items()):
+        segment = ArchiveSegment(os.path.join(segments_path(),
+                                              month + '.txt.gz'))
+        segment.append(lines)
+
+
+def archive_done(tasks):
+    """
+    Adds done tasks to the archive: done.txt, or its segments once
+    it was rotated; lines that aren't done tasks go to done.txt.
+    With DEFER_WRITES they wait in deferred_done for flush_writes.
+    """
+    if DEFER_WRITES:
+        deferred_done.extend(task.content for task in tasks)
+        return
+    if os.path.isdir(segments_path()):
+        rotated = [task.content for task in tasks
+                   if line_prefix(task.content)[1]]
+        append_segments(rotated)
+        tasks = [task for task in tasks if not line_prefix(task.content)[1]]
+    if tasks:
+        write_tasks(tasks, 'done.txt', 'a')
+
+
+ROTATE_LOG = '.todo.rotate'
+
+
+def rotate_log_path():
+    return os.path.join(PATH, ROTATE_LOG)
+
+
+def rotate_archive():
+    """
+    Moves the done tasks of done.txt into monthly segments, so that
+    they end up in one or the other. The lines that aren't done tasks
+    stay. The rotation log saves the moved lines after the identity of
+    done.txt and the task counts of the segments, then done.txt is
+    rewritten without them and they are added to the segments. Until
+    the log is removed, recover_rotation can finish the rotation.
+    """
+    import json
+    os.makedirs(segments_path(), exist_ok=True)
+    done_file = TaskFile(get_file_dir('done.txt'))
+    stat = done_file.stat
+    header = {'done': [stat.st_ino, stat.st_size, stat.st_mtime_ns],
+              'tasks': {os.path.basename(segment.path): segment.tasks
+                        for segment in load_segments().segments}}
+    kept = []
+    temp_path = '{0}.{1}.tmp'.format(rotate_log_path(), os.getpid())
+    with open(temp_path, 'w', encoding='utf-8') as log:
+        log.write(json.dumps(header) + '\n')
+        for _, raw in iter_raw_lines(done_file.buffer):
+            line = decode_line(raw)
+            if (line[:2] == 'x ' and is_date(line[2:12]) and
+                    line[12:13].isspace()):
+                log.write(line if line.endswith('\n') else line + '\n')
+            else:
+                kept.append(Task(0, line))
+        log.flush()
+        os.fsync(log.fileno())
+    os.replace(temp_path, rotate_log_path())
+    write_tasks(kept, 'done.txt')
+    finish_rotation(header)
+
+
+def finish_rotation(header):
+    """
+    Adds the lines of the rotation log to the segments, in batches of
+    SEGMENT_FLUSH tasks, and removes the log. The lines of a month an
+    interrupted rotation added already are skipped.
+    """
+    added = {}  # lines of each segment to skip
+    batch = []
+    with open(rotate_log_path(), encoding='utf-8') as log:
+        next(log)
+        for line in log:
+            name = line[2:9] + '.txt.gz'
+            if name not in added:
+                segment = ArchiveSegment(os.path.join(segments_path(),
+                                                      name))
+                added[name] = segment.tasks - header['tasks'].get(name, 0)
+            if added[name]:
+                added[name] -= 1
+                continue
+            batch.append(line)
+            if len(batch) >= SEGMENT_FLUSH:
+                append_segments(batch)
+                batch = []
+    append_segments(batch)
+    os.remove(rotate_log_path())
+
+
+def recover_rotation():
+    """
+    Finishes a rotation rotate_archive didn't: if done.txt was
+    rewritten already, the lines of the log go on into the segments,
+    otherwise nothing changed yet and the log is dropped
+    """
+    import json
+    try:
+        with open(rotate_log_path(), encoding='utf-8') as log:
+            header = json.loads(log.readline())
+    except OSError:
+        return
+    try:
+        stat = os.stat(os.path.join(PATH, 'done.txt'))
+        identity = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        identity = None
+    if identity != header['done']:
+        finish_rotation(header)
+    else:
+        os.remove(rotate_log_path())
+
+
+# Catalog of the todo.txt files of the todo.txt directory
+CATALOG_NAME = '.todo.catalog'
+CATALOG_VERSION = 2
+CATALOG_DEPTH = 3  # levels of subdirectories looked into
+
+
+class Catalog:
+    """
+    The .txt files of the todo.txt directory with their size and line
+    count, the state they were last parsed in is the one their caches
+    were saved for. A directory is only
+    listed again when its mtime changed, and a file only counted again
+    when its size or mtime changed. Hidden files and directories, and
+    directories deeper than CATALOG_DEPTH, are left out.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        import json
+        self.path = os.path.join(directory, CATALOG_NAME)
+        self.dirs, self.files = {}, {}
+        self.changed = False
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == CATALOG_VERSION:
+                self.dirs, self.files = data['dirs'], data['files']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass  # Built again from scratch
+
+    def refresh(self):
+        """
+        Brings the catalog up to date with the directory tree
+        """
+        dirs, files = {}, {}
+        pending = [('', 0)]
+        while pending:
+            relative, depth = pending.pop()
+            full = os.path.join(self.directory, relative)
+            try:
+                mtime = os.stat(full).st_mtime_ns
+            except OSError:
+                continue
+            entry = self.dirs.get(relative)
+            if not entry or entry['mtime'] != mtime:
+                entry = self.scan(full, mtime)
+                self.changed = True
+            dirs[relative] = entry
+            if depth < CATALOG_DEPTH:
+                pending += [(os.path.join(relative, name), depth + 1)
+                            for name in reversed(entry['dirs'])]
+            for name in entry['files']:
+                name = os.path.join(relative, name)
+                record = self.file_record(name, self.files.get(name))
+                if record:
+                    files[name] = record
+        if dirs.keys() != self.dirs.keys() or \
+                files.keys() != self.files.keys():
+            self.changed = True
+        self.dirs, self.files = dirs, files
+
+    @staticmethod
+    def scan(full, mtime):
+        """
+        Lists the .txt files and the subdirectories of a directory
+        """
+        entry = {'mtime': mtime, 'files': [], 'dirs': []}
+        try:
+            with os.scandir(full) as it:
+                for item in it:
+                    if item.name.startswith('.'):
+                        continue
+                    if item.is_dir(follow_symlinks=False):
+                        entry['dirs'].append(item.name)
+                    elif item.name.endswith('.txt') and item.is_file():
+                        entry['files'].append(item.name)
+        except OSError:
+            pass  # Unreadable, listed as empty
+        entry['files'].sort()
+        entry['dirs'].sort()
+        return entry
+
+    def file_record(self, name, record):
+        """
+        Returns the record of a file, counting its lines again only if
+        it changed since record. None if it's gone.
+        """
+        try:
+            stat = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return None
+        if (record and record['size'] == stat.st_size and
+                record['mtime'] == stat.st_mtime_ns):
+            return record
+        task_file = TaskFile(os.path.join(self.directory, name))
+        buf = task_file.buffer
+        lines = count_newlines(buf, 0, len(buf))
+        if buf and buf[-1:] != b'\n':
+            lines += 1  # Last line without a newline
+        self.changed = True
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                'lines': lines}
+
+    def find(self, name):
+        """
+        Returns the name the catalog knows a file by, with or without
+        its .txt extension, or None
+        """
+        name = os.path.normpath(name)
+        for candidate in (name, name + '.txt'):
+            if candidate in self.files:
+                return candidate
+        return None
+
+    def state(self, name):
+        """
+        Describes the state a file was last parsed in
+        """
+        record = self.files[name]
+        parsed = cache_state(os.path.join(self.directory, name))
+        if not parsed:
+            return 'not parsed'
+        mtime, size, indexed = parsed
+        if size != record['size'] or mtime != record['mtime']:
+            return 'changed since parsed'
+        return 'parsed, indexed' if indexed else 'parsed'
+
+    def save(self):
+        """
+        Writes the catalog if it changed
+        """
+        if not self.changed:
+            return
+        import json
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': CATALOG_VERSION, 'dirs': self.dirs,
+                           'files': self.files}, f)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass  # The catalog is optional
+        self.changed = False
+
+
+def load_tasks(file_name):
+    """
+    Returns the TaskTable of a tasks file, from memory when serving
+    """
+    return resident(file_name, read_tasks)
+
+
+def file_identity(file_name):
+    """
+    Returns the inode, size and mtime of a file and of its journal,
+    one of which changes with any write
+    """
+    identity = []
+    for path in (file_name, journal_path(file_name)):
+        try:
+            stat = os.stat(path)
+            identity.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            identity.append(None)
+    return tuple(identity)
+
+
+def resident(file_name, load):
+    """
+    Returns load(file_name). While serving, what it returns is kept in
+    RESIDENT until the file or its journal changes; lines appended to
+    the file of a kept TaskTable are parsed onto it.
+    """
+    if RESIDENT is None:
+        return load(file_name)
+    key = os.path.abspath(file_name), load
+    identity = file_identity(file_name)
+    kept = RESIDENT.get(key)
+    if kept is None or kept[0] != identity and not (
+            isinstance(kept[1], TaskTable) and
+            parse_appended(kept[1], kept[0], identity)):
+        kept = identity, load(file_name)
+    RESIDENT[key] = identity, kept[1]
+    return kept[1]
+
+
+def keep_resident(file_name, table):
+    """
+    Keeps the TaskTable of a file just written, if serving
+    """
+    if RESIDENT is not None:
+        RESIDENT[os.path.abspath(file_name), read_tasks] = (
+            file_identity(file_name), table)
+
+
+def parse_appended(table, old, new):
+    """
+    Parses onto a TaskTable the lines appended to its file since its
+    identity was old. Returns False if the file changed otherwise, or
+    the table has changes of its own.
+    """
+    if old[1] is not None or new[1] is not None or new[0] is None:
+        return False  # Journals are replayed from scratch
+    (inode, size, _), (new_inode, new_size, _) = old[0], new[0]
+    if new_inode != inode or new_size <= size or table.edits or \
+            table.first_change is not None:
+        return False
+    task_file = TaskFile(table.file.file_name)
+    end = table.starts[-1]
+    if len(task_file.buffer) < end or prefix_checksum(
+            task_file.buffer, end) != prefix_checksum(table.buffer, end):
+        return False
+    table.file, table.buffer = task_file, task_file.buffer
+    table.parse_tail()
+    return True
+
+
+def read_tasks(file_name):
+    """
+    Returns the TaskTable of a tasks file, from the cache if it's
+    up to date. Lines appended since are parsed and added to it.
+    Changes in the file's journal are applied on top.
+    """
+    task_file = TaskFile(file_name)
+    table = read_cache(task_file) if USE_CACHE else None
+    if table is None:
+        table = TaskTable(task_file)
+    elif table.starts[-1] < len(task_file.buffer):
+        table.parse_tail()  # Only parse what was appended
+    else:
+        replay_journal(table)
+        return table
+    if USE_CACHE:
+        write_cache(table)
+    replay_journal(table)
+    return table
+
+
+def journal_path(file_name):
+    """
+    Returns the path of the journal of a tasks file
+    """
+    directory, name = os.path.split(file_name)
+    return os.path.join(directory, '.' + name + '.journal')
+
+
+# Journal size at which it's folded back into its file
+JOURNAL_LIMIT = 1 << 20
+
+
+def append_journal(file_name, batches, stat=None):
+    """
+    Appends batches of records to the journal of a tasks file.
+    A new journal starts with the identity of the file it applies to.
+    A batch only counts once its closing C line is written.
+    """
+    path = journal_path(file_name)
+    lines = []
+    for records in batches:
+        lines += ['B'] + records + ['C']
+    with open(path, 'a', encoding='utf-8') as f:
+        if f.tell() == 0:
+            stat = stat or os.stat(file_name)
+            lines.insert(0, 'S {0} {1} {2}'.format(stat.st_ino, stat.st_size,
+                                                   stat.st_mtime_ns))
+        f.write('\n'.join(lines) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def journal_records(table):
+    """
+    Returns the changes of a TaskTable as a batch of journal records,
+    and forgets them:
+      R NUMBER CONTENT  replaces task NUMBER
+      D NUMBER          deletes task NUMBER
+      A CONTENT         adds a task at the end
+    Numbers are the ones the tasks had before the changes.
+    """
+    removed = set(table.removed)
+    records = []
+    for row in sorted(table.touched - removed, key=table.number):
+        if row not in table.added:
+            records.append('R {0} {1}'.format(
+                table.number(row), table.line(row).rstrip('\n')))
+    for row in table.removed:
+        if row not in table.added:
+            records.append('D {0}'.format(table.number(row)))
+    for row in table.added:
+        if row not in removed:
+            records.append('A ' + table.line(row).rstrip('\n'))
+    table.touched, table.removed, table.added = set(), [], []
+    return records
+
+
+def journal_tasks(table):
+    """
+    Writes the changes of a TaskTable to its file's journal.
+    Returns False if the changes can't be journaled or the journal is
+    due for compaction, the file has to be rewritten then.
+    """
+    file_name = table.file.file_name
+    path = journal_path(file_name)
+    if not table.journalable:
+        return False
+    if os.path.exists(path):
+        if os.path.getsize(path) >= JOURNAL_LIMIT:
+            return False
+    else:
+        stat, old = os.stat(file_name), table.file.stat
+        if (stat.st_ino, stat.st_size, stat.st_mtime_ns) != (
+                old.st_ino, old.st_size, old.st_mtime_ns):
+            return False
+
+    batches = table.batches + [journal_records(table)]
+    batches = [records for records in batches if records]
+    if batches:
+        append_journal(file_name, batches, table.file.stat)
+    table.written(journaled=True)
+    return True
+
+
+def replay_journal(table):
+    """
+    Applies the journal of the file of a TaskTable to it.
+    A journal left from a file that was since rewritten is removed.
+    """
+    path = journal_path(table.file.file_name)
+    try:
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().split('\n')
+    except OSError:
+        return
+
+    stat = table.file.stat
+    identity = 'S {0} {1} {2}'.format(stat.st_ino, stat.st_size,
+                                      stat.st_mtime_ns)
+    if lines[0] != identity:
+        if 'F' not in lines:
+            print("TODO:", os.path.basename(table.file.file_name),
+                  "changed outside of the journal, journal moved to",
+                  path + '.stale')
+            os.replace(path, path + '.stale')
+        else:
+            os.remove(path)  # Already folded into the file
+        return
+
+    batch = None
+    deleted = False
+    for line in lines[1:]:
+        if line == 'B':
+            batch = []
+        elif line == 'C' and batch is not None:
+            deleted = apply_batch(table, batch) or deleted
+            batch = None
+        elif batch is not None:
+            batch.append(line)
+
+    if deleted:
+        table.renumber()
+    table.first_change = 0  # The file lacks the journal
+    table.patchable = False
+
+
+def apply_batch(table, records):
+    """
+    Applies a batch of journal records to a TaskTable.
+    Returns True if tasks were deleted.
+    """
+    order = table.order
+    deleted = []
+    for record in records:
+        kind, _, rest = record.partition(' ')
+        if kind == 'R':
+            number, _, content = rest.partition(' ')
+            row = order[int(number) - 1]
+            table.edits[row] = parse_task(content + '\n', table.number(row))
+        elif kind == 'D':
+            deleted.append(order[int(rest) - 1])
+        elif kind == 'A':
+            order.append(table.add(parse_task(rest + '\n', len(order) + 1)))
+            table.reordered = True
+    if deleted:
+        table.reordered = True
+        table.dropped.update(deleted)
+    if len(deleted) < 32:
+        for row in deleted:
+            order.remove(row)
+    else:
+        deleted = set(deleted)
+        table.order = array('I', [row for row in order if row not in deleted])
+    return bool(deleted)
+
+
+def count_newlines(buf, start, end, chunk=1 << 20):
+    """
+    Counts newlines in buf[start:end] a chunk at a time
+    (mmap objects have no count method)
+    """
+    count = 0
+    for pos in range(start, end, chunk):
+        count += buf[pos:min(pos + chunk, end)].count(b'\n')
+    return count
+
+
+def decode_line(raw):
+    """
+    Decodes a line read in binary mode as text mode would
+    """
+    line = raw.decode('utf-8', 'replace')
+    if line.endswith('\r\n'):
+        line = line[:-2] + '\n'
+    return line
+
+
+def write_tasks(task_list, file='todo.txt', mode='w'):
+    """
+    Rewrites the todo file with updated tasks
+    """
+    file_path = get_file_dir(file)
+    if mode == 'a':
+        with open(file_path, mode) as f:
+            for task in task_list:
+                f.write(task.content)
+        if USE_CACHE and os.path.exists(archive_index_path(file_path)):
+            ArchiveIndex(file_path).update()
+        return
+
+    if isinstance(task_list, TaskTable) and os.path.abspath(
+            task_list.file.file_name) == os.path.abspath(file_path):
+        if DEFER_WRITES:
+            return  # Written by commit_queue
+        if USE_JOURNAL and journal_tasks(task_list):
+            return
+        if patch_tasks(task_list):
+            return
+        data = task_list.encode()
+        first = task_list.first_change
+    else:
+        data = ''.join([task.content for task in task_list]).encode('utf-8')
+        first = 0
+
+    # The journal is folded into the new file, mark it as such
+    # in case we crash before removing it
+    journal = journal_path(file_path)
+    if os.path.exists(journal):
+        with open(journal, 'a') as f:
+            f.write('F\n')
+
+    # Write a new file and move it over the old one,
+    # a crash leaves either of them complete
+    temp_path = '{0}.{1}.tmp'.format(file_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(file_path):
+        os.chmod(temp_path, os.stat(file_path).st_mode & 0o7777)
+    os.replace(temp_path, file_path)
+    if os.path.exists(journal):
+        os.remove(journal)
+
+    if isinstance(task_list, TaskTable):
+        task_list.written()
+        cache_written_file(task_list, file_path, first)
+
+
+def patch_tasks(table):
+    """
+    Writes the changes of a TaskTable into its own file, overwriting
+    only the changed lines when their length didn't change, or else
+    the tail of the file from the first changed line.
+    Returns False when the whole file has to be rewritten.
+    """
+    first = table.first_change
+    if first is None:
+        return True  # Nothing changed
+    file_path = table.file.file_name
+    old = table.file.stat
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return False
+    if (not table.patchable or (stat.st_ino, stat.st_size,
+            stat.st_mtime_ns) != (old.st_ino, old.st_size, old.st_mtime_ns)):
+        return False
+
+    buf, starts, rows = table.buffer, table.starts, table.rows
+    edits = {row: task.content.encode('utf-8')
+             for row, task in table.edits.items()}
+    if not table.reordered and all(
+            len(data) == starts[row + 1] - starts[row]
+            for row, data in edits.items()):
+        # Same length lines, overwrite them where they are
+        with open(file_path, 'r+b') as f:
+            for row in sorted(edits):
+                f.seek(starts[row])
+                f.write(edits[row])
+        table.written()
+        cache_written_file(table, file_path, first, sorted(edits))
+        return True
+    else:
+        offset = starts[first]
+        tail = table.encode(first)
+        if len(tail) > offset:
+            return False  # Most of the file changes
+        # The tail of the map is about to change, keep the old one
+        table.buffer = SplicedBuffer(buf, offset, buf[offset:])
+        with open(file_path, 'r+b') as f:
+            f.seek(offset)
+            f.write(tail)
+            f.truncate()
+
+    table.written()
+    cache_written_file(table, file_path, first)
+    return True
+
+
+# A move between two files that may have to be undone after a crash
+MOVE_LOG = '.todo.move'
+
+
+def move_log_path():
+    return os.path.join(PATH, MOVE_LOG)
+
+
+def commit_move(table, rows, dest_path):
+    """
+    Moves rows of a TaskTable to the end of the file dest_path, so
+    that both files change or neither does. The new source is written
+    aside, the move log records the length of dest_path, the lines are
+    appended to it at once, and the new source replaces the old one.
+    Until the log is removed, recover_move can undo the append.
+    """
+    import json
+    moved = ''.join(table.line(row).rstrip('\n') + '\n' for row in rows)
+    table.discard(set(rows))
+    data = table.encode()
+    first = table.first_change
+    file_path = table.file.file_name
+
+    temp_path = '{0}.{1}.tmp'.format(file_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(temp_path, table.file.stat.st_mode & 0o7777)
+
+    with open(dest_path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size:
+            f.seek(size - 1)
+            if f.read(1) != b'\n':
+                moved = '\n' + moved  # Last line without a newline
+    with open(move_log_path(), 'w', encoding='utf-8') as f:
+        json.dump({'dest': dest_path, 'size': size, 'temp': temp_path}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    with open(dest_path, 'ab') as f:
+        f.write(moved.encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+    journal = journal_path(file_path)
+    if os.path.exists(journal):
+        with open(journal, 'a') as f:
+            f.write('F\n')
+    os.replace(temp_path, file_path)  # The move is done
+    if os.path.exists(journal):
+        os.remove(journal)
+    os.remove(move_log_path())
+
+    table.written()
+    cache_written_file(table, file_path, first)
+    if USE_CACHE and os.path.exists(archive_index_path(dest_path)):
+        ArchiveIndex(dest_path).update()
+
+
+def recover_move():
+    """
+    Undoes a move commit_move didn't finish: the lines appended to the
+    destination are cut off if the source wasn't replaced yet
+    """
+    import json
+    try:
+        with open(move_log_path(), encoding='utf-8') as f:
+            log = json.load(f)
+    except OSError:
+        return
+    except ValueError:
+        log = None  # Cut short, nothing was appended yet
+    if log and os.path.exists(log['temp']):
+        with open(log['dest'], 'r+b') as f:
+            f.truncate(log['size'])
+            os.fsync(f.fileno())
+        with contextlib.suppress(OSError):
+            os.remove(log['temp'])
+    with contextlib.suppress(OSError):
+        os.remove(move_log_path())
+
+
+def cache_written_file(table, file_path, first, rows=None):
+    """
+    Caches a file just written from table, reusing the columns of
+    the table. If rows is given, only those rows were overwritten.
+    """
+    if not USE_CACHE:
+        return
+    task_file = TaskFile(file_path)
+    if rows is not None:
+        new_table = TaskTable(task_file, table.prefix_columns(table.rows),
+                              list(table.names),
+                              counts=table.counts_before(table.rows))
+        if not all(new_table.store(row, table.edits[row]) for row in rows):
+            new_table = None
+        elif table.words is not None:
+            moves = array('l', range(table.rows))
+            for row in rows:
+                moves[row] = -1
+            edited = [(row, table.edits[row].content) for row in rows]
+            new_table.words = table.moved_index(first, moves, edited)
+            new_table.indexed = new_table.rows
+    if rows is None or new_table is None:
+        new_table = table.rebased(task_file, first)
+    if new_table.starts[-1] == len(task_file.buffer):
+        write_cache(new_table)
+        keep_resident(file_path, new_table)
+
+
+def priority_order(priority):
+    """
+    Sort key of priorities, the tasks without one come last
+    """
+    return not priority, priority
+
+
+def order_tasks(tasks, limit=None, offset=0):
+    """
+    Returns tasks in listing order, by priority and alphabetically
+    within a priority, skipping offset of them and keeping at most
+    limit. Tasks are put in a bucket per priority, and only the
+    buckets the page reaches into are sorted; the last one is cut
+    with a heap instead of sorting all of it.
+    The tables serve keeps in memory are sorted once instead.
+    """
+    if isinstance(tasks, TaskTable) and RESIDENT is not None and not (
+            tasks.edits or tasks.reordered or tasks.first_change is not None):
+        stop = None if limit is None else offset + limit
+        return [TaskView(tasks, row) for row in tasks.listing()[offset:stop]]
+    if isinstance(tasks, TaskTable):
+        buckets = tasks.priority_buckets()
+        key = tasks.line
+    else:
+        buckets = {}
+        for task in tasks:
+            buckets.setdefault(task.priority or '', []).append(task)
+        key = operator.attrgetter('content')
+
+    page = []
+    skip = offset
+    for priority in sorted(buckets, key=priority_order):
+        bucket = buckets[priority]
+        if skip >= len(bucket):
+            skip -= len(bucket)
+            continue
+        if limit is not None and skip + limit - len(page) < len(bucket):
+            bucket = heapq.nsmallest(skip + limit - len(page), bucket, key)
+        else:
+            bucket = sorted(bucket, key=key)
+        page += bucket[skip:]
+        skip = 0
+        if limit is not None and len(page) >= limit:
+            break
+    if isinstance(tasks, TaskTable):
+        return [TaskView(tasks, row) for row in page]
+    return page
+
+
+def following_page(listed, shown):
+    """
+    Returns the page (limit, offset) of a listing printed after one
+    of listed tasks, shown of which were printed
+    """
+    limit = None if LIMIT is None else LIMIT - shown
+    return limit, max(0, OFFSET - listed)
 
-    # Check if it's a completed task
-    comp_pattern = re.compile(r"(x\s\d{4}-\d{2}-\d{2}\s)")  # matches "x yyyy-mm-dd"
-    completed = re.findall(comp_pattern, line)
 
-    # Check for projects (+something)
-    proj_pattern = re.compile(r".*\s*(\+\w+)\s.*")
-    projects = re.findall(proj_pattern, line)  # returns a list
+def print_by_priority(tasks, page=None):
+    """
+    Prints tasks from a list, by priority if they have it,
+    and alphabetically if they don't.
+    Only the page (limit, offset) is printed, by default the one
+    set with --limit and --offset. Returns how many were printed.
+    """
+    limit, offset = page or (LIMIT, OFFSET)
+    ordered = order_tasks(tasks, limit, offset)
+    for item in ordered:
+        print_task(item)
+    return len(ordered)
+
+
+def print_task(item, label=''):
+    """
+    Prints a task with its number after label, colored by priority
+    """
+    task = label + "{:02d}".format(item.num) + " " + item.content
+    if not item.priority:
+        print(task, end='')
+    # use colors for priorities
+    elif item.priority == 'A':
+        print(colors.YELLOW + colors.BOLD + task + colors.ENDC, end='')
+    elif item.priority == 'B':
+        print(colors.GREEN + colors.BOLD + task + colors.ENDC, end='')
+    elif item.priority == 'C':
+        print(colors.BLUE + colors.BOLD + task + colors.ENDC, end='')
+    else:
+        print(colors.BOLD + task + colors.ENDC, end='')
+
+
+RECORD_FIELDS = ('file', 'number', 'priority', 'done', 'projects',
+                 'contexts', 'tags', 'content')
+
+
+def task_records(tasks, file_name):
+    """
+    Yields a dict with the RECORD_FIELDS of each task of file_name,
+    one at a time
+    """
+    for task in tasks:
+        yield {'file': file_name, 'number': task.num,
+               'priority': task.priority or None, 'done': task.done,
+               'projects': task.projects, 'contexts': task.contexts,
+               'tags': task.tags, 'content': task.content.rstrip('\n')}
+
+
+def print_records(sources):
+    """
+    Prints the tasks of (file name, tasks) sources as FORMAT records
+    in file order, as they come, so that only one task at a time is
+    held. Only the page set with --limit and --offset is printed.
+    Returns how many were printed.
+    """
+    records = (record for file_name, tasks in sources
+               for record in task_records(tasks, file_name))
+    stop = None if LIMIT is None else OFFSET + LIMIT
+    return write_records(itertools.islice(records, OFFSET, stop),
+                         RECORD_FIELDS)
 
-    # Check for contexts (@somewhere)
-    con_pattern = re.compile(r".*\s*(\@\w+)\s.*")
-    contexts = re.findall(con_pattern, line)
 
-    content = str(line)
-    if priority:
-        task = Task(number, content, priority.group(1), projects, contexts, completed)
+def write_records(records, fields):
+    """
+    Writes dict records to stdout as FORMAT: a JSON array, NDJSON,
+    or CSV with fields as header and lists and dicts joined by spaces.
+    Returns how many were written.
+    """
+    out = sys.stdout
+    shown = 0
+    if FORMAT == 'csv':
+        import csv
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(fields)
+        for record in records:
+            row = []
+            for field in fields:
+                value = record[field]
+                if isinstance(value, dict):
+                    value = ' '.join(key + ':' + str(item)
+                                     for key, item in value.items())
+                elif isinstance(value, list):
+                    value = ' '.join(value)
+                row.append(value)
+            writer.writerow(row)
+            shown += 1
+    elif FORMAT == 'json':
+        import json
+        out.write('[')
+        for record in records:
+            out.write(',\n' if shown else '\n')
+            out.write(json.dumps(record))
+            shown += 1
+        out.write('\n]\n')
     else:
-        task = Task(number, content, priority, projects, contexts, completed)
+        import json
+        for record in records:
+            out.write(json.dumps(record) + '\n')
+            shown += 1
+    return shown
 
-    return task
 
+class Query:
+    """
+    Search terms compiled once for all the tasks:
+      WORD                    tasks containing WORD
+      +PROJECT, @CONTEXT      tasks in PROJECT, or CONTEXT
+      pri:X, pri:X-Y          tasks prioritized X, or X to Y
+      done:true, done:false   done tasks, or pending ones
+      done:DATE, done:DATE..DATE
+                              tasks completed on DATE, or in between;
+                              DATE is yyyy, yyyy-mm or yyyy-mm-dd
+      re:/REGEX/, re:/REGEX/i tasks matching REGEX, or ignoring case
+    Tasks must match all the terms. A term preceded by '-' excludes
+    the tasks it would match.
+    """
+    def __init__(self, terms):
+        self.words = []  # (word, negated)
+        self.names = []  # (+project or @context, negated)
+        self.priorities = []  # (first, last, negated)
+        self.done = []  # done states required
+        self.completed = []  # (first, last, negated) completion dates
+        self.regexes = []  # (compiled regex, negated)
+        for term in terms:
+            negated = term[:1] == '-'
+            if negated:
+                term = term[1:]
+            if term.startswith('pri:'):
+                priorities = re.fullmatch(r'([A-Z])(?:-([A-Z]))?', term[4:])
+                if not priorities:
+                    raise ValueError("Invalid priority range " + term)
+                first, last = priorities.groups()
+                self.priorities.append((first, last or first, negated))
+            elif term.startswith('done:'):
+                dates = re.fullmatch(r'({0})(?:\.\.({0}))?'.format(
+                    r'\d{4}(?:-\d{2}(?:-\d{2})?)?'), term[5:])
+                if dates:
+                    first, last = dates.groups()
+                    self.completed.append((first, last or first, negated))
+                elif term[5:] in ('true', 'false'):
+                    self.done.append((term[5:] == 'true') != negated)
+                else:
+                    raise ValueError("done: takes true, false or dates, not " +
+                                     term[5:])
+            elif term.startswith('re:'):
+                pattern = re.fullmatch(r'/(.*)/(i?)', term[3:], re.DOTALL)
+                if not pattern:
+                    raise ValueError("Regular expressions go as re:/REGEX/")
+                flags = re.IGNORECASE if pattern.group(2) else 0
+                try:
+                    regex = re.compile(pattern.group(1), flags)
+                except re.error as error:
+                    raise ValueError("Invalid regular expression " +
+                                     pattern.group(1) + ": " + str(error))
+                self.regexes.append((regex, negated))
+            elif term[:1] in ('+', '@') and len(term) > 1:
+                self.names.append((term, negated))
+            else:
+                self.words.append((term, negated))
 
-def write_tasks(task_list, file='todo.txt', mode='w'):
+    def matches(self, task):
+        """
+        Returns True if task matches every term, checking the fields
+        first and the regexes last
+        """
+        priority = task.priority or '\0'
+        for low, high, negated in self.priorities:
+            if (low <= priority <= high) == negated:
+                return False
+        for state in self.done:
+            if bool(task.done) != state:
+                return False
+        for first, last, negated in self.completed:
+            if (bool(task.done) and
+                    date_in_range(task.done, first, last)) == negated:
+                return False
+        for name, negated in self.names:
+            names = task.projects if name[0] == '+' else task.contexts
+            if (name in names) == negated:
+                return False
+        content = task.content
+        for term, negated in self.words:
+            if (term in content) == negated:
+                return False
+        for regex, negated in self.regexes:
+            if bool(regex.search(content)) == negated:
+                return False
+        return True
+
+
+def date_in_range(date, first, last):
     """
-    Rewrites the todo file with updated tasks
+    Checks if a yyyy-mm-dd date is between the dates first and last,
+    which may lack the day or the month
     """
-    file_path = get_file_dir(file)
-    with open(file_path, mode) as f:
-        for task in task_list:
-            f.write(task.content)
+    return first <= date[:len(first)] and date[:len(last)] <= last
 
 
-def print_by_priority(tasks):
+def combine_postings(lookups, line_cost):
     """
-    Prints tasks from a list, by priority if they have it,
-    and alphabetically if they don't.
+    Combines index lookups, (negated, size, term, lists of rows, checks)
+    tuples, the rarest included terms first. A term much more common
+    than the rows found so far is appended to its checks instead.
+    Returns the set of rows found, None if nothing was included, and
+    the set of excluded rows when nothing was found.
     """
-    # sort all tasks alphabetically first
-    alpha_sorted = sorted(tasks, key=operator.attrgetter('content'))
-
-    # make a list of items with priority and one of items without it
-    with_pr = []
-    without_pr = []
-    for item in alpha_sorted:
-        if item.priority == '':
-            without_pr.append(item)
-        else:
-            with_pr.append(item)
-
-    # sort the list of items with priority
-    pr_sorted = sorted(with_pr, key=operator.attrgetter('priority'))
-    # update the alphabetically sorted list without items with priority
-    alpha_sorted = sorted(without_pr, key=operator.attrgetter('content'))
-
-    # Print items with priority first
-    for item in pr_sorted:
-        # use colors for priorities
-        task = "{:02d}".format(item.num) + " " + item.content
-        if item.priority == 'A':
-            print(colors.YELLOW + colors.BOLD + task + colors.ENDC, end='')
-        elif item.priority == 'B':
-            print(colors.GREEN + colors.BOLD + task + colors.ENDC, end='')
-        elif item.priority == 'C':
-            print(colors.BLUE + colors.BOLD + task + colors.ENDC, end='')
+    found = None
+    excluded = set()
+    for negated, size, term, lists, checks in sorted(
+            lookups, key=operator.itemgetter(0, 1)):
+        if found is not None and size > line_cost * len(found):
+            checks.append((term, negated))
+        elif negated:
+            for rows in lists:
+                if found is None:
+                    excluded.update(rows)
+                else:
+                    found.difference_update(rows)
+        elif found is None:
+            found = set()
+            for rows in lists:
+                found.update(rows)
         else:
-            print(colors.BOLD + task + colors.ENDC, end='')
+            found = set().union(*[found.intersection(rows) for rows in lists])
+    return found, excluded
+
 
-    # Print items without priority alphabetically sorted
-    for item in alpha_sorted:
-        print("{:02d}".format(item.num), item.content, end='')
+def iter_keyword_matches(tasks, terms):
+    """
+    Returns an iterator over the tasks that match all the terms given,
+    see Query for their syntax. If a term starts with '-' the tasks
+    matching that term will be ignored. A TaskTable answers from its
+    index.
+    """
+    try:
+        query = Query(terms)
+    except ValueError as error:
+        print("TODO:", error)
+        sys.exit(1)
+    if isinstance(tasks, (TaskTable, ArchiveIndex, SegmentedArchive)):
+        return tasks.match(query)
+    return (task for task in tasks if query.matches(task))
 
 
 def match_keyword_arguments(tasks, terms):
     """
-    Makes a list with the tasks that matched the terms given.
-    If a term starts with '-' the tasks containing that term will
-    be ignored.
+    Makes a list with the tasks that match all the terms given
     """
-    matching = []
-    if len(terms) > 0:
-        found = 0
-        for task in tasks:
-            for x in range(arg+1, len(sys.argv)):
-                # Don't print tasks if the term starts with '-'
-                term = sys.argv[x]
-                if term[0] == '-':
-                    if term[1:] in task.content:
-                        break
-                    else:
-                        matching.append(task)
-                else:
-                    if term in task.content:
-                        matching.append(task)
-                        break
-    return matching
+    return list(iter_keyword_matches(tasks, terms))
 
 
 def check_word_arguments(argv, error_msg=None):
@@ -315,6 +3320,23 @@ def check_int_arguments(argv, error_msg):
     return arguments
 
 
+def item_numbers(text):
+    """
+    Returns the sorted task numbers of a list like 3,7,12-40,
+    or None if text isn't one
+    """
+    numbers = set()
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        if not first.isdigit() or not (last or first).isdigit():
+            return None
+        first, last = int(first), int(last or first)
+        if first < 1 or last < first:
+            return None
+        numbers.update(range(first, last + 1))
+    return sorted(numbers)
+
+
 # TODO.py functions
 def add_task(task=None):
     """
@@ -324,13 +3346,27 @@ def add_task(task=None):
       Project and context notation optional.
       Quotes optional.
     """
-    file_path = get_file_dir()
     if not task:
-        item = str(sys.argv[arg+1]) + '\n'
-    else:
-        item = task + '\n'
+        task = str(sys.argv[arg+1])
+    append_tasks([task])
+
+
+def append_tasks(items):
+    """
+    Adds lines to the end of todo.txt with one write, or in one batch
+    of its journal
+    """
+    file_path = get_file_dir()
+    if DEFER_WRITES:
+        for item in items:
+            current_tasks.append(parse_task(item + '\n',
+                                            len(current_tasks) + 1))
+        return
+    if USE_JOURNAL or os.path.exists(journal_path(file_path)):
+        append_journal(file_path, [['A ' + item for item in items]])
+        return
     with open(file_path, 'a') as f:
-        f.write(item)
+        f.write(''.join(item + '\n' for item in items))
 
 
 def add_multiple_tasks():
@@ -339,13 +3375,21 @@ def add_multiple_tasks():
       Adds FIRST THING I NEED TO DO to your todo.txt on its own line and
       Adds SECOND THING I NEED TO DO to you todo.txt on its own line.
       Project and context notation optional.
+      The tasks are written at once after an empty line or the end of
+      the input.
     """
+    tasks = []
     while True:
-        task = str(input("Add: "))
+        try:
+            task = str(input("Add: "))
+        except EOFError:
+            task = ""
         if task == "":
-            sys.exit(0)
-        else:
-            add_task(task)
+            break
+        tasks.append(task)
+    if tasks:
+        append_tasks(tasks)
+    sys.exit(0)
 
 def add_to_file():
     """
@@ -356,7 +3400,10 @@ def add_to_file():
     error_msg = 'usage: todo.py addto DEST "TODO ITEM"'
     arguments = check_word_arguments(sys.argv, error_msg)
     file = get_file_dir(arguments[0])
-    if len(arguments) == 2:
+    if len(arguments) == 2 and file == get_file_dir('done.txt'):
+        # Archived like done tasks, written with todo.txt when deferred
+        archive_done([Task(0, arguments[1] + '\n')])
+    elif len(arguments) == 2:
         with open(file, 'a') as f:
             f.write(arguments[1])
             f.write("\n")
@@ -364,6 +3411,111 @@ def add_to_file():
         print(error_msg)
         sys.exit(1)
 
+
+# Bytes of imported tasks written to todo.txt at a time
+IMPORT_CHUNK = 1 << 20
+CONTROL_CHARACTERS = re.compile(r'[\x00-\x1f\x7f]')
+
+
+def import_line(line, today=None):
+    """
+    Returns a line to import as a task with its whitespace normalized
+    and its priority in upper case, and today's date as creation date
+    if today is given and it has none. None if there's no task in it.
+    """
+    line = ' '.join(line.split())
+    if not line or CONTROL_CHARACTERS.search(line):
+        return None
+    if re.match(r'\([a-z]\) ', line):
+        line = line[:3].upper() + line[3:]
+    priority, completed = line_prefix(line + ' ')
+    if today and not completed:
+        start = 4 if priority else 0
+        if not is_date(line[start:start + 10]):
+            line = line[:start] + today + ' ' + line[start:]
+    return line
+
+
+def import_tasks():
+    """
+    import FILE|- [date] [dedup]
+      Adds the lines of FILE, or of the standard input with -, to
+      todo.txt as tasks, their whitespace normalized. Blank lines and
+      lines with control characters are skipped. With date, the tasks
+      without a creation date get today's. With dedup, the tasks
+      already in todo.txt, or read before, are skipped; priorities and
+      dates don't tell tasks apart.
+    """
+    error_msg = "usage: todo.py import FILE|- [date] [dedup]"
+    arguments = check_word_arguments(sys.argv, error_msg)
+    options = arguments[1:]
+    if any(option not in ('date', 'dedup') for option in options):
+        print(error_msg)
+        sys.exit(1)
+    if arguments[0] == '-':
+        source = getattr(sys.stdin, 'buffer', None) or \
+            io.BytesIO(sys.stdin.read().encode('utf-8'))
+    elif os.path.isfile(arguments[0]):
+        source = open(arguments[0], 'rb')
+    else:
+        print("TODO: File {0} does not exist.".format(arguments[0]))
+        sys.exit(1)
+    today = None
+    if 'date' in options:
+        from datetime import date
+        today = date.today().isoformat()
+
+    file_path = get_file_dir()
+    seen = None
+    if 'dedup' in options:
+        tasks = load_tasks(file_path)
+        seen = {line_digest(tasks.line(row), True) for row in tasks.order}
+    # Straight to the file, unless the lines go to the journal or the
+    # tasks of a shell
+    deferred = DEFER_WRITES or USE_JOURNAL or \
+        os.path.exists(journal_path(file_path))
+    items, chunk, size = [], [], 0
+    imported = duplicates = skipped = 0
+    with contextlib.ExitStack() as stack:
+        if arguments[0] != '-':
+            stack.enter_context(source)
+        if not deferred:
+            todo = stack.enter_context(open(file_path, 'ab+'))
+            if todo.tell():
+                todo.seek(-1, os.SEEK_END)
+                if todo.read(1) != b'\n':
+                    chunk.append(b'\n')  # Last line without a newline
+        for raw in source:
+            line = import_line(decode_line(raw), today)
+            if line is None:
+                skipped += 1
+                continue
+            if seen is not None:
+                digest = line_digest(line, True)
+                if digest in seen:
+                    duplicates += 1
+                    continue
+                seen.add(digest)
+            imported += 1
+            if deferred:
+                items.append(line)
+                continue
+            data = (line + '\n').encode('utf-8')
+            chunk.append(data)
+            size += len(data)
+            if size >= IMPORT_CHUNK:
+                todo.write(b''.join(chunk))
+                chunk, size = [], 0
+        if not deferred:
+            todo.write(b''.join(chunk))
+            todo.flush()
+            os.fsync(todo.fileno())
+    if items:
+        append_tasks(items)
+    print("TODO: {0} task(s) imported, {1} duplicate(s) and {2} blank or "
+          "invalid line(s) skipped.".format(imported, duplicates, skipped))
+
+
 def append_to_task():
     """
     append ITEM# "TEXT TO APPEND"
@@ -379,7 +3531,7 @@ def append_to_task():
         sys.exit(1)
     TEXT = sys.argv[arg+2]
     appended = False
-    for task in current_tasks:
+    for task in current_tasks.with_number(item_number):
         if task.num == item_number:
             task.content = task.content.replace('\n', '')
             task.content += " " + TEXT + '\n'
@@ -395,45 +3547,120 @@ def append_to_task():
 
 def archive_tasks():
     """
-    archive
+    archive [rotate]
       Moves all done tasks from todo.txt to done.txt and removes blank lines.
+      With rotate, the done tasks of done.txt are moved into monthly
+      compressed segments in the done directory, where archived tasks
+      go from then on.
     """
+    if 'rotate' in check_word_arguments(sys.argv):
+        rotate_archive()
     done_tasks = []
-    for task in current_tasks:
-        if task.content == '':
-            current_tasks.remove(task)
+    # Backwards, so that removing a task doesn't skip the next one
+    for index in range(len(current_tasks) - 1, -1, -1):
+        task = current_tasks[index]
+        if task.content.strip() == '':
+            current_tasks.pop(index)
         elif task.done:
             done_tasks.append(task)
-            current_tasks.remove(task)
+            current_tasks.pop(index)
+    done_tasks.reverse()
     write_tasks(current_tasks)
-    write_tasks(done_tasks, 'done.txt', 'a')
+    archive_done(done_tasks)
 
 
-def remove_duplicates():
+def compact_journal():
     """
-    deduplicate
-      Removes duplicate lines from todo.txt.
+    compact
+      Folds the journal of changes back into todo.txt.
     """
+    global USE_JOURNAL
     file_path = get_file_dir()
+    if not os.path.exists(journal_path(file_path)):
+        print("TODO: No journal to compact")
+        return
+    USE_JOURNAL = False
+    write_tasks(current_tasks)
+    print("TODO: Journal folded into " + file_path)
+
+
+def normalized_line(line):
+    """
+    Returns line without its completion mark, priority and creation
+    date, with its words one space apart, to find near duplicates
+    """
+    words = line.split()
+    if words[:1] == ['x'] and len(words) > 1 and is_date(words[1]):
+        words = words[2:]
+    elif words and re.fullmatch(r'\([A-Z]\)', words[0]):
+        words = words[1:]
+    if words and is_date(words[0]):
+        words = words[1:]
+    return ' '.join(words)
+
+
+def line_digest(line, normalize=False):
+    """
+    Returns a digest of 8 bytes standing for line in duplicate checks,
+    chances are about one in 10^7 that two of 10^6 lines share one
+    """
+    import hashlib
+    key = normalized_line(line) if normalize else line.rstrip()
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+
 
-    # Read the todo.txt file, make a list without duplicates
-    with open(file_path, 'r') as f:
-        lines = (line.rstrip() for line in f)
-        unique_lines = OrderedDict.fromkeys((line for line in lines if line))
-    deduplicated_list = unique_lines.keys()
+def done_lines():
+    """
+    Yields the lines of done.txt and of the segments of done tasks
+    """
+    if os.path.exists(get_file_dir('done.txt')):
+        done_file = TaskFile(get_file_dir('done.txt'))
+        for _, raw in iter_raw_lines(done_file.buffer):
+            yield decode_line(raw)
+    segments = load_segments()
+    if segments:
+        for segment in segments.segments:
+            yield from segment.lines()
 
-    # Count deleted lines
-    count_original = len(current_tasks)
-    count_deduplicated = len(deduplicated_list)
-    total = count_original - count_deduplicated
 
-    # Write the list back to the file
-    write_tasks(deduplicated_list)
+def remove_duplicates():
+    """
+    deduplicate [normalize] [done]
+      Removes duplicate lines from todo.txt.
+      With normalize, lines that only differ in whitespace, priority,
+      completion mark or creation date are duplicates too. With done,
+      the tasks already in done.txt are removed as well: its lines are
+      compared without their completion mark. Blank lines stay.
+    """
+    options = check_word_arguments(sys.argv)
+    normalize = 'normalize' in options
+
+    # Digests of the lines seen so far, never the lines themselves
+    seen = set()
+    if 'done' in options:
+        for line in done_lines():
+            if line_prefix(line)[1]:
+                line = line[13:]  # Without "x yyyy-mm-dd "
+            if line.strip():
+                seen.add(line_digest(line, normalize))
+    removed = set()
+    for task in current_tasks:
+        line = task.content
+        if not line.strip():
+            continue
+        digest = line_digest(line, normalize)
+        if digest in seen:
+            removed.add(task.row)
+        else:
+            seen.add(digest)
 
-    if total == 0:
+    if not removed:
         print("TODO: No duplicate tasks found")
-    else:
-        print(total, "duplicate task(s) removed")
+        return
+    # The tasks left are written at once, their lines copied as they are
+    current_tasks.discard(removed)
+    write_tasks(current_tasks)
+    print(len(removed), "duplicate task(s) removed")
 
 
 def remove_task():
@@ -451,11 +3678,11 @@ def remove_task():
         print("usage: todo.py del ITEM# [TERM]")
         sys.exit(1)
 
-    for task in current_tasks:
+    for task in current_tasks.with_number(number):
         if task.num == number:
             content = task.content.replace('\n', '')
             input_prompt = "Delete '" + content + "'?  (y/n)\n"
-            confirm = input(input_prompt)
+            confirm = 'y' if FORCE else input(input_prompt)
             if confirm == 'y':
                 current_tasks.remove(task)
                 print(task.num, content)
@@ -520,7 +3747,7 @@ def mark_done():
             sys.exit(1)
 
     write_tasks(current_tasks)
-    write_tasks(done_tasks, 'done.txt', 'a')
+    archive_done(done_tasks)
     file_path = get_file_dir('todo.txt')
     print("TODO: " + file_path + " archived.")
 
@@ -533,23 +3760,36 @@ def list_tasks(tasks=None):
       numbers.  Each task must match all TERM(s) (logical AND).
       Hides all tasks that contain TERM(s) preceded by a
       minus sign (i.e. -TERM). If no TERM specified, lists entire todo.txt.
+      TERM can also be +PROJECT, @CONTEXT, pri:A-C, done:false or
+      re:/REGEX/ (see help).
     """
     if not tasks:
         tasks = current_tasks
+    show_listing('todo.txt', tasks, check_word_arguments(sys.argv))
+
+
+def show_listing(file_name, tasks, terms):
+    """
+    Prints the tasks of file_name containing terms by priority,
+    or as FORMAT records
+    """
     n_items = len(tasks)
 
     # Show items containing terms
-    terms = check_word_arguments(sys.argv)
-    if len(terms) > 0:
+    if FORMAT:
+        if terms:
+            tasks = iter_keyword_matches(tasks, terms)
+        print_records([(file_name, tasks)])
+    elif len(terms) > 0:
         matching = match_keyword_arguments(tasks, terms)
-        print_by_priority(matching)
+        shown = print_by_priority(matching)
         print("--")
-        print("TODO:", len(matching), "of", n_items, "tasks shown")
+        print("TODO:", shown, "of", n_items, "tasks shown")
     # else print all of them
     else:
-        print_by_priority(tasks)
+        shown = print_by_priority(tasks)
         print("--")
-        print("TODO:", n_items, "of", n_items, "tasks shown")
+        print("TODO:", shown, "of", n_items, "tasks shown")
 
 
 def list_all():
@@ -561,56 +3801,85 @@ def list_all():
       contain TERM(s) preceded by a minus sign (i.e. -TERM).  If no
       TERM specified, lists entire todo.txt AND done.txt
       concatenated and sorted.
-
+      Done tasks rotated into segments are listed after done.txt.
     """
     done = get_file_dir('done.txt')
     tasks = current_tasks
-    done_tasks = parse_todo_file(done)
     terms = check_word_arguments(sys.argv)
 
-    if len(terms) > 0:
-        matching = match_keyword_arguments(tasks, terms)
-        matching_done = match_keyword_arguments(done_tasks, terms)
-        print_by_priority(matching)
-        print_by_priority(matching_done)
-        print("--")
-        print("TODO:", len(matching), "of", len(tasks), "tasks shown")
-        print("DONE:", len(matching_done), "of", len(done_tasks), "tasks shown")
+    # Only the lines of done.txt that match are read, and only the
+    # segments whose header allows a match
+    done_tasks = load_archive(done) if terms else load_tasks(done)
+    sources = [('todo.txt', tasks), ('done.txt', done_tasks)]
+    segments = load_segments(len(done_tasks) + 1)
+    if segments:
+        sources.append((SEGMENTS_DIR, segments))
+    if terms:
+        sources = [(name, iter_keyword_matches(source, terms))
+                   for name, source in sources]
+    if FORMAT:
+        print_records(sources)
+        return
+    if len(sources) > 2 or terms:
+        matching_done = [task for _, source in sources[1:]
+                         for task in source]
     else:
-        print_by_priority(tasks)
-        print_by_priority(done_tasks)
-        print("--")
-        print("TODO:", len(tasks), "of", len(tasks), "tasks shown")
-        print("DONE:", len(done_tasks), "of", len(done_tasks), "tasks shown")
+        matching_done = done_tasks
+    matching = list(sources[0][1]) if terms else tasks
+    # One listing, the page can go on from todo.txt into done.txt
+    shown = print_by_priority(matching)
+    shown_done = print_by_priority(matching_done,
+                                   following_page(len(matching), shown))
+    print("--")
+    print("TODO:", shown, "of", len(tasks), "tasks shown")
+    print("DONE:", shown_done, "of",
+          len(done_tasks) + len(segments or ()), "tasks shown")
 
 
 def list_contexts():
     """
     listcon [TERM...]
     lsc [TERM...]
-      Lists all the task contexts that start with the @ sign in todo.txt.
+      Lists all the task contexts that start with the @ sign in todo.txt,
+      with the number of open and done tasks in each.
       If TERM specified, considers only tasks that contain TERM(s).
     """
-    tasks_with_context = []
-    contexts = []
-    for item in current_tasks:
-        if len(item.contexts) > 0:
-            tasks_with_context.append(item)
-
     terms = check_word_arguments(sys.argv)
-    if len(terms) > 0:
-        matching = match_keyword_arguments(tasks_with_context, terms)
-        for task in matching:
-            for context in task.contexts:
-                contexts.append(context)
+    if FORMAT:
+        # The records of the tasks the contexts come from
+        tasks = iter_keyword_matches(current_tasks, terms) if terms \
+            else current_tasks
+        print_records([('todo.txt', (task for task in tasks
+                                     if task.contexts))])
+    else:
+        print_name_counts(terms, '@')
+
+
+def print_name_counts(terms, sigil):
+    """
+    Prints the projects (sigil '+') or contexts (sigil '@') of the
+    tasks matching terms with their open and done counts. Without
+    terms the counts kept for todo.txt are used, no task is read.
+    """
+    if terms:
+        counts = {}
+        for task in iter_keyword_matches(current_tasks, terms):
+            names = task.projects if sigil == '+' else task.contexts
+            for name in set(names):
+                pair = counts.setdefault(name, [0, 0])
+                pair[1 if task.done else 0] += 1
     else:
-        for task in tasks_with_context:
-            for context in task.contexts:
-                contexts.append(context)
+        counts = current_tasks.counters()
+    for name in sorted(counts):
+        if name[:1] == sigil:
+            print_count(name, counts[name])
+
 
-    contexts = list(set(contexts))  # Remove duplicates
-    for context in contexts:
-        print(context)
+def print_count(name, count):
+    """
+    Prints the (open, done) count of name
+    """
+    print(name, count[0], "open,", count[1], "done")
 
 
 def list_files():
@@ -622,13 +3891,34 @@ def list_files():
       all lines that contain TERM(s) in SRC file.  Hides all tasks that
       contain TERM(s) preceded by a minus sign (i.e. -TERM).
       Without any arguments, the names of all text files in the todo.txt
-      directory are listed.
+      directory are listed, with their size, line count and whether
+      they were parsed since they last changed.
     """
-    dir_path = Path(PATH)
-    files_list = list(dir_path.glob('**/*.txt'))  # List all .txt files
-    print("Files in the todo.txt directory:")
-    for file_name in files_list:
-        print(file_name)
+    catalog = Catalog(PATH)
+    catalog.refresh()
+    catalog.save()
+    words = check_word_arguments(sys.argv)
+    if not words:
+        if FORMAT:
+            write_records(({'file': name, 'size': record['size'],
+                            'lines': record['lines'],
+                            'state': catalog.state(name)}
+                           for name, record in sorted(catalog.files.items())),
+                          ('file', 'size', 'lines', 'state'))
+            return
+        print("Files in the todo.txt directory:")
+        for name, record in sorted(catalog.files.items()):
+            print("{0}: {1} lines, {2} bytes, {3}".format(
+                name, record['lines'], record['size'], catalog.state(name)))
+        return
+
+    name = catalog.find(words[0])
+    if name is None:
+        print("TODO: No file", words[0], "in the todo.txt directory")
+        sys.exit(1)
+    # Read as todo.txt is, through its cache, index and journal
+    tasks = load_tasks(os.path.join(PATH, name))
+    show_listing(name, tasks, words[1:])
 
 
 def list_priorities():
@@ -642,126 +3932,180 @@ def list_priorities():
       Hides all tasks that contain TERM(s) preceded by a minus sign
       (i.e. -TERM).
     """
-    tasks_with_priority = []
-    for item in current_tasks:
-        if item.priority != '':
-            tasks_with_priority.append(item)
+    matching = priority_matches(current_tasks,
+                                check_word_arguments(sys.argv))
+    if FORMAT:
+        print_records([('todo.txt', matching)])
+        return
+    shown = print_by_priority(matching)
+    print("TODO:", shown, "of", len(current_tasks), "tasks shown")
+
+
+def priority_matches(tasks, terms):
+    """
+    Returns the prioritized tasks of a TaskTable matching terms
+    """
+    # A priority (X) or a range (X-Y) comes first
+    selected = re.match(r"\(([A-Z])(?:-([A-Z]))?\)", terms[0]) \
+        if terms else None
+    if selected:
+        first, last = selected.groups()
+        return tasks.prioritized(first, last or first)
+    if terms:
+        return (task for task in iter_keyword_matches(tasks, terms)
+                if task.priority)
+    return tasks.prioritized()
+
+
+def term_matches(tasks, terms):
+    """
+    Returns the tasks matching terms, all of them without terms
+    """
+    return iter_keyword_matches(tasks, terms) if terms else tasks
+
 
+def directory_matches(directory, select, terms):
+    """
+    Returns the tasks of the todo.txt of directory that select keeps
+    for terms, and how many tasks it has, or None if it has no
+    todo.txt. They are in listing order up to the end of the page, or
+    in file order for FORMAT records.
+    """
+    file_path = os.path.join(directory, 'todo.txt')
+    if not os.path.exists(file_path):
+        return None
+    # The directory may not be ours to write: its lock is only shared
+    # if a writer created it and it can be read
+    try:
+        lock = open(os.path.join(directory, '.todo.lock'), 'rb')
+    except OSError:
+        lock = None
+    try:
+        if lock is not None and fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        tasks = load_tasks(file_path)
+        matching = select(tasks, terms)
+        stop = None if LIMIT is None else OFFSET + LIMIT
+        if FORMAT:
+            return list(itertools.islice(matching, stop)), len(tasks)
+        return order_tasks(matching, stop), len(tasks)
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+def list_directories(user_action, directories):
+    """
+    Runs a listing action over the todo.txt of several directories.
+    Each directory is searched in a thread, then their tasks are
+    listed together by priority, each after its directory. The
+    directories without a todo.txt are skipped with a warning.
+    """
+    select = FEDERATED_ACTIONS.get(user_action)
+    if select is None:
+        print("TODO: Only ls and listpri run on several directories.")
+        sys.exit(1)
     terms = check_word_arguments(sys.argv)
-    if len(terms) > 0:
-        # Specific priority regex
-        specific_pr = re.compile(r"\(([A-Z])\)")  # Matches (X)
-        pr_char = specific_pr.match(terms[0])
-        if pr_char:
-            pr_char = pr_char.group(1)
-
-        # Specific range of priorities regex
-        pr_range = re.compile(r"\(([A-Z])-([A-Z])\)")  # Matches (X-X)
-        start_char = pr_range.match(terms[0])  # Range start
-        if start_char:
-            start_char = ord(start_char.group(1))
-        end_char = pr_range.match(terms[0])  # Range end
-        if end_char:
-            end_char = ord(end_char.group(2))
-
-        # Check if user specified a priority
-        if pr_char is not None:
-            matching = []
-            for task in current_tasks:
-                if task.priority == pr_char:
-                    matching.append(task)
-            print_by_priority(matching)
-            print("TODO:", len(matching), "of",
-                  len(current_tasks), "tasks shown")
-        # Check if user specified a priority range
-        elif start_char is not None:
-            matching = []
-            for task in current_tasks:
-                for c in range(start_char, end_char + 1):
-                    if task.priority == chr(c):
-                        matching.append(task)
-            print_by_priority(matching)
-            print("TODO:", len(matching), "of",
-                  len(current_tasks), "tasks shown")
-        # else print if they match the terms
+    # The threads are the parallelism, a thread mustn't fork processes
+    global JOBS
+    JOBS = 1
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(min(32, len(directories))) as pool:
+        results = list(pool.map(directory_matches, directories,
+                                itertools.repeat(select),
+                                itertools.repeat(terms)))
+    read = []  # (directory, (tasks, count)) of the directories read
+    for directory, result in zip(directories, results):
+        if result is not None:
+            read.append((directory, result))
+        elif not os.path.isdir(directory):
+            print("TODO: Directory {0} does not exist, skipped.".format(
+                directory), file=sys.stderr)
         else:
-            matching = match_keyword_arguments(tasks_with_priority, terms)
-            print_by_priority(matching)
-            print("TODO:", len(matching), "of",
-                  len(current_tasks), "tasks shown")
-    else:
-        print_by_priority(tasks_with_priority)
-        print("TODO:", len(tasks_with_priority), "of",
-              len(current_tasks), "tasks shown")
+            print("TODO: No todo.txt in {0}, skipped.".format(directory),
+                  file=sys.stderr)
+    if FORMAT:
+        print_records([(os.path.join(directory, 'todo.txt'), matching)
+                       for directory, (matching, _) in read])
+        return
+    labeled = [[(directory, task) for task in matching]
+               for directory, (matching, _) in read]
+    ordered = heapq.merge(*labeled, key=lambda labeled_task: (
+        priority_order(labeled_task[1].priority), labeled_task[1].content))
+    stop = None if LIMIT is None else OFFSET + LIMIT
+    shown = 0
+    for directory, task in itertools.islice(ordered, OFFSET, stop):
+        print_task(task, directory + ': ')
+        shown += 1
+    print("--")
+    print("TODO:", shown, "of", sum(count for _, (_, count) in read),
+          "tasks shown in", len(read), "directories")
+
 
 def list_projects():
     """
     listproj [TERM...]
     lsprj [TERM...]
       Lists all the projects (terms that start with a + sign) in
-      todo.txt.
+      todo.txt, with the number of open and done tasks in each.
       If TERM specified, considers only tasks that contain TERM(s).
     """
-    tasks_with_projects = []
-    for item in current_tasks:
-        if item.projects != '':
-            tasks_with_projects.append(item)
-
     terms = check_word_arguments(sys.argv)
-    if len(terms) > 0:
-        matching = match_keyword_arguments(tasks_with_projects, terms)
-        print_by_priority(matching)
-        print("TODO:", len(matching), "of", len(current_tasks), "tasks shown")
+    if FORMAT:
+        # The records of the tasks the projects come from
+        tasks = iter_keyword_matches(current_tasks, terms) if terms \
+            else current_tasks
+        print_records([('todo.txt', (task for task in tasks
+                                     if task.projects))])
     else:
-        print_by_priority(tasks_with_projects)
-        print("TODO:", len(tasks_with_projects), "of", len(current_tasks),
-              "tasks shown")
+        print_name_counts(terms, '+')
 
 
 def move_task():
     """
-    move ITEM# DEST [SRC]
-    mv ITEM# DEST [SRC]
-      Moves a line from source text file (SRC) to destination text file (DEST).
+    move ITEM#[,ITEM#|ITEM#-ITEM#...] DEST [SRC]
+    mv ITEM#[,ITEM#|ITEM#-ITEM#...] DEST [SRC]
+      Moves lines from source text file (SRC) to the end of destination
+      text file (DEST), e.g. mv 3,7,12-40 someday.txt.
       Both source and destination file must be located in the directory defined
       in the configuration directory. When SRC is not defined
-      it's by default todo.txt.
+      it's by default todo.txt. Both files are changed or neither is.
     """
-    error_msg = "TODO: Destination file " + PATH + "does not exist."
-    terms = check_word_arguments(sys.argv)
-    if len(terms) >= 2:
-        # Get argument values
-        try:
-            number = int(terms[0])
-            dest = terms[1]
-        except ValueError:
-            print(error_msg)
+    error_msg = "usage: todo.py mv ITEM#[,ITEM#|ITEM#-ITEM#...] DEST [SRC]"
+    terms = check_word_arguments(sys.argv, error_msg)
+    numbers = item_numbers(terms[0])
+    if len(terms) not in (2, 3) or numbers is None:
+        print(error_msg)
+        sys.exit(1)
+    src = terms[2] if len(terms) == 3 else 'todo.txt'
+    src_path = os.path.join(PATH, src)
+    dest_path = os.path.join(PATH, terms[1])
+    for name, path in (('Source', src_path), ('Destination', dest_path)):
+        if not os.path.isfile(path):
+            print("TODO: {0} file {1} does not exist.".format(name, path))
             sys.exit(1)
-        # Check for specific source
-        if len(terms) == 3:
-            src = terms[2]
-        else:
-            src = None
-
-        if src:
-            file_path += src
-            if not os.path.exists(file_path):
-                print(error_msg)
-                sys.exit(1)
-            text_file = parse_todo_file(src)
-            for line in text_file:
-                if line.num == number:
-                    text_file.insert(dest-1, text_file.pop(number-1))
-                    write_tasks(text_file, src)
-        else:
-            for task in current_tasks:
-                if task.num == number:
-                    current_tasks.insert(dest-1, current_tasks.pop(number-1))
-                    write_tasks(current_tasks)
-                    break
+    if os.path.samefile(src_path, dest_path):
+        print("TODO: Source and destination are the same file.")
+        sys.exit(1)
 
-    else:
+    todo_path = get_file_dir()
+    tasks = current_tasks if os.path.samefile(src_path, todo_path) \
+        else load_tasks(src_path)
+    if numbers[-1] > len(tasks):
+        print("TODO: No task {0}.".format(
+            next(n for n in numbers if n > len(tasks))))
         sys.exit(1)
+    # The lines are appended as they are, changes waiting in the journal
+    # of the destination are folded into it first
+    if os.path.exists(journal_path(dest_path)):
+        global USE_JOURNAL
+        USE_JOURNAL = False
+        write_tasks(current_tasks if os.path.samefile(dest_path, todo_path)
+                    else load_tasks(dest_path), terms[1])
+    rows = [tasks.order[n - 1] for n in numbers]
+    commit_move(tasks, rows, dest_path)
+    print("TODO: {0} task(s) moved from {1} to {2}.".format(
+        len(rows), src, terms[1]))
 
 
 def prepend_text():
@@ -779,7 +4123,7 @@ def prepend_text():
         sys.exit(1)
     TEXT = sys.argv[arg+2]
     found = False
-    for task in current_tasks:
+    for task in current_tasks.with_number(item_number):
         if task.num == item_number:
             task.content = task.content.replace('\n', '')
             task.content = TEXT + ' ' + task.content + '\n'
@@ -825,7 +4169,7 @@ def replace_priority():
         sys.exit(1)
 
     # Change item's priority
-    for item in current_tasks:
+    for item in current_tasks.with_number(item_number):
         if item.num == item_number:
             item.priority = priority
             item.content = "(" + priority + ") " + item.content
@@ -852,7 +4196,7 @@ def replace_text():
 
     new_task = parse_task(replacement, item_number)
     found = False
-    for item in current_tasks:
+    for item in current_tasks.with_number(item_number):
         if item.num == item_number:
             print(item.num, item.content)
             print("TODO: Replaced task with:")
@@ -872,8 +4216,13 @@ def make_task_report():
     report
       Adds the number of open tasks and done tasks to report.txt.
     """
-    done = len(parse_todo_file('done.txt'))  # Number of tasks completed
+    # Number of tasks completed
+    done = len(load_tasks(get_file_dir('done.txt')))
+    segments = load_segments()
+    if segments:
+        done += len(segments)  # Counted in the headers
     todo = len(current_tasks)  # Number of tasks pending
+    from datetime import date, datetime
     now = datetime.now()
     current_time = "{:02d}:{:02d}:{:02d}".format(now.hour,
                                                  now.minute, now.second)
@@ -902,7 +4251,8 @@ def make_task_report():
         last_report = ''
 
     # Parse last report's number of tasks
-    report_regex = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\ (\d+)\ (\d+)')
+    report_regex = re.compile(
+        r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\ (\d+)\ (\d+)')
     last_report_data = re.match(report_regex, last_report)
     try:
         last_report_todo = int(last_report_data.group(1))
@@ -923,57 +4273,794 @@ def make_task_report():
         print("TODO: Report file updated.")
 
 
+# Words of done.txt analytics reads: completion dates, creation dates,
+# projects and contexts
+ANALYTICS_WORDS = r'x \d{4}-\d\d-\d\d| \d{4}-\d\d-\d\d|[+@]\S+'
+ANALYTICS_REPORTS = {
+    'summary': ('measure', 'value'),
+    'day': ('date', 'done', 'average', 'left'),
+    'week': ('week', 'done', 'average', 'left'),
+    'project': ('name', 'done', 'per_week', 'last', 'lead_time'),
+    'context': ('name', 'done', 'per_week', 'last', 'lead_time'),
+}
+ROLLING_DAYS = 7  # days in the rolling average of the day report
+ROLLING_WEEKS = 4  # weeks in the rolling average of the week report
+
+
+def analytics_words(tasks, pattern):
+    """
+    Yields (word, rows) for the words of an ArchiveIndex, a TaskTable
+    or a SegmentedArchive that match pattern. Segments have no index,
+    the words of their lines are gathered as they are read.
+    """
+    if isinstance(tasks, ArchiveIndex):
+        yield from tasks.words_matching(pattern)
+        return
+    regex = re.compile(pattern)
+    if isinstance(tasks, SegmentedArchive):
+        index = {}
+        for row, line in enumerate(tasks.lines()):
+            for word in index_words(line):
+                if regex.fullmatch(word):
+                    rows = index.setdefault(word, array('I'))
+                    if not rows or rows[-1] != row:
+                        rows.append(row)
+        yield from index.items()
+        return
+    for word, rows in tasks.word_index().items():
+        if regex.fullmatch(word):
+            yield word, rows
+
+
+def completion_columns(sources):
+    """
+    Returns the columns of the completions of files of done tasks,
+    the rows of each after those of the ones before, built from the
+    rows of the words of their index rather than from their lines,
+    each column filled by slices or map() at C speed:
+      days   Counter of the tasks completed on each day (ordinal)
+      done   completion day of every row, 0 if it has none
+      lead   days from creation to completion of every row, negative
+             if either date is missing
+      names  {+project or @context: [lists of rows]}
+    """
+    import collections
+    from datetime import date
+    days = collections.Counter()
+    done, lead = array('i'), array('i')
+    names = {}
+    for tasks in sources:
+        offset = len(done)
+        rows = len(tasks)
+        source_done = array('i', bytes(4 * rows))
+        created = array('i', [1 << 30]) * rows
+        for word, word_rows in analytics_words(tasks, ANALYTICS_WORDS):
+            if word[0] in '+@':
+                if offset:
+                    word_rows = array('I', map(offset.__add__, word_rows))
+                names.setdefault(word, []).append(word_rows)
+                continue
+            try:
+                day = date.fromisoformat(word[-10:]).toordinal()
+            except ValueError:
+                continue  # Not a date
+            if word[0] == 'x':
+                days[day] += len(word_rows)
+                column = source_done
+            else:
+                column = created
+            first, last = word_rows[0], word_rows[-1]
+            if last - first + 1 == len(word_rows):  # Consecutive rows
+                column[first:last + 1] = array('i', [day]) * len(word_rows)
+            else:
+                collections.deque(map(column.__setitem__, word_rows,
+                                      itertools.repeat(day)), maxlen=0)
+        done.extend(source_done)
+        lead.extend(map(operator.sub, source_done, created))
+    return days, done, lead, names
+
+
+def rolling_average(series, window):
+    """
+    Returns the averages of series over the window items ending at
+    each one, fewer at the start
+    """
+    sums = list(itertools.accumulate(series, initial=0))
+    return [round((sums[i + 1] - sums[max(0, i + 1 - window)]) /
+                  min(i + 1, window), 2) for i in range(len(series))]
+
+
+def lead_times(counts):
+    """
+    Returns the mean and the median of a Counter of lead times,
+    leaving out the negative ones, None if there are none
+    """
+    leads = sorted((days, count) for days, count in counts.items()
+                   if days >= 0)
+    total = sum(count for _, count in leads)
+    if not total:
+        return None, None
+    mean = sum(days * count for days, count in leads) / total
+    seen = 0
+    for days, count in leads:
+        seen += count
+        if 2 * seen >= total:
+            return round(mean, 2), days
+
+
+def analytics_records(report, sources, open_tasks):
+    """
+    Yields the records of an analytics report on files of done
+    tasks. open_tasks is the number of tasks left now, the start of
+    the burn-down counting back.
+    """
+    import collections
+    from datetime import date
+    days, done, lead, names = completion_columns(sources)
+    first, last = (min(days), max(days)) if days else (0, -1)
+    series = [days[day] for day in range(first, last + 1)]
+    weeks = max(1, len(series) / 7)
+    if report == 'summary':
+        mean, median = lead_times(collections.Counter(lead))
+        total = sum(series)
+        measures = [
+            ('done', total),
+            ('first', date.fromordinal(first).isoformat() if days else None),
+            ('last', date.fromordinal(last).isoformat() if days else None),
+            ('per_day', round(total / max(1, len(series)), 2)),
+            ('per_week', round(total / weeks, 2)),
+            ('last_week', sum(series[-7:])),
+            ('lead_time_mean', mean),
+            ('lead_time_median', median),
+            ('open', open_tasks),
+        ]
+        for measure, value in measures:
+            yield {'measure': measure, 'value': value}
+    elif report in ('day', 'week'):
+        labels = [date.fromordinal(day).isoformat()
+                  for day in range(first, last + 1)]
+        window = ROLLING_DAYS
+        if report == 'week':
+            # Weeks start on Monday, ordinal 1 is a Monday
+            weekly = collections.Counter()
+            for day, count in days.items():
+                weekly[day - (day - 1) % 7] += count
+            mondays = range(first - (first - 1) % 7, last + 1, 7)
+            series = [weekly[monday] for monday in mondays]
+            labels = ['{0}-W{1:02d}'.format(*date.fromordinal(
+                monday).isocalendar()[:2]) for monday in mondays]
+            window = ROLLING_WEEKS
+        # Tasks left after each day: the open ones and the ones
+        # completed later
+        left = itertools.accumulate(reversed(series), initial=open_tasks)
+        left = list(left)[-2::-1]
+        for label, count, average, remaining in zip(
+                labels, series, rolling_average(series, window), left):
+            yield {'date' if report == 'day' else 'week': label,
+                   'done': count, 'average': average, 'left': remaining}
+    else:
+        sigil = '+' if report == 'project' else '@'
+        for name in sorted(names):
+            if name[0] != sigil:
+                continue
+            count, latest = 0, 0
+            leads = collections.Counter()
+            for rows in names[name]:
+                count += len(rows) - operator.countOf(
+                    map(done.__getitem__, rows), 0)
+                latest = max(latest, max(map(done.__getitem__, rows)))
+                leads.update(map(lead.__getitem__, rows))
+            if not count:
+                continue  # None done
+            yield {'name': name, 'done': count,
+                   'per_week': round(count / weeks, 2),
+                   'last': date.fromordinal(latest).isoformat(),
+                   'lead_time': lead_times(leads)[0]}
+
+
+def show_analytics():
+    """
+    analytics [summary|day|week|project|context]
+      Displays completion analytics of done.txt and of the done tasks
+      rotated out of it: the summary, the tasks completed per day or
+      per week with their rolling average and the tasks left
+      (burn-down), or the completions and lead time per project or
+      context. --format csv (or json, ndjson) prints it as
+      records.
+    """
+    reports = check_word_arguments(sys.argv) or ['summary']
+    report = reports[0]
+    if report not in ANALYTICS_REPORTS:
+        print("TODO: analytics reports are",
+              ', '.join(ANALYTICS_REPORTS))
+        sys.exit(1)
+    fields = ANALYTICS_REPORTS[report]
+    # Done tasks rotated into segments count too
+    sources = [load_archive(get_file_dir('done.txt'))]
+    segments = load_segments()
+    if segments:
+        sources.append(segments)
+    records = analytics_records(report, sources,
+                                current_tasks.counters()[''][0])
+    if FORMAT:
+        write_records(records, fields)
+        return
+    rows = [['' if record[field] is None else str(record[field])
+             for field in fields] for record in records]
+    if report == 'summary':
+        for measure, value in rows:
+            print(measure + ':', value)
+        return
+    widths = [max([len(field)] + [len(row[i]) for row in rows])
+              for i, field in enumerate(fields)]
+    for row in [fields] + rows:
+        print('  '.join(value.ljust(width) if i == 0 else value.rjust(width)
+                        for i, (value, width) in enumerate(zip(row, widths))))
+
+
+def show_stats():
+    """
+    stats
+      Displays the number of open and done tasks in todo.txt, in all
+      and by priority, project and context.
+    """
+    counts = current_tasks.counters()
+    print_count("TODO:", counts[''])
+    for title, prefix in (("Priorities:", 'pri:'), ("Projects:", '+'),
+                          ("Contexts:", '@')):
+        keys = sorted(key for key in counts if key[:len(prefix)] == prefix)
+        if keys:
+            print(title)
+        for key in keys:
+            name = '(' + key[4:] + ')' if prefix == 'pri:' else key
+            print_count('  ' + name, counts[key])
+
+
+@contextlib.contextmanager
+def command_options():
+    """
+    Takes the options of one command out of sys.argv, the settings
+    are restored once it ran
+    """
+    global USE_CACHE, USE_JOURNAL, LIMIT, OFFSET, FORMAT, JOBS, FORCE
+    settings = USE_CACHE, USE_JOURNAL, LIMIT, OFFSET, FORMAT, JOBS, FORCE
+    try:
+        read_options()
+        yield
+    finally:
+        (USE_CACHE, USE_JOURNAL, LIMIT, OFFSET, FORMAT, JOBS,
+         FORCE) = settings
+
+
+# Connections waiting for serve to accept them
+SERVE_BACKLOG = 64
+SERVE_SOCKET = '.todo.sock'
+
+
+def serve():
+    """
+    serve
+      Keeps todo.txt and done.txt parsed in memory and runs the actions
+      sent to the Unix socket .todo.sock of the todo.txt directory, one
+      at a time. A client sends the arguments it would give todo.py as
+      a JSON array on one line, then reads the exit code on a line and
+      the output. Files changed from outside are read again before the
+      next action, appended lines only are parsed.
+    """
+    global RESIDENT
+    import json
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        print("TODO: serve needs Unix sockets")
+        sys.exit(1)
+    path = os.path.join(PATH, SERVE_SOCKET)
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX) as probe:
+            try:
+                probe.connect(path)
+            except OSError:
+                os.remove(path)  # Left by a server that died
+            else:
+                print("TODO: Already served on", path)
+                sys.exit(1)
+
+    # The directory lock is taken for each action, the other processes
+    # can go on using the files
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    sys.stdin = io.StringIO()  # Actions that ask for input fail
+    RESIDENT = {}
+    load_tasks(get_file_dir('todo.txt'))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the owner may connect, the socket runs actions as the owner
+    umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(SERVE_BACKLOG)
+    print("TODO: Serving", PATH, "on", path, flush=True)
+    try:
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                try:
+                    line = connection.makefile('rb').readline()
+                    argv = json.loads(line.decode('utf-8'))
+                    if not isinstance(argv, list):
+                        raise ValueError
+                except ValueError:
+                    code, output = 1, "TODO: Send a JSON array of arguments\n"
+                else:
+                    code, output = serve_request(argv)
+                with contextlib.suppress(OSError):
+                    connection.sendall('{0}\n{1}'.format(
+                        code, output).encode('utf-8'))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(path)
+
+
+def serve_request(argv):
+    """
+    Runs a client's todo.py arguments with their own options against
+    the files kept in memory, under the directory lock.
+    Returns the exit code and the output.
+    """
+    global current_tasks, arg
+    sys.argv = ['todo.py'] + [str(word) for word in argv]
+    output = io.StringIO()
+    code = 0
+    with contextlib.redirect_stdout(output):
+        try:
+            with command_options():
+                arg, user_action = find_action(sys.argv)
+                if user_action in (None, serve, shell, add_multiple_tasks):
+                    print("TODO: Action can't be served")
+                    sys.exit(1)
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX if user_action in
+                                WRITE_ACTIONS else fcntl.LOCK_SH)
+                recover_move()
+                recover_rotation()
+                current_tasks = load_tasks(get_file_dir('todo.txt'))
+                user_action()
+        except SystemExit as exit:
+            code = exit.code if isinstance(exit.code, int) else 1
+        except EOFError:
+            print("TODO: Action can't ask for input when served")
+            code = 1
+        except Exception:
+            import traceback
+            traceback.print_exc(file=output)
+            code = 1
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    if code != 0:
+        RESIDENT.clear()  # Changes the action left in memory are dropped
+    return code, output.getvalue()
+
+
+SHELL_PROMPT = 'todo> '
+# Actions that write files of their own, which a shell can't defer
+UNDEFERRED_ACTIONS = {add_multiple_tasks, compact_journal, move_task}
+
+
+def shell():
+    """
+    shell
+      Runs actions read one per line, from the terminal or a script on
+      stdin, against todo.txt parsed once. Their changes are written at
+      once on commit, and on exit, quit or the end of the input.
+      Options can precede the action on its line, # starts a comment.
+      A script's actions don't ask for confirmation, as with -f.
+      Exits with 1 if an action failed, or if the changes since the
+      last commit were dropped because another process wrote todo.txt.
+    """
+    global DEFER_WRITES, FORCE
+    import shlex
+    interactive = sys.stdin.isatty()
+    script = sys.stdin
+    if not interactive:
+        sys.stdin = io.StringIO()  # Actions can't take the next lines
+        FORCE = True
+    failed = False
+    DEFER_WRITES = True
+    # Other processes read and write between actions, the directory is
+    # locked while one runs, and shared while changes aren't written
+    read_from = file_identity(get_file_dir('todo.txt'))
+    changed = False
+    relock(None)
+    while True:
+        if interactive:
+            print(SHELL_PROMPT, end='', flush=True)
+        line = script.readline()
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError as error:
+            print("TODO:", error)
+            failed = True
+            continue
+        if not line or words[:1] in (['exit'], ['quit']):
+            break
+        if not words:
+            continue
+        if words == ['commit']:
+            if shell_reread(read_from, changed, True):
+                failed = failed or changed
+            else:
+                flush_shell()
+            read_from = file_identity(get_file_dir('todo.txt'))
+            changed = False
+            relock(None)
+            continue
+        user_action = find_action(words)[1]
+        if user_action in UNDEFERRED_ACTIONS or user_action in (
+                None, serve, shell):
+            print("TODO: Action can't be run in the shell:", words[0])
+            failed = True
+            continue
+        writes = user_action in WRITE_ACTIONS
+        if shell_reread(read_from, changed, writes):
+            read_from = file_identity(get_file_dir('todo.txt'))
+            failed, changed = failed or changed, False
+        code, _ = run_action(['todo.py'] + words, queued=False)
+        failed = failed or code != 0
+        changed = changed or writes and code == 0
+        relock(False if changed else None)
+    if interactive:
+        print()
+    if changed:
+        if shell_reread(read_from, changed, True):
+            failed = True
+        else:
+            flush_shell()
+    sys.exit(1 if failed else 0)
+
+
+def relock(exclusive):
+    """
+    Changes the lock lock_directory took: exclusive, shared if False,
+    none if None
+    """
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN if exclusive is None else
+                    fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+def shell_reread(read_from, changed, exclusive):
+    """
+    Locks the directory for an action of the shell, and reads todo.txt
+    again if another process wrote it since it was read_from, which
+    drops the changes of the shell. Returns True if it was read again.
+    """
+    global current_tasks
+    relock(exclusive)
+    file_path = get_file_dir('todo.txt')
+    if file_identity(file_path) == read_from:
+        return False
+    if changed:
+        print("TODO: todo.txt was changed by another process, the changes"
+              " since the last commit are dropped")
+    del deferred_done[:]
+    current_tasks = load_tasks(file_path)
+    return True
+
+
+def flush_shell():
+    """
+    Writes the changes of the shell with the queued requests, and
+    reads todo.txt back for the next actions
+    """
+    global DEFER_WRITES, current_tasks
+    flush_queue()
+    current_tasks = load_tasks(get_file_dir('todo.txt'))
+    DEFER_WRITES = True
+
+
+possible_actions = {
+    'add': add_task, 'a': add_task,
+    'addm': add_multiple_tasks,
+    'addto': add_to_file,
+    'append': append_to_task, 'app': append_to_task,
+    'archive': archive_tasks,
+    'compact': compact_journal,
+    'deduplicate': remove_duplicates, 'remdup': remove_duplicates,
+    'del': remove_task, 'rm': remove_task,
+    'depri': remove_priority, 'dp': remove_priority,
+    'do': mark_done,
+    'help': print_help,
+    'import': import_tasks,
+    'list': list_tasks, 'ls': list_tasks,
+    'listall': list_all, 'lsa': list_all,
+    'listcon': list_contexts, 'lsc': list_contexts,
+    'listfile': list_files, 'lf': list_files,
+    'listpri': list_priorities, 'lsp': list_priorities,
+    'listproj': list_projects, 'lsprj': list_projects,
+    'move': move_task, 'mv': move_task,
+    'prepend': prepend_text, 'prep': prepend_text,
+    'pri': replace_priority, 'p': replace_priority,
+    'replace': replace_text,
+    'report': make_task_report,
+    'stats': show_stats,
+    'analytics': show_analytics,
+    'serve': serve,
+    'shell': shell,
+    'shorthelp': print_short_help
+}
+
+
+# Actions that change todo.txt
+WRITE_ACTIONS = {
+    add_task, add_multiple_tasks, add_to_file, append_to_task,
+    archive_tasks, compact_journal, import_tasks, remove_duplicates,
+    remove_task, remove_priority, mark_done, move_task, prepend_text,
+    replace_priority, replace_text,
+}
+# Actions that never read todo.txt, it isn't parsed for them
+TASKLESS_ACTIONS = {
+    add_task, add_multiple_tasks, add_to_file, import_tasks, list_files,
+    print_help, print_short_help, serve,
+}
+# Listings run on several todo directories, with the function
+# selecting the tasks of each
+FEDERATED_ACTIONS = {
+    list_tasks: term_matches,
+    list_priorities: priority_matches,
+}
+# Write actions that never prompt, so another process can run them
+QUEUED_ACTIONS = {
+    add_task, append_to_task, archive_tasks, remove_priority, mark_done,
+    prepend_text, replace_priority,
+}
+
+
+def find_action(argv):
+    """
+    Returns the position and function of the action in argv
+    """
+    for position, word in enumerate(argv):
+        if word in possible_actions:
+            return position, possible_actions[word]
+    return None, None
+
+
+def lock_directory(exclusive):
+    """
+    Takes an advisory lock on the todo directory, held until exit.
+    Returns False if an exclusive lock had to be waited for.
+    """
+    if fcntl is None:
+        return True
+    global lock_file
+    lock_file = open(os.path.join(PATH, '.todo.lock'), 'a')
+    if not exclusive:
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        return True
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def queue_dir():
+    return os.path.join(PATH, '.todo.queue')
+
+
+def queue_request(argv):
+    """
+    Leaves an action for the process holding the lock to run.
+    Returns the path of the request.
+    """
+    import json
+    os.makedirs(queue_dir(), exist_ok=True)
+    name = '{0:020d}-{1}'.format(time.time_ns(), os.getpid())
+    path = os.path.join(queue_dir(), name + '.req')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(argv, f)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def take_response(request):
+    """
+    Prints and exits with the response to a queued request,
+    if it was already run. Otherwise withdraws the request.
+    """
+    response = request[:-len('.req')] + '.out'
+    try:
+        with open(response) as f:
+            code, _, output = f.read().partition('\n')
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(request)
+        return
+    os.remove(response)
+    sys.stdout.write(output)
+    sys.exit(int(code))
+
+
+def run_action(argv, capture=False, queued=True):
+    """
+    Runs the action in argv, with its options, against current_tasks.
+    Changes are undone if the action fails.
+    Returns the exit code and the output if it's captured.
+    """
+    global arg
+    sys.argv = argv
+    state = current_tasks.snapshot()
+    archived = len(deferred_done)
+    output = io.StringIO()
+    code = 0
+    with contextlib.redirect_stdout(output if capture else sys.stdout):
+        try:
+            with command_options():
+                arg, user_action = find_action(sys.argv)
+                if queued and user_action not in QUEUED_ACTIONS:
+                    print("TODO: Action can't be queued")
+                    sys.exit(1)
+                user_action()
+        except SystemExit as exit:
+            code = exit.code if isinstance(exit.code, int) else 1
+        except EOFError:
+            print("TODO: Action can't ask for input here")
+            code = 1
+    if code != 0:
+        current_tasks.restore(state)
+        del deferred_done[archived:]
+    elif state[0] != current_tasks.order:
+        # Number tasks as if the next action reloaded the file, the
+        # journal needs the changes made under the old numbers first
+        current_tasks.batches.append(journal_records(current_tasks))
+        current_tasks.renumber()
+    return code, output.getvalue()
+
+
+def queued_requests():
+    """
+    Returns the names of the requests waiting in the queue, oldest first
+    """
+    if not os.path.isdir(queue_dir()):
+        return []
+    return sorted(name for name in os.listdir(queue_dir())
+                  if name.endswith('.req'))
+
+
+def flush_writes():
+    """
+    Writes what the actions run with DEFER_WRITES changed: todo.txt at
+    once, then the tasks they archived, once todo.txt is committed
+    """
+    global DEFER_WRITES
+    DEFER_WRITES = False
+    done = [Task(0, line) for line in deferred_done]
+    del deferred_done[:]
+    write_tasks(current_tasks)
+    if done:
+        archive_done(done)
+
+
+def commit_queue(own_argv):
+    """
+    Runs our own action and every queued one, then writes todo.txt
+    once for all of them (group commit). Exits with our action's code.
+    """
+    global DEFER_WRITES
+    DEFER_WRITES = True
+    code, _ = run_action(own_argv)
+    flush_queue()
+    sys.exit(code)
+
+
+def flush_queue():
+    """
+    Runs the queued requests, writes what they and the actions run
+    before them changed, then answers the requests
+    """
+    import json
+    responses = []
+    for name in queued_requests():
+        path = os.path.join(queue_dir(), name)
+        try:
+            with open(path) as f:
+                argv = json.load(f)
+        except (OSError, ValueError):
+            continue
+        responses.append((path, run_action(argv, capture=True)))
+
+    flush_writes()
+
+    # Answer only once the changes are written
+    for path, (request_code, output) in responses:
+        response = path[:-len('.req')] + '.out'
+        with open(response + '.tmp', 'w') as f:
+            f.write('{0}\n{1}'.format(request_code, output))
+        os.replace(response + '.tmp', response)
+        os.remove(path)
+
+
+def read_options():
+    """
+    Takes the options out of sys.argv into the settings
+    """
+    global USE_CACHE, USE_JOURNAL
+    if pop_option('--no-cache'):
+        USE_CACHE = False
+    if pop_option('--journal'):
+        USE_JOURNAL = True
+    global LIMIT, OFFSET
+    limit, offset = pop_option('--limit', True), pop_option('--offset', True)
+    for value in (limit, offset):
+        if value is not None and not value.isdigit():
+            print("TODO: --limit and --offset take a number of tasks")
+            sys.exit(1)
+    if limit is not None:
+        LIMIT = int(limit)
+    if offset is not None:
+        OFFSET = int(offset)
+    global FORMAT
+    FORMAT = pop_option('--format', True)
+    if FORMAT not in (None, 'json', 'ndjson', 'csv'):
+        print("TODO: --format takes json, ndjson or csv")
+        sys.exit(1)
+    global JOBS
+    jobs = pop_option('--jobs', True)
+    if jobs is not None:
+        if not jobs.isdigit() or int(jobs) < 1:
+            print("TODO: --jobs takes a number of processes")
+            sys.exit(1)
+        JOBS = int(jobs)
+    global FORCE
+    if pop_option('-f'):
+        FORCE = True
+
+
 def main():
-    possible_actions = {
-        'add': add_task, 'a': add_task,
-        'addm': add_multiple_tasks,
-        'addto': add_to_file,
-        'append': append_to_task, 'app': append_to_task,
-        'archive': archive_tasks,
-        'deduplicate': remove_duplicates, 'remdup': remove_duplicates,
-        'del': remove_task, 'rm': remove_task,
-        'depri': remove_priority, 'dp': remove_priority,
-        'do': mark_done,
-        'help': print_help,
-        'list': list_tasks, 'ls': list_tasks,
-        'listall': list_all, 'lsa': list_all,
-        'listcon': list_contexts, 'lsc': list_contexts,
-        'listfile': list_files, 'lf': list_files,
-        'listpri': list_priorities, 'lsp': list_priorities,
-        'listproj': list_projects, 'lsprj': list_projects,
-        'move': move_task, 'mv': move_task,
-        'prepend': prepend_text, 'prep': prepend_text,
-        'pri': replace_priority, 'p': replace_priority,
-        'replace': replace_text,
-        'report': make_task_report,
-        'shorthelp': print_short_help
-    }
-
-    # Check parameters
+    read_options()
     parameters = check_parameters()
 
     # Get the todo.txt path
     global PATH
-    PATH = get_working_path()
-
-    # Parse current todos
-    global current_tasks
-    todo_file = get_file_dir('todo.txt')
-    current_tasks = parse_todo_file(todo_file)
+    directories = get_working_paths()
+    PATH = directories[0]
 
-    # Do user actions
+    # Find the action
     global arg  # Number of the action argument
-    for arg in range(len(sys.argv)):
-        if sys.argv[arg] in possible_actions.keys():
-            user_action = possible_actions.get(sys.argv[arg])
-            break
-        else:
-            user_action = None
-
+    arg, user_action = find_action(sys.argv)
     if not user_action:
         print_help()
         sys.exit(1)
-
+    if len(directories) > 1:
+        list_directories(user_action, directories)
+        return
+
+    # Writers take turns, a writer that has to wait leaves its action
+    # to the one holding the lock
+    request = None
+    if user_action not in WRITE_ACTIONS:
+        lock_directory(exclusive=False)
+    elif not lock_directory(exclusive=True):
+        if user_action in QUEUED_ACTIONS:
+            request = queue_request(sys.argv)
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if request:
+            take_response(request)
+
+    # Parse current todos, only if the action or the queue reads them.
+    # Without queued requests the action runs alone and writes itself.
+    global current_tasks
+    recover_move()
+    recover_rotation()
+    group = user_action in QUEUED_ACTIONS and queued_requests()
+    if group or user_action not in TASKLESS_ACTIONS:
+        current_tasks = load_tasks(get_file_dir('todo.txt'))
+
+    if group:
+        commit_queue(sys.argv)
     user_action()
 
 